@@ -0,0 +1,88 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Captures the in-code policy defaults of services into a snapshot file.
+
+Loading in-code policy defaults requires importing each service's code,
+which is slow and memory-hungry. This command is run once, on a node where
+the services are installed, and the resulting file is then referenced by
+``[rbac] policy_snapshot_file`` in tempest.conf, so that Patrole never has
+to import the services' code itself.
+
+Usage::
+
+    $ patrole-policy-snapshot --output /etc/patrole/policy-snapshot.json \
+        nova keystone
+
+If the output file already exists, the policy defaults of the given
+services are added to it; the entries of other services are preserved.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from patrole_tempest_plugin import rbac_policy_parser
+
+
+def generate_snapshot(services, output):
+    """Writes the in-code policy defaults of ``services`` to ``output``.
+
+    :param services: list of services registered under
+        ``oslo.policy.policies``.
+    :param output: path to the snapshot file.
+    :returns: the snapshot written to ``output``.
+    """
+    snapshot = {}
+    if os.path.isfile(output):
+        snapshot = rbac_policy_parser.load_policy_snapshot(output)
+
+    for service in services:
+        snapshot[service] = rbac_policy_parser.load_code_policy(service)
+
+    with open(output, 'w') as f:
+        json.dump(snapshot, f, sort_keys=True, separators=(',', ':'))
+    return snapshot
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Capture the in-code policy defaults of OpenStack '
+                    'services into a snapshot file.')
+    parser.add_argument('services', nargs='+',
+                        help='Services whose in-code policy defaults are '
+                             'captured, for example nova or keystone.')
+    parser.add_argument('--output', '-o', required=True,
+                        help='Path to the snapshot file.')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    snapshot = generate_snapshot(args.services, args.output)
+
+    for service in args.services:
+        if not snapshot[service]:
+            sys.stderr.write('No in-code policy defaults found for %s.\n'
+                             % service)
+        else:
+            sys.stdout.write('Captured %d policy defaults for %s.\n'
+                             % (len(snapshot[service]), service))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Predicts the outcome of RBAC tests without running them.
+
+Every test decorated with ``rbac_rule_validation.action`` is evaluated
+against the local policy files for each of the given roles, the same way
+the decorator does before running the test. No request is sent to the
+cloud, so the impact of a policy change can be checked in seconds.
+
+Usage::
+
+    $ patrole-rbac-plan --config-file /etc/tempest/tempest.conf \
+        --role Member --role reader --format json
+
+Each test is predicted as:
+
+* ``allow``: the role is expected to be allowed to perform the action.
+* ``deny``: the role is expected to receive ``expected_error_code``.
+* ``skip``: the policy action is not in the policy and
+  ``[rbac] strict_policy_check`` is False.
+* ``error``: the test would fail before running its API call.
+
+Every service used by a test is assumed to be deployed, and policy targets
+do not include the ``extra_target_data`` of tests, which can only be
+resolved from the resources of a live run.
+"""
+
+import argparse
+import importlib
+import inspect
+import json
+import os
+import pkgutil
+import sys
+
+from oslo_log import log as logging
+
+from tempest import config
+
+from patrole_tempest_plugin import rbac_exceptions
+from patrole_tempest_plugin import rbac_policy_parser
+
+CONF = config.CONF
+LOG = logging.getLogger(__name__)
+
+# Placeholder credentials: only their equality between the access token and
+# the target matters to owner checks.
+_PROJECT_ID = 'rbac-plan-project'
+_USER_ID = 'rbac-plan-user'
+
+_DEFAULT_PACKAGES = ['patrole_tempest_plugin.tests.api']
+
+
+def import_modules(packages):
+    """Imports every module of ``packages``.
+
+    :returns: tuple of the imported modules and of the names of the modules
+        that failed to import.
+    """
+    modules = []
+    failures = []
+    for package_name in packages:
+        package = importlib.import_module(package_name)
+        modules.append(package)
+        for _, name, _ in pkgutil.walk_packages(package.__path__,
+                                                package_name + '.'):
+            try:
+                modules.append(importlib.import_module(name))
+            except Exception as e:
+                LOG.warning("Failed to import %s: %s", name, e)
+                failures.append(name)
+    return modules, failures
+
+
+def find_rbac_tests(modules):
+    """Yields the ID and ``RbacAction`` of the RBAC tests of ``modules``."""
+    for module in modules:
+        for class_name, test_class in sorted(vars(module).items()):
+            if not inspect.isclass(test_class):
+                continue
+            if test_class.__module__ != module.__name__:
+                continue
+            for test_name in sorted(dir(test_class)):
+                if not test_name.startswith('test'):
+                    continue
+                rbac_action = getattr(getattr(test_class, test_name),
+                                      'rbac_action', None)
+                if rbac_action is not None:
+                    yield ('%s.%s.%s' % (module.__name__, class_name,
+                                         test_name), rbac_action)
+
+
+def predict(rbac_action, role, parsers):
+    """Predicts the outcome of an RBAC test for ``role``.
+
+    :param rbac_action: ``RbacAction`` of the test.
+    :param role: role the test is run with.
+    :param parsers: dictionary of ``RbacPolicyParser`` by service, filled
+        in as services are evaluated.
+    :returns: one of ``allow``, ``deny``, ``skip`` or ``error``.
+    """
+    if rbac_action.admin_only:
+        return 'allow' if role == CONF.identity.admin_role else 'deny'
+
+    try:
+        parser = parsers.get(rbac_action.service)
+        if parser is None:
+            parser = rbac_policy_parser.RbacPolicyParser(
+                _PROJECT_ID, _USER_ID, rbac_action.service)
+            parsers[rbac_action.service] = parser
+        allowed = parser.allowed(rbac_action.rule, role)
+    except rbac_exceptions.RbacParsingException:
+        return 'error' if CONF.rbac.strict_policy_check else 'skip'
+    except rbac_exceptions.RbacInvalidService:
+        return 'error'
+    return 'allow' if allowed else 'deny'
+
+
+def build_plan(tests, roles):
+    """Predicts the outcome of ``tests`` for each of ``roles``.
+
+    :param tests: iterable of test IDs and ``RbacAction`` tuples.
+    :param roles: list of roles.
+    :returns: list with one dictionary per test.
+    """
+    tests = list(tests)
+    parser_class = rbac_policy_parser.RbacPolicyParser
+    # Every service used by a test is assumed to be deployed, so that the
+    # service catalog is never requested. The services known beforehand,
+    # if any, are restored afterwards.
+    old_services = vars(parser_class).get('available_services')
+    if old_services is None:
+        parser_class.available_services = sorted(
+            set(rbac_action.service for _, rbac_action in tests))
+
+    try:
+        parsers = {}
+        plan = []
+        for test_id, rbac_action in tests:
+            plan.append({
+                'test': test_id,
+                'service': rbac_action.service,
+                'rule': rbac_action.rule,
+                'admin_only': rbac_action.admin_only,
+                'expected_error_code': rbac_action.expected_error_code,
+                'outcomes': dict((role, predict(rbac_action, role, parsers))
+                                 for role in roles)
+            })
+    finally:
+        if old_services is None:
+            del parser_class.available_services
+    return plan
+
+
+def format_table(plan, roles):
+    """Formats ``plan`` as a text table with one column per role."""
+    header = ['test', 'rule'] + list(roles)
+    rows = []
+    for entry in plan:
+        rows.append([entry['test'], entry['rule']])
+        rows[-1].extend(entry['outcomes'][role] for role in roles)
+    widths = [max([len(header[i])] + [len(row[i]) for row in rows])
+              for i in range(len(header))]
+    lines = []
+    for row in [header] + rows:
+        lines.append('  '.join(value.ljust(width)
+                               for value, width in zip(row, widths)).rstrip())
+    return '\n'.join(lines) + '\n'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Predict the outcome of RBAC tests from the local '
+                    'policy files, without running them.')
+    parser.add_argument('--config-file',
+                        help='Path to tempest.conf. Defaults to the file '
+                             'Tempest would use.')
+    parser.add_argument('--role', action='append', dest='roles',
+                        help='Role to evaluate the tests for. Can be '
+                             'repeated. Defaults to [rbac] rbac_test_roles '
+                             'or, if unset, rbac_test_role.')
+    parser.add_argument('--package', action='append', dest='packages',
+                        help='Package containing RBAC tests. Can be '
+                             'repeated. Defaults to %s.'
+                             % ', '.join(_DEFAULT_PACKAGES))
+    parser.add_argument('--format', choices=['table', 'json'],
+                        default='table', help='Output format.')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.config_file:
+        # Tempest reads its configuration when an option is first read,
+        # which may be when the test modules are imported, so the path is
+        # set before anything else.
+        CONF.set_config_path(os.path.abspath(args.config_file))
+
+    modules, failures = import_modules(args.packages or _DEFAULT_PACKAGES)
+    roles = args.roles or CONF.rbac.rbac_test_roles
+    if not roles:
+        roles = [CONF.rbac.rbac_test_role]
+    plan = build_plan(find_rbac_tests(modules), roles)
+
+    if args.format == 'json':
+        json.dump(plan, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        sys.stdout.write(format_table(plan, roles))
+
+    for role in roles:
+        counts = {}
+        for entry in plan:
+            outcome = entry['outcomes'][role]
+            counts[outcome] = counts.get(outcome, 0) + 1
+        sys.stderr.write('%s: %s\n' % (role, ', '.join(
+            '%d %s' % (counts[outcome], outcome)
+            for outcome in sorted(counts))))
+    if failures:
+        sys.stderr.write('Failed to import %d modules: %s\n'
+                         % (len(failures), ', '.join(failures)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,6 +23,12 @@ RbacGroup = [
                default='admin',
                help="The current RBAC role against which to run"
                     " Patrole tests."),
+    cfg.ListOpt('rbac_test_roles',
+                default=[],
+                help="If set, each RBAC test is run once with each of these "
+                     "roles, reusing the resources of its test class, "
+                     "instead of only with rbac_test_role. The result for "
+                     "each role is attached to the details of the test."),
     cfg.BoolOpt('enable_rbac',
                 default=True,
                 help="Enables RBAC tests."),
@@ -31,6 +37,12 @@ RbacGroup = [
                 help="If true, throws RbacParsingException for"
                      " policies which don't exist. If false, "
                      "throws skipException."),
+    cfg.BoolOpt('validate_policy_before_setup',
+                default=True,
+                help="If true and strict_policy_check is false, RBAC test "
+                     "classes are skipped before their resources are "
+                     "created when none of their policy actions can be "
+                     "evaluated against the policy."),
     cfg.StrOpt('cinder_policy_file',
                default='/etc/cinder/policy.json',
                help="Location of the neutron policy file."),
@@ -45,5 +57,99 @@ RbacGroup = [
                help="Location of the neutron policy file."),
     cfg.StrOpt('nova_policy_file',
                default='/etc/nova/policy.json',
-               help="Location of the nova policy file.")
+               help="Location of the nova policy file."),
+    cfg.StrOpt('policy_snapshot_file',
+               help="Location of a snapshot of the in-code policy defaults "
+                    "generated by patrole-policy-snapshot. If set, in-code "
+                    "policy defaults are read from the snapshot instead of "
+                    "importing the code of each service."),
+    cfg.StrOpt('cache_dir',
+               help="Directory in which compiled policies and other data "
+                    "are cached, so that they are shared by all the worker "
+                    "processes of a test run and by later runs. The "
+                    "directory must only be writable by trusted users. If "
+                    "not set, nothing is cached on disk."),
+    cfg.IntOpt('service_catalog_cache_ttl',
+               default=3600,
+               min=0,
+               help="Number of seconds for which the list of services in "
+                    "the service catalog is cached in cache_dir."),
+    cfg.IntOpt('role_id_cache_ttl',
+               default=3600,
+               min=0,
+               help="Number of seconds for which the IDs of the admin role "
+                    "and of rbac_test_role are cached in cache_dir."),
+    cfg.IntOpt('policy_decision_cache_size',
+               default=4096,
+               min=0,
+               help="Maximum number of policy decisions cached per process "
+                    "for rules that depend on more than the role. The admin "
+                    "contexts of roles, cached per compiled policy, are "
+                    "bounded by the same size. Set to 0 to disable both "
+                    "caches."),
+    cfg.StrOpt('switch_role_mode',
+               default='role_assignment',
+               choices=['role_assignment', 'dual_user'],
+               help="How switch_role switches between the admin role and "
+                    "rbac_test_role. 'role_assignment' changes the role "
+                    "assigned to the test user and re-authenticates. "
+                    "'dual_user' creates a second user holding the admin "
+                    "role in the project of the test user, which holds "
+                    "rbac_test_role, and switches between the two users "
+                    "without any Keystone write. In 'dual_user' mode, the "
+                    "resources created outside of tests, such as in "
+                    "resource_setup, belong to the admin user, so "
+                    "resources owned by a user, such as keypairs, are not "
+                    "visible to the test user."),
+    cfg.BoolOpt('worker_isolation',
+                default=False,
+                help="If true and dynamic credentials are not used, each "
+                     "worker process creates its own project and user, "
+                     "which its test classes use instead of the configured "
+                     "primary credentials. Role switching in a worker then "
+                     "cannot interfere with the other workers. The project "
+                     "and user are deleted when the worker exits. No "
+                     "network is provisioned for the project, so tests "
+                     "creating servers require a pre-created shared "
+                     "network, such as [compute] fixed_network_name."),
+    cfg.IntOpt('role_switch_concurrency',
+               default=4,
+               min=1,
+               help="Maximum number of role assignment changes that "
+                    "switch_role makes concurrently. Set to 1 to make them "
+                    "one at a time."),
+    cfg.BoolOpt('async_role_restore',
+                default=False,
+                help="If true, the switch back to the admin role after each "
+                     "RBAC test runs in the background, overlapping with the "
+                     "cleanups of the test. The test waits for it in its "
+                     "last cleanup, so that an error raised by the switch "
+                     "is reported on that test."),
+    cfg.StrOpt('timing_report_file',
+               help="If set, each worker process writes the wall-clock "
+                    "time spent in each phase of role switching to this "
+                    "file, suffixed with the process ID, as JSON when it "
+                    "exits."),
+    cfg.StrOpt('results_file',
+               help="If set, each worker process writes the result of each "
+                    "RBAC test for each role to this file, suffixed with "
+                    "the process ID, as JSON when it exits."),
+    cfg.StrOpt('baseline_results',
+               help="Glob pattern of the results files of a previous run, "
+                    "written as configured by results_file. Used with "
+                    "baseline_role to only run the tests whose outcome "
+                    "differs from the baseline."),
+    cfg.StrOpt('baseline_role',
+               help="Role of the baseline run in baseline_results. Tests "
+                    "that passed with this role, and whose policy action "
+                    "the tested role is expected to be allowed to perform "
+                    "exactly when this role is, are skipped and reported "
+                    "as inherited from the baseline."),
+    cfg.IntOpt('keystone_http_pool_size',
+               default=4,
+               min=0,
+               help="Maximum number of keep-alive connections to Keystone "
+                    "that the identity clients used for role switching "
+                    "share within a worker process. Set to 0 to open a new "
+                    "connection for each request instead.")
 ]
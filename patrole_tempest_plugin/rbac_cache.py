@@ -0,0 +1,134 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""On-disk cache shared by the worker processes of a test run.
+
+Entries are stored as files under ``CONF.rbac.cache_dir``. Each entry is
+prefixed with a checksum of its content, so that truncated or otherwise
+corrupt entries are detected and treated as missing, and entries are
+written atomically, so that concurrent workers never read a partially
+written entry.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+_HEADER = b'patrole-cache-1'
+
+
+def is_enabled():
+    """Returns whether ``CONF.rbac.cache_dir`` is configured."""
+    return bool(CONF.rbac.cache_dir)
+
+
+def get_path(name):
+    """Returns the path of the cache entry ``name``."""
+    return os.path.join(CONF.rbac.cache_dir, name)
+
+
+def load(name):
+    """Loads the cache entry ``name``.
+
+    :returns: The content of the entry, or None if the entry does not exist
+        or is corrupt.
+    """
+    path = get_path(name)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+
+    header, _, content = data.partition(b'\n')
+    expected_header = _HEADER + b' ' + \
+        hashlib.sha256(content).hexdigest().encode('ascii')
+    if header != expected_header:
+        LOG.warning("Ignoring corrupt cache entry %s.", path)
+        return None
+    return content
+
+
+def store(name, content):
+    """Atomically stores ``content`` as the cache entry ``name``.
+
+    Failing to store an entry is not fatal: it is only logged.
+    """
+    path = get_path(name)
+    header = _HEADER + b' ' + \
+        hashlib.sha256(content).hexdigest().encode('ascii')
+    try:
+        if not os.path.isdir(CONF.rbac.cache_dir):
+            os.makedirs(CONF.rbac.cache_dir)
+    except OSError:
+        # Another worker may have created the directory concurrently.
+        pass
+
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=CONF.rbac.cache_dir,
+                                        prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header + b'\n' + content)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        LOG.warning("Failed to store cache entry %s: %s", path, e)
+
+
+def delete(name):
+    """Deletes the cache entry ``name``, if it exists."""
+    try:
+        os.remove(get_path(name))
+    except OSError:
+        pass
+
+
+def load_json(name, ttl=None):
+    """Loads the JSON cache entry ``name``.
+
+    :param ttl: Maximum age of the entry, in seconds. If None, the entry
+        never expires.
+    :returns: The deserialized entry, or None if the entry does not exist,
+        is corrupt or has expired.
+    """
+    content = load(name)
+    if content is None:
+        return None
+    try:
+        entry = json.loads(content.decode('utf-8'))
+        timestamp, data = entry['timestamp'], entry['data']
+    except (ValueError, TypeError, KeyError):
+        LOG.warning("Ignoring invalid cache entry %s.", get_path(name))
+        return None
+    if ttl is not None and time.time() - timestamp > ttl:
+        return None
+    return data
+
+
+def store_json(name, data):
+    """Stores ``data`` as the JSON cache entry ``name``."""
+    entry = {'timestamp': time.time(), 'data': data}
+    store(name, json.dumps(entry).encode('utf-8'))
@@ -38,3 +38,7 @@ class RbacParsingException (exceptions.TempestException):
 
 class RbacInvalidErrorCode (exceptions.TempestException):
     message = "Unsupported error code passed in test"
+
+
+class RbacRoleSweepFailed (exceptions.TempestException):
+    message = "RBAC test failed with one or more of the swept roles"
@@ -0,0 +1,136 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Keep-alive HTTP connections shared by the identity clients of RbacUtils.
+
+Tempest clients close their connection after each request, so every role
+switch pays for new TCP and TLS handshakes with Keystone. The identity
+clients used for role switching instead share a process-wide pool of
+keep-alive connections, sized by ``CONF.rbac.keystone_http_pool_size``.
+"""
+
+import threading
+
+from oslo_log import log as logging
+
+from tempest import config
+from tempest.lib.common import http
+
+CONF = config.CONF
+LOG = logging.getLogger(__name__)
+
+_shared_http = None
+_shared_http_lock = threading.Lock()
+
+
+class KeepAliveHttp(http.ClosingHttp):
+    """Tempest's ``ClosingHttp``, keeping its connections alive.
+
+    The ``connection: close`` header that ``ClosingHttp`` adds to each
+    request is dropped, and connections are returned to their pool after
+    each request instead of being closed, so that later requests to the
+    same host reuse them.
+    """
+
+    def __init__(self, disable_ssl_certificate_validation=False,
+                 ca_certs=None, timeout=None, follow_redirects=True,
+                 maxsize=1):
+        # ClosingHttp only accepts follow_redirects from Tempest 20.0.0 on,
+        # so it is set afterwards, for the Tempest releases reading it.
+        super(KeepAliveHttp, self).__init__(
+            disable_ssl_certificate_validation=(
+                disable_ssl_certificate_validation),
+            ca_certs=ca_certs, timeout=timeout)
+        self.follow_redirects = follow_redirects
+        self.connection_pool_kw['maxsize'] = maxsize
+
+    def urlopen(self, method, url, *args, **kwargs):
+        headers = kwargs.get('headers')
+        if headers and 'connection' in headers:
+            kwargs['headers'] = dict((key, value)
+                                     for key, value in headers.items()
+                                     if key != 'connection')
+        return super(KeepAliveHttp, self).urlopen(method, url, *args,
+                                                  **kwargs)
+
+    def clear(self):
+        # Some Tempest releases clear the pools after each request.
+        pass
+
+    def close(self):
+        """Closes every connection of the pools."""
+        super(KeepAliveHttp, self).clear()
+
+    def get_stats(self):
+        """Returns the number of requests made and connections opened."""
+        stats = {'requests': 0, 'connections': 0}
+        for key in self.pools.keys():
+            try:
+                pool = self.pools[key]
+            except KeyError:
+                # The pool was evicted meanwhile.
+                continue
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        return stats
+
+
+def get_shared_http():
+    """Returns the keep-alive HTTP client shared by the process.
+
+    Returns None if sharing is disabled or requests go through a proxy.
+    """
+    global _shared_http
+
+    if CONF.rbac.keystone_http_pool_size < 1:
+        return None
+    if CONF.service_clients.proxy_url:
+        return None
+    with _shared_http_lock:
+        if _shared_http is None:
+            _shared_http = KeepAliveHttp(
+                disable_ssl_certificate_validation=(
+                    CONF.identity.disable_ssl_certificate_validation),
+                ca_certs=CONF.identity.ca_certificates_file,
+                timeout=CONF.service_clients.http_timeout,
+                maxsize=CONF.rbac.keystone_http_pool_size)
+        return _shared_http
+
+
+def share_connections(client):
+    """Makes ``client`` send its requests over the shared connections."""
+    http = get_shared_http()
+    if http is not None and client.http_obj is not http:
+        client.http_obj = http
+    return client
+
+
+def get_http_stats():
+    """Returns the connection reuse statistics of the shared connections."""
+    with _shared_http_lock:
+        if _shared_http is None:
+            return {'requests': 0, 'connections': 0, 'reused': 0}
+        return _shared_http.get_stats()
+
+
+def reset_shared_http():
+    """Closes the shared connections, which are reopened when next used."""
+    global _shared_http
+
+    with _shared_http_lock:
+        if _shared_http is not None:
+            _shared_http.close()
+        _shared_http = None
@@ -0,0 +1,363 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# NOTE: The check classes are only exposed by oslo.policy's private _checks
+# module, but they are needed to walk the parsed rule trees. Fail loudly if
+# an oslo.policy release no longer provides them, rather than compiling
+# rules wrongly.
+try:
+    from oslo_policy import _checks
+except ImportError as e:
+    raise ImportError("oslo_policy._checks, which Patrole uses to compile "
+                      "policy rules, cannot be imported: %s" % e)
+import six
+
+from patrole_tempest_plugin import rbac_exceptions
+
+_CHECK_CLASSES = ('AndCheck', 'FalseCheck', 'NotCheck', 'OrCheck',
+                  'RoleCheck', 'RuleCheck', 'TrueCheck')
+_missing_classes = [name for name in _CHECK_CLASSES
+                    if not hasattr(_checks, name)]
+if _missing_classes:
+    raise ImportError("oslo_policy._checks does not provide %s, which "
+                      "Patrole uses to compile policy rules."
+                      % ', '.join(_missing_classes))
+
+
+class RoleMasks(object):
+    """Compiles role-only policy rules into role bitmasks.
+
+    Most policy rules are boolean combinations of ``role:`` and ``rule:``
+    checks. For such rules, the outcome only depends on the role being
+    checked, so the set of roles that are allowed can be computed once, for
+    all roles at the same time: every role referenced by the policy is
+    interned as a bit in a role table and each rule is compiled into the
+    bitmask of the roles it allows, by and-ing, or-ing and negating the
+    bitmasks of its sub-checks.
+
+    All roles not referenced by the policy are indistinguishable from the
+    policy's point of view, so they share a single bit.
+
+    Rules containing any other kind of check (for example generic checks
+    like ``project_id:%(project_id)s``) are not compiled and must be
+    evaluated by oslo.policy.
+    """
+
+    def __init__(self, rules):
+        self._rules = rules
+        self._roles = {}
+        for check in rules.values():
+            self._intern_roles(check)
+        self._other_roles_bit = 1 << len(self._roles)
+        self._all_roles = (self._other_roles_bit << 1) - 1
+
+        self.masks = {}
+        self._compiled = {}
+        self._compiling = set()
+        for name in rules:
+            self._compile_rule(name)
+
+    @property
+    def roles(self):
+        """The role table, mapping each referenced role to its bit."""
+        return dict((role, 1 << bit) for role, bit in self._roles.items())
+
+    def role_bit(self, role):
+        """Returns the bit of ``role`` in the role table."""
+        bit = self._roles.get(role.lower())
+        if bit is None:
+            return self._other_roles_bit
+        return 1 << bit
+
+    def is_allowed(self, rule_name, role):
+        """Checks whether ``role`` is allowed by ``rule_name``.
+
+        :returns: True or False, or None if ``rule_name`` is not a role-only
+            rule and must be evaluated by oslo.policy.
+        """
+        mask = self.masks.get(rule_name)
+        if mask is None or not isinstance(role, six.string_types):
+            return None
+        return bool(mask & self.role_bit(role))
+
+    def _intern_roles(self, check):
+        if isinstance(check, _checks.RoleCheck):
+            if '%' not in check.match:
+                self._roles.setdefault(check.match.lower(), len(self._roles))
+        elif isinstance(check, (_checks.AndCheck, _checks.OrCheck)):
+            for sub_check in check.rules:
+                self._intern_roles(sub_check)
+        elif isinstance(check, _checks.NotCheck):
+            self._intern_roles(check.rule)
+
+    def _compile_rule(self, name):
+        """Compiles the rule ``name``, as resolved by ``rule:name``.
+
+        :returns: The bitmask of the roles allowed by the rule, or None if
+            the rule is not a role-only rule.
+        """
+        if name in self._compiled:
+            return self._compiled[name]
+        if name in self._compiling:
+            # A rule referencing itself is not compiled, like rules with
+            # other kinds of checks.
+            return None
+
+        try:
+            check = self._rules[name]
+        except KeyError:
+            # Like oslo.policy, fail closed for undefined rules.
+            return 0
+
+        self._compiling.add(name)
+        try:
+            mask = self._compile(check)
+        finally:
+            self._compiling.discard(name)
+        self._compiled[name] = mask
+        # An undefined rule reached through ``rule:`` resolves to the default
+        # rule, which must not make it look defined.
+        if mask is not None and name in self._rules:
+            self.masks[name] = mask
+        return mask
+
+    def _compile(self, check):
+        if isinstance(check, _checks.TrueCheck):
+            return self._all_roles
+        elif isinstance(check, _checks.FalseCheck):
+            return 0
+        elif isinstance(check, _checks.RoleCheck):
+            if '%' in check.match:
+                # The role depends on the target.
+                return None
+            return self.role_bit(check.match)
+        elif isinstance(check, _checks.RuleCheck):
+            return self._compile_rule(check.match)
+        elif isinstance(check, _checks.NotCheck):
+            mask = self._compile(check.rule)
+            if mask is None:
+                return None
+            return self._all_roles & ~mask
+        elif isinstance(check, (_checks.AndCheck, _checks.OrCheck)):
+            is_and = isinstance(check, _checks.AndCheck)
+            result = self._all_roles if is_and else 0
+            for sub_check in check.rules:
+                mask = self._compile(sub_check)
+                if mask is None:
+                    return None
+                result = result & mask if is_and else result | mask
+            return result
+        return None
+
+
+class CheckGraph(object):
+    """Compiles policy rules into a graph of checks.
+
+    Evaluating a rule with oslo.policy resolves each ``rule:`` check by
+    looking up the referenced rule and evaluating it recursively, every
+    time. Here, every ``rule:`` check is instead replaced by a direct
+    reference to the compiled node of the rule it refers to, so the rules
+    form a directed acyclic graph in which referenced rules are shared
+    subexpressions. The result of each referenced rule is memoized for the
+    duration of one evaluation, so a rule referenced several times, like
+    ``context_is_admin``, is only evaluated once.
+
+    Circular references are detected when the graph is compiled; evaluating
+    a rule that is part of a cycle raises ``RbacParsingException`` instead
+    of exhausting the stack.
+    """
+
+    def __init__(self, rules):
+        self._rules = rules
+        self._nodes = {}
+        self._leaves = {}
+        self.circular_rules = self._find_circular_rules()
+        for name in rules:
+            self._get_rule_node(name)
+
+    def __contains__(self, rule_name):
+        return rule_name in self._nodes
+
+    def evaluate(self, rule_name, target, creds, enforcer):
+        """Evaluates ``rule_name`` like ``rules[rule_name](...)`` would.
+
+        :raises RbacParsingException: if the rule contains a circular
+            reference.
+        """
+        return self._nodes[rule_name].evaluate(target, creds, enforcer, {})
+
+    def _resolve(self, name):
+        """Returns the name of the rule that ``rule:name`` refers to.
+
+        Mirrors ``oslo_policy.policy.Rules``: undefined rules fall back to
+        the default rule, if there is one, or to None otherwise.
+        """
+        if name in self._rules:
+            return name
+        default_rule = getattr(self._rules, 'default_rule', None)
+        if isinstance(default_rule, six.string_types) and \
+                default_rule in self._rules:
+            return default_rule
+        return None
+
+    def _get_references(self, check):
+        if isinstance(check, _checks.RuleCheck):
+            name = self._resolve(check.match)
+            return [name] if name is not None else []
+        elif isinstance(check, (_checks.AndCheck, _checks.OrCheck)):
+            references = []
+            for sub_check in check.rules:
+                references.extend(self._get_references(sub_check))
+            return references
+        elif isinstance(check, _checks.NotCheck):
+            return self._get_references(check.rule)
+        return []
+
+    def _find_circular_rules(self):
+        """Returns a dictionary mapping each rule in a cycle to the cycle."""
+        references = dict((name, self._get_references(check))
+                          for name, check in self._rules.items())
+        circular_rules = {}
+        done = set()
+
+        def visit(name, path):
+            if name in done:
+                return
+            if name in path:
+                cycle = path[path.index(name):] + [name]
+                for rule_name in cycle:
+                    circular_rules.setdefault(rule_name, cycle)
+                return
+            path.append(name)
+            for reference in references.get(name, []):
+                visit(reference, path)
+            path.pop()
+            done.add(name)
+
+        for name in references:
+            visit(name, [])
+        return circular_rules
+
+    def _get_rule_node(self, name):
+        node = self._nodes.get(name)
+        if node is None:
+            if name in self.circular_rules:
+                node = _CircularRuleNode(name, self.circular_rules[name])
+                self._nodes[name] = node
+            else:
+                node = _RuleNode(name)
+                # Register the node before compiling its check, so that
+                # other references to the rule share it.
+                self._nodes[name] = node
+                node.node = self._compile(self._rules[name])
+        return node
+
+    def _compile(self, check):
+        if isinstance(check, _checks.RuleCheck):
+            name = self._resolve(check.match)
+            if name is None:
+                # Like oslo.policy, fail closed for undefined rules.
+                return self._get_leaf(_checks.FalseCheck())
+            return self._get_rule_node(name)
+        elif isinstance(check, _checks.AndCheck):
+            return _AndNode([self._compile(c) for c in check.rules])
+        elif isinstance(check, _checks.OrCheck):
+            return _OrNode([self._compile(c) for c in check.rules])
+        elif isinstance(check, _checks.NotCheck):
+            return _NotNode(self._compile(check.rule))
+        return self._get_leaf(check)
+
+    def _get_leaf(self, check):
+        # Identical checks, like role:admin, are shared between rules.
+        key = (type(check), str(check))
+        leaf = self._leaves.get(key)
+        if leaf is None:
+            leaf = self._leaves[key] = _LeafNode(check)
+        return leaf
+
+
+class _LeafNode(object):
+    __slots__ = ('check',)
+
+    def __init__(self, check):
+        self.check = check
+
+    def evaluate(self, target, creds, enforcer, memo):
+        return self.check(target, creds, enforcer)
+
+
+class _AndNode(object):
+    __slots__ = ('nodes',)
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def evaluate(self, target, creds, enforcer, memo):
+        for node in self.nodes:
+            if not node.evaluate(target, creds, enforcer, memo):
+                return False
+        return True
+
+
+class _OrNode(object):
+    __slots__ = ('nodes',)
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def evaluate(self, target, creds, enforcer, memo):
+        for node in self.nodes:
+            if node.evaluate(target, creds, enforcer, memo):
+                return True
+        return False
+
+
+class _NotNode(object):
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        self.node = node
+
+    def evaluate(self, target, creds, enforcer, memo):
+        return not self.node.evaluate(target, creds, enforcer, memo)
+
+
+class _RuleNode(object):
+    __slots__ = ('name', 'node')
+
+    def __init__(self, name):
+        self.name = name
+        self.node = None
+
+    def evaluate(self, target, creds, enforcer, memo):
+        try:
+            return memo[self.name]
+        except KeyError:
+            result = memo[self.name] = self.node.evaluate(
+                target, creds, enforcer, memo)
+            return result
+
+
+class _CircularRuleNode(object):
+    __slots__ = ('name', 'cycle')
+
+    def __init__(self, name, cycle):
+        self.name = name
+        self.cycle = cycle
+
+    def evaluate(self, target, creds, enforcer, memo):
+        message = "Policy action: {0} contains a circular reference: "\
+                  "{1}.".format(self.name, ' -> '.join(self.cycle))
+        raise rbac_exceptions.RbacParsingException(message)
@@ -13,23 +13,325 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import copy
+import hashlib
 import json
 import os
+import threading
 
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_policy import policy
+import pbr.version
+import pkg_resources
+import six
 import stevedore
 
 from tempest.common import credentials_factory as credentials
 
+from patrole_tempest_plugin import rbac_cache
 from patrole_tempest_plugin import rbac_exceptions
+from patrole_tempest_plugin import rbac_policy_compiler
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
 
+PermissionMatrix = collections.namedtuple(
+    'PermissionMatrix', ['roles', 'actions', 'allowed'])
+
+
+class CompiledPolicy(object):
+    """The compiled policy of a service, shared by all parsers.
+
+    :param rules: The ``oslo_policy.policy.Rules`` of the service.
+    :param fingerprint: Hashable value identifying the policy sources the
+        rules were compiled from.
+    """
+
+    def __init__(self, rules, fingerprint):
+        self.rules = rules
+        self.fingerprint = fingerprint
+        self._role_masks = None
+        self._check_graph = None
+        # Admin context of each role, keyed by role and target, bounded like
+        # the policy decisions.
+        self.admin_contexts = DecisionCache()
+
+    @property
+    def role_masks(self):
+        """The ``RoleMasks`` of the role-only rules, compiled on demand."""
+        if self._role_masks is None:
+            self._role_masks = rbac_policy_compiler.RoleMasks(self.rules)
+        return self._role_masks
+
+    @property
+    def check_graph(self):
+        """The ``CheckGraph`` of the rules, compiled on demand."""
+        if self._check_graph is None:
+            check_graph = rbac_policy_compiler.CheckGraph(self.rules)
+            if check_graph.circular_rules:
+                LOG.warning("Policy actions with circular references: %s",
+                            ', '.join(sorted(check_graph.circular_rules)))
+            self._check_graph = check_graph
+        return self._check_graph
+
+
+class DecisionCache(object):
+    """A bounded LRU cache of policy decisions.
+
+    Memoizes the outcome of ``RbacPolicyParser.allowed`` for rules that
+    must be evaluated by oslo.policy. Decisions are keyed by the service,
+    the fingerprint of its compiled policy, the rule, the role, the target
+    and the admin context, so a refreshed policy never reuses stale
+    decisions. The size limit is ``CONF.rbac.policy_decision_cache_size``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._decisions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached decision for ``key``, or None."""
+        with self._lock:
+            decision = self._decisions.pop(key, None)
+            if decision is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # Mark the decision as the most recently used one.
+                self._decisions[key] = decision
+            return decision
+
+    def set(self, key, decision):
+        max_size = CONF.rbac.policy_decision_cache_size
+        with self._lock:
+            self._decisions.pop(key, None)
+            self._decisions[key] = decision
+            while len(self._decisions) > max_size:
+                self._decisions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._decisions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._decisions)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+class PolicyCache(object):
+    """A process-wide registry of compiled policy rules.
+
+    Parsing a policy means reading the policy file, loading the in-code
+    defaults registered under ``oslo.policy.policies`` and building the
+    ``oslo_policy.policy.Rules`` for the result. Since the outcome only
+    depends on those inputs, it is computed once per process and shared by
+    every ``RbacPolicyParser`` instance.
+
+    Compiled rules are keyed by the service, the resolved policy file path,
+    the policy file's modification time and size and the version of the
+    in-code policy defaults. A policy file that changes on disk therefore
+    results in a cache miss and is reparsed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._policies = {}
+        self._code_policies = {}
+        self._code_versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            compiled_policy = self._policies.get(key)
+            if compiled_policy is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return compiled_policy
+
+    def set(self, key, compiled_policy):
+        with self._lock:
+            # Only the latest version of a given policy file is kept: stale
+            # entries for the same service and path are evicted.
+            stale_keys = [k for k in self._policies if k[:2] == key[:2]]
+            for stale_key in stale_keys:
+                del self._policies[stale_key]
+            self._policies[key] = compiled_policy
+        if stale_keys:
+            _decision_cache.clear()
+
+    def get_code_policy(self, service):
+        with self._lock:
+            return self._code_policies.get(service)
+
+    def set_code_policy(self, service, code_policy):
+        with self._lock:
+            self._code_policies[service] = code_policy
+
+    def get_code_version(self, service):
+        with self._lock:
+            return self._code_versions.get(service)
+
+    def set_code_version(self, service, code_version):
+        with self._lock:
+            self._code_versions[service] = code_version
+
+    def invalidate(self, service=None):
+        """Drops cached policies for ``service`` or for every service."""
+        with self._lock:
+            if service is None:
+                self._policies.clear()
+                self._code_policies.clear()
+                self._code_versions.clear()
+            else:
+                for key in [k for k in self._policies if k[0] == service]:
+                    del self._policies[key]
+                self._code_policies.pop(service, None)
+                self._code_versions.pop(service, None)
+        _decision_cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._policies)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+_policy_cache = PolicyCache()
+_decision_cache = DecisionCache()
+_oslo_policy_version = None
+
+
+def invalidate_policy_cache(service=None):
+    """Invalidates the compiled policy cache.
+
+    Cached policy decisions are invalidated along with it.
+
+    :param service: The service whose compiled policy is invalidated. If
+        None, the compiled policies for all services are invalidated.
+    """
+    _policy_cache.invalidate(service)
+
+
+def get_policy_cache_stats():
+    """Returns the hit and miss counters of the compiled policy cache."""
+    return _policy_cache.stats()
+
+
+def get_decision_cache_stats():
+    """Returns the hit and miss counters of the policy decision cache."""
+    return _decision_cache.stats()
+
+
+def _get_oslo_policy_version():
+    global _oslo_policy_version
+    if _oslo_policy_version is None:
+        _oslo_policy_version = pbr.version.VersionInfo(
+            'oslo.policy').version_string()
+    return _oslo_policy_version
+
+
+def get_code_policy_version(service):
+    """Returns the version of the in-code policy defaults of ``service``.
+
+    If ``CONF.rbac.policy_snapshot_file`` is set, the version identifies the
+    snapshot file by its path, modification time and size. Otherwise, it
+    lists the packages registering the policy defaults of ``service`` under
+    the ``oslo.policy.policies`` namespace, with their versions. Unlike
+    ``load_code_policy``, the service's code is never imported.
+    """
+    snapshot_file = CONF.rbac.policy_snapshot_file
+    if snapshot_file:
+        try:
+            stat = os.stat(snapshot_file)
+            file_version = (stat.st_mtime, stat.st_size)
+        except OSError:
+            file_version = (None, None)
+        return 'snapshot:%s:%s:%s' % (
+            (os.path.realpath(snapshot_file),) + file_version)
+
+    code_version = _policy_cache.get_code_version(service)
+    if code_version is None:
+        entry_points = []
+        for entry_point in pkg_resources.iter_entry_points(
+                'oslo.policy.policies', service):
+            dist = entry_point.dist
+            entry_points.append('%s=%s:%s' % (
+                getattr(dist, 'project_name', None),
+                getattr(dist, 'version', None), entry_point.module_name))
+        code_version = 'code:' + ','.join(sorted(entry_points))
+        _policy_cache.set_code_version(service, code_version)
+    return code_version
+
+
+def load_code_policy(service):
+    """Loads the in-code policy defaults of ``service``.
+
+    The policy defaults are retrieved from the ``oslo.policy.policies``
+    namespace, which requires importing the service's code.
+
+    :param service: The service whose policy defaults are loaded.
+    :returns: dictionary mapping policy actions to rules; empty if the
+        service does not register any policy defaults in code.
+    """
+    mgr_policy_data = {}
+
+    # Check whether policy actions are defined in code. Nova and Keystone,
+    # for example, define their default policy actions in code.
+    mgr = stevedore.named.NamedExtensionManager(
+        'oslo.policy.policies',
+        names=[service],
+        on_load_failure_callback=None,
+        invoke_on_load=True,
+        warn_on_missing_entrypoint=False)
+
+    if mgr:
+        policy_generator = {policy.name: policy.obj for policy in mgr}
+        if policy_generator and service in policy_generator:
+            for rule in policy_generator[service]:
+                mgr_policy_data[rule.name] = str(rule.check)
+
+    return mgr_policy_data
+
+
+def load_policy_snapshot(snapshot_file):
+    """Loads a snapshot of in-code policy defaults.
+
+    The snapshot is generated by ``patrole-policy-snapshot`` and maps each
+    service to the dictionary returned by ``load_code_policy``.
+
+    :param snapshot_file: Path to the snapshot file.
+    :raises RbacParsingException: if the snapshot cannot be read.
+    """
+    try:
+        with open(snapshot_file, 'r') as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError) as e:
+        error_message = 'Failed to read policy snapshot file {0}: {1}'.format(
+            snapshot_file, e)
+        raise rbac_exceptions.RbacParsingException(error_message)
+
+    if not isinstance(snapshot, dict):
+        error_message = 'Policy snapshot file {0} is invalid.'.format(
+            snapshot_file)
+        raise rbac_exceptions.RbacParsingException(error_message)
+    return snapshot
+
+
 class RbacPolicyParser(object):
     """A class for parsing policy rules into lists of allowed roles.
 
@@ -40,7 +342,11 @@ class RbacPolicyParser(object):
     each role, whether a given rule is allowed using oslo policy.
     """
 
-    def __init__(self, project_id, user_id, service, extra_target_data=None):
+    # Admin identity services client registered by ``set_services_client``.
+    _services_client = None
+
+    def __init__(self, project_id, user_id, service, extra_target_data=None,
+                 check_service=True):
         """Initialization of Rbac Policy Parser.
 
         Parses a policy file to create a dictionary, mapping policy actions to
@@ -61,13 +367,16 @@ class RbacPolicyParser(object):
         :param user_id: type uuid
         :param service: type string
         :param path: type string
+        :param check_service: whether to check that ``service`` is in the
+            service catalog before loading its policy
         """
 
         if extra_target_data is None:
             extra_target_data = {}
 
         # First check if the service is valid.
-        self.validate_service(service)
+        if check_service:
+            self.validate_service(service)
 
         # Use default path in /etc/<service_name/policy.json if no path
         # is provided.
@@ -77,8 +386,9 @@ class RbacPolicyParser(object):
                      " using default path", str(service))
             path = os.path.join('/etc', service, 'policy.json')
         self.path = path
-        self.rules = policy.Rules.load(self._get_policy_data(service),
-                                       'default')
+        self.service = service
+        self._compiled_policy = self._get_compiled_policy(service)
+        self.rules = self._compiled_policy.rules
         self.project_id = project_id
         self.user_id = user_id
         self.extra_target_data = extra_target_data
@@ -91,27 +401,254 @@ class RbacPolicyParser(object):
         # Cache the list of available services in memory to avoid needlessly
         # doing an API call every time.
         if not hasattr(cls, 'available_services'):
-            admin_mgr = credentials.AdminManager()
-            services = admin_mgr.identity_services_v3_client.\
-                list_services()['services']
-            cls.available_services = [s['name'] for s in services]
+            cls.available_services = cls._get_available_services()
 
         if not service or service not in cls.available_services:
             LOG.debug("%s is NOT a valid service.", service)
             raise rbac_exceptions.RbacInvalidService(
                 "%s is NOT a valid service." % service)
 
+    @classmethod
+    def set_services_client(cls, services_client):
+        """Registers the identity client used to list available services.
+
+        Registering an already authenticated admin identity services client
+        avoids building a ``credentials.AdminManager`` just to validate
+        services.
+        """
+        cls._services_client = services_client
+
+    @classmethod
+    def unset_services_client(cls, services_client):
+        """Unregisters ``services_client``, if it is still registered."""
+        if cls._services_client is services_client:
+            cls._services_client = None
+
+    @classmethod
+    def _get_available_services(cls):
+        """Returns the names of the services in the service catalog.
+
+        If ``CONF.rbac.cache_dir`` is set, the service names are shared with
+        other processes for ``CONF.rbac.service_catalog_cache_ttl`` seconds.
+        """
+        cache_enabled = rbac_cache.is_enabled()
+        if cache_enabled:
+            available_services = rbac_cache.load_json(
+                'services.json', ttl=CONF.rbac.service_catalog_cache_ttl)
+            if available_services is not None:
+                return available_services
+
+        services_client = cls._services_client
+        if services_client is None:
+            admin_mgr = credentials.AdminManager()
+            services_client = admin_mgr.identity_services_v3_client
+        services = services_client.list_services()['services']
+        available_services = [s['name'] for s in services]
+
+        if cache_enabled:
+            rbac_cache.store_json('services.json', available_services)
+        return available_services
+
     def allowed(self, rule_name, role):
+        # Role-only rules are answered from their precompiled role bitmasks.
+        role_masks = self._get_role_masks()
+        if role_masks is not None:
+            is_allowed = role_masks.is_allowed(rule_name, role)
+            if is_allowed is not None:
+                return is_allowed
+
         is_admin_context = self._is_admin_context(role)
+        decision_key = self._get_decision_key(rule_name, role,
+                                              is_admin_context)
+        if decision_key is not None:
+            is_allowed = _decision_cache.get(decision_key)
+            if is_allowed is not None:
+                return is_allowed
+
         is_allowed = self._allowed(
             access=self._get_access_token(role),
             apply_rule=rule_name,
             is_admin=is_admin_context)
+        if decision_key is not None:
+            _decision_cache.set(decision_key, bool(is_allowed))
         return is_allowed
 
+    def _get_decision_key(self, rule_name, role, is_admin):
+        """Returns the key of a decision in the decision cache.
+
+        Returns None if decisions must not be cached: if the cache is
+        disabled, if ``self.rules`` was replaced or if the target is not
+        hashable.
+        """
+        if CONF.rbac.policy_decision_cache_size <= 0:
+            return None
+        target_key = self._get_target_key()
+        if target_key is None:
+            return None
+        return (self.service, self._compiled_policy.fingerprint,
+                rule_name, role, target_key, is_admin)
+
+    def _get_target_key(self):
+        """Returns a hashable key of the target of policy checks.
+
+        Returns None if ``self.rules`` was replaced, as results computed
+        from the replaced rules must not be stored in the compiled policy,
+        or if the target is not hashable.
+        """
+        if self.rules is not self._compiled_policy.rules:
+            return None
+        target = {"project_id": self.project_id,
+                  "user_id": self.user_id}
+        target.update(self.extra_target_data or {})
+        try:
+            target_key = frozenset(target.items())
+            hash(target_key)
+        except TypeError:
+            return None
+        return target_key
+
+    def permission_matrix(self, roles, actions=None):
+        """Evaluates every policy action for every role in a single pass.
+
+        Equivalent to calling ``allowed`` for every combination of role and
+        action, but the credentials and admin context of each role and the
+        target are only computed once.
+
+        :param roles: list of roles to evaluate.
+        :param actions: list of policy actions to evaluate. If None, every
+            policy action of the service is evaluated.
+        :returns: ``PermissionMatrix`` whose ``allowed`` attribute holds one
+            tuple per action, with one boolean per role.
+        :raises RbacParsingException: if an action is not in the policy.
+        """
+        roles = list(roles)
+        if actions is None:
+            actions = sorted(self.rules)
+        else:
+            actions = list(actions)
+            for action in actions:
+                if action not in self.rules:
+                    message = "Policy action: {0} not found in policy "\
+                              "file: {1}.".format(action, self.path)
+                    LOG.debug(message)
+                    raise rbac_exceptions.RbacParsingException(message)
+
+        role_masks = self._get_role_masks()
+        all_access_data = None
+        target = enforcer = None
+
+        allowed = []
+        for action in actions:
+            mask = role_masks.masks.get(action) if role_masks else None
+            if mask is not None:
+                allowed.append(tuple(bool(mask & role_masks.role_bit(role))
+                                     for role in roles))
+                continue
+
+            # Only build the credentials if some rule needs oslo.policy.
+            if all_access_data is None:
+                all_access_data = [
+                    self._get_access_data(self._get_access_token(role),
+                                          self._is_admin_context(role))
+                    for role in roles]
+                target = self._get_target(all_access_data[0]) if roles \
+                    else {}
+                enforcer = self._get_enforcer()
+            allowed.append(tuple(
+                bool(self._try_rule(action, target, access_data, enforcer))
+                for access_data in all_access_data))
+
+        return PermissionMatrix(tuple(roles), tuple(actions), allowed)
+
+    def _get_compiled_policy(self, service):
+        """Returns the ``CompiledPolicy`` for ``service``.
+
+        The policy is retrieved from the process-wide policy cache if the
+        policy sources did not change since they were last parsed. Only the
+        metadata of the policy sources is read to check that, so that the
+        in-code policy defaults are only loaded on a cache miss.
+        """
+        try:
+            stat = os.stat(self.path)
+            file_version = (stat.st_mtime, stat.st_size)
+        except OSError:
+            file_version = (None, None)
+
+        cache_key = (service, os.path.realpath(self.path)) + file_version + \
+            (get_code_policy_version(service),)
+        compiled_policy = _policy_cache.get(cache_key)
+        if compiled_policy is None:
+            compiled_policy = CompiledPolicy(
+                self._load_rules(service, cache_key), cache_key)
+            _policy_cache.set(cache_key, compiled_policy)
+        return compiled_policy
+
+    def _load_rules(self, service, cache_key):
+        """Parses the rules of ``service``.
+
+        If ``CONF.rbac.cache_dir`` is set, the merged policy data is shared
+        with other processes through an on-disk JSON cache, keyed by a hash
+        of ``cache_key`` and of the oslo.policy version. Invalid entries are
+        rebuilt.
+        """
+        entry_name = None
+        if rbac_cache.is_enabled():
+            entry_name = self._get_cache_entry_name(service, cache_key)
+            policy_data = rbac_cache.load_json(entry_name)
+            if policy_data is not None:
+                if self._is_valid_policy_data(policy_data):
+                    return policy.Rules.from_dict(policy_data, 'default')
+                LOG.warning("Rebuilding invalid cached policy for service "
+                            "%s.", service)
+                rbac_cache.delete(entry_name)
+
+        policy_data = self._get_policy_data(service)
+        if entry_name:
+            rbac_cache.store_json(entry_name, policy_data)
+        return policy.Rules.from_dict(policy_data, 'default')
+
+    def _get_cache_entry_name(self, service, cache_key):
+        """Returns the name of the on-disk cache entry of the policy."""
+        digest = hashlib.sha256()
+        for source in cache_key + (_get_oslo_policy_version(),):
+            digest.update(str(source).encode('utf-8') + b'\0')
+        return 'policy-%s-%s.json' % (service, digest.hexdigest())
+
+    @staticmethod
+    def _is_valid_policy_data(policy_data):
+        """Checks that each rule of ``policy_data`` is a policy string.
+
+        Lists are accepted as well, for the legacy syntax.
+        """
+        return isinstance(policy_data, dict) and all(
+            isinstance(rule, (six.string_types, list))
+            for rule in policy_data.values())
+
+    def _get_code_policy_data(self, service):
+        """Returns the in-code policy defaults of ``service``.
+
+        The policy defaults are only loaded once per process, as they cannot
+        change without restarting it. If ``CONF.rbac.policy_snapshot_file``
+        is set, the policy defaults are read from that snapshot instead, so
+        that the service's code is never imported.
+
+        :returns: dictionary mapping policy actions to rules.
+        """
+        code_policy = _policy_cache.get_code_policy(service)
+        if code_policy is not None:
+            return code_policy
+
+        snapshot_file = CONF.rbac.policy_snapshot_file
+        if snapshot_file:
+            code_policy = load_policy_snapshot(snapshot_file).get(service, {})
+        else:
+            code_policy = load_code_policy(service)
+
+        _policy_cache.set_code_policy(service, code_policy)
+        return code_policy
+
     def _get_policy_data(self, service):
         file_policy_data = {}
-        mgr_policy_data = {}
         policy_data = {}
 
         # Check whether policy file exists.
@@ -129,20 +666,7 @@ class RbacPolicyParser(object):
                 LOG.debug(msg)
                 file_policy_data = {}
 
-        # Check whether policy actions are defined in code. Nova and Keystone,
-        # for example, define their default policy actions in code.
-        mgr = stevedore.named.NamedExtensionManager(
-            'oslo.policy.policies',
-            names=[service],
-            on_load_failure_callback=None,
-            invoke_on_load=True,
-            warn_on_missing_entrypoint=False)
-
-        if mgr:
-            policy_generator = {policy.name: policy.obj for policy in mgr}
-            if policy_generator and service in policy_generator:
-                for rule in policy_generator[service]:
-                    mgr_policy_data[rule.name] = str(rule.check)
+        mgr_policy_data = self._get_code_policy_data(service)
 
         # If data from both file and code exist, combine both together.
         if file_policy_data and mgr_policy_data:
@@ -161,9 +685,9 @@ class RbacPolicyParser(object):
                             'code nor at {1}.'.format(service, self.path)
             raise rbac_exceptions.RbacParsingException(error_message)
 
-        try:
-            policy_data = json.dumps(policy_data)
-        except ValueError:
+        # The rules are parsed straight from the dictionary, so validate that
+        # each of them is a policy string.
+        if not self._is_valid_policy_data(policy_data):
             error_message = 'Policy file for {0} service is invalid.'.format(
                 service)
             raise rbac_exceptions.RbacParsingException(error_message)
@@ -176,12 +700,34 @@ class RbacPolicyParser(object):
         If context_is_admin is contained in the policy file, then checks
         whether the given role is contained in context_is_admin. If it is not
         in the policy file, then default to context_is_admin: admin.
+
+        The admin context of a role is only evaluated once per compiled
+        policy and target.
         """
-        if 'context_is_admin' in self.rules.keys():
-            return self._allowed(
+        if 'context_is_admin' not in self.rules:
+            return role == CONF.identity.admin_role
+
+        target_key = self._get_target_key()
+        admin_context_key = (role, target_key)
+        if target_key is not None:
+            is_admin = self._compiled_policy.admin_contexts.get(
+                admin_context_key)
+            if is_admin is not None:
+                return is_admin
+
+        role_masks = self._get_role_masks()
+        is_admin = None
+        if role_masks is not None:
+            is_admin = role_masks.is_allowed('context_is_admin', role)
+        if is_admin is None:
+            is_admin = bool(self._allowed(
                 access=self._get_access_token(role),
-                apply_rule='context_is_admin')
-        return role == CONF.identity.admin_role
+                apply_rule='context_is_admin'))
+
+        if target_key is not None:
+            self._compiled_policy.admin_contexts.set(admin_context_key,
+                                                     is_admin)
+        return is_admin
 
     def _get_access_token(self, role):
         access_token = {
@@ -207,6 +753,23 @@ class RbacPolicyParser(object):
         :param apply_rule: type string: rule to be checked
         :param is_admin: type bool: whether admin context is used
         """
+        access_data = self._get_access_data(access, is_admin)
+        target = self._get_target(access_data)
+        return self._try_rule(apply_rule, target, access_data,
+                              self._get_enforcer())
+
+    def _get_role_masks(self):
+        """Returns the role bitmasks of the policy, if they apply.
+
+        The bitmasks are compiled from the cached policy rules, so they do
+        not apply if ``self.rules`` was replaced.
+        """
+        if self.rules is not self._compiled_policy.rules:
+            return None
+        return self._compiled_policy.role_masks
+
+    def _get_access_data(self, access, is_admin=False):
+        """Converts an access token into oslo.policy credentials."""
         access_data = copy.copy(access['token'])
         access_data['roles'] = [role['name'] for role in access_data['roles']]
         access_data['is_admin'] = is_admin
@@ -216,21 +779,24 @@ class RbacPolicyParser(object):
         # _populate_is_admin_project in keystone.token.providers.common
         # for more information.
         access_data['is_admin_project'] = True
+        return access_data
 
-        class Object(object):
-            pass
-        o = Object()
-        o.rules = self.rules
-
+    def _get_target(self, access_data):
         target = {"project_id": access_data['project_id'],
                   "tenant_id": access_data['project_id'],
                   "network:tenant_id": access_data['project_id'],
                   "user_id": access_data['user_id']}
         if self.extra_target_data:
             target.update(self.extra_target_data)
+        return target
 
-        result = self._try_rule(apply_rule, target, access_data, o)
-        return result
+    def _get_enforcer(self):
+        """Returns the minimal enforcer needed to resolve rule: checks."""
+        class Object(object):
+            pass
+        o = Object()
+        o.rules = self.rules
+        return o
 
     def _try_rule(self, apply_rule, target, access_data, o):
         if apply_rule not in self.rules:
@@ -238,6 +804,9 @@ class RbacPolicyParser(object):
                       .format(apply_rule, self.path)
             LOG.debug(message)
             raise rbac_exceptions.RbacParsingException(message)
+        elif self.rules is self._compiled_policy.rules:
+            return self._compiled_policy.check_graph.evaluate(
+                apply_rule, target, access_data, o)
         else:
             rule = self.rules[apply_rule]
             return rule(target, access_data, o)
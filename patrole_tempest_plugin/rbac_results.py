@@ -0,0 +1,171 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Results of RBAC tests per role, and their reuse by later runs.
+
+The result of each RBAC test for each role, along with whether the role was
+expected to be allowed, is written to ``CONF.rbac.results_file`` when the
+process exits. A later run can use these results as a baseline: a test whose
+expected outcome for a new role is the same as for
+``CONF.rbac.baseline_role``, which passed under the same expected outcome,
+is not run again and is reported as inherited.
+"""
+
+import atexit
+import copy
+import glob
+import json
+import os
+import threading
+
+from oslo_log import log as logging
+
+from tempest import config
+
+CONF = config.CONF
+LOG = logging.getLogger(__name__)
+
+
+class ResultRecorder(object):
+    """Records the result of RBAC tests per test and role."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def record(self, test_id, role, result, allowed=None):
+        """Records the result of a test run with ``role``.
+
+        :param result: one of ``pass``, ``fail``, ``skip`` or ``inherited``.
+        :param allowed: whether ``role`` was expected to be allowed to
+            perform the policy action of the test, if known.
+        """
+        with self._lock:
+            self._results.setdefault(test_id, {})[role] = {
+                'result': result, 'allowed': allowed}
+
+    def get_results(self):
+        with self._lock:
+            return copy.deepcopy(self._results)
+
+    def reset(self):
+        with self._lock:
+            self._results.clear()
+
+    def write_results(self, path):
+        """Writes the results of the process to ``path`` as JSON."""
+        results = {'pid': os.getpid(), 'results': self.get_results()}
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=4, sort_keys=True)
+
+
+recorder = ResultRecorder()
+
+_baseline = None
+_baseline_lock = threading.Lock()
+
+
+def get_results_path():
+    """Returns the path of the results file of this process, if any.
+
+    The process ID is appended to ``CONF.rbac.results_file``, so that the
+    workers of a test run do not overwrite each other's results.
+    """
+    if not CONF.rbac.results_file:
+        return None
+    return '%s.%d' % (CONF.rbac.results_file, os.getpid())
+
+
+def load_results(pattern):
+    """Merges the results of the results files matching ``pattern``."""
+    results = {}
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as results_file:
+            for test_id, roles in json.load(
+                    results_file)['results'].items():
+                results.setdefault(test_id, {}).update(roles)
+    return results
+
+
+def get_baseline():
+    """Returns the results of ``CONF.rbac.baseline_results``.
+
+    The results are loaded once per process.
+    """
+    global _baseline
+
+    with _baseline_lock:
+        if _baseline is None:
+            _baseline = load_results(CONF.rbac.baseline_results)
+            if not _baseline:
+                LOG.warning("No baseline results found in %s",
+                            CONF.rbac.baseline_results)
+        return _baseline
+
+
+def reset_baseline():
+    global _baseline
+
+    with _baseline_lock:
+        _baseline = None
+
+
+def is_baseline_enabled(role):
+    """Checks whether outcomes for ``role`` may be inherited."""
+    if not CONF.rbac.baseline_role or not CONF.rbac.baseline_results:
+        return False
+    return role != CONF.rbac.baseline_role
+
+
+def is_inherited(test_id, role, allowed, baseline_allowed):
+    """Checks whether the outcome of a test can be inherited.
+
+    The outcome is inherited if the test passed with
+    ``CONF.rbac.baseline_role`` in the baseline run, and ``role`` is expected
+    to be allowed to perform its policy action exactly when
+    ``CONF.rbac.baseline_role`` is. The expected outcome of the baseline run
+    must also be ``baseline_allowed``, the expected outcome for
+    ``CONF.rbac.baseline_role`` under the current policy, otherwise the
+    policy changed since the baseline run.
+
+    :param test_id: ID of the test, as recorded by the baseline run.
+    :param allowed: whether ``role`` is expected to be allowed.
+    :param baseline_allowed: whether ``CONF.rbac.baseline_role`` is expected
+        to be allowed under the current policy.
+    """
+    if not is_baseline_enabled(role):
+        return False
+    baseline_result = get_baseline().get(test_id, {}).get(
+        CONF.rbac.baseline_role)
+    if not baseline_result or baseline_result['result'] != 'pass':
+        return False
+    if baseline_result['allowed'] != baseline_allowed:
+        return False
+    return allowed == baseline_allowed
+
+
+@atexit.register
+def _write_results():
+    try:
+        path = get_results_path()
+    except Exception:
+        # The configuration may already be unusable at exit.
+        return
+    if path is None or not recorder.get_results():
+        return
+    try:
+        recorder.write_results(path)
+    except (IOError, OSError) as e:
+        LOG.warning("Failed to write the RBAC results %s: %s", path, e)
@@ -13,11 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import logging
 import sys
 import testtools
 
 import six
+from testtools import content
 
 from tempest import config
 from tempest.lib import exceptions
@@ -25,12 +27,109 @@ from tempest import test
 
 from patrole_tempest_plugin import rbac_exceptions
 from patrole_tempest_plugin import rbac_policy_parser
+from patrole_tempest_plugin import rbac_results
+from patrole_tempest_plugin import rbac_timings
 
 CONF = config.CONF
 LOG = logging.getLogger(__name__)
 
 _SUPPORTED_ERROR_CODES = [403, 404]
 
+# The arguments of an ``action`` decorator, recorded on the decorated test
+# as ``rbac_action`` so that tools can inspect RBAC tests without running
+# them.
+RbacAction = collections.namedtuple(
+    'RbacAction', ['service', 'rule', 'admin_only', 'expected_error_code',
+                   'extra_target_data'])
+
+# Validation plans of the decorated test functions, by plan ID.
+_validation_plans = {}
+
+
+class ValidationPlan(object):
+    """What the ``action`` decorator resolves about a test when decorating it.
+
+    The expected exception is resolved when the test module is imported, so
+    that an unsupported ``expected_error_code`` fails test collection rather
+    than every run of the test.
+
+    :param plan_id: the module, name and first line of the decorated
+        function, which are unique even on Python 2. A function inherited by
+        several test classes has a single plan.
+    :param rbac_action: the ``RbacAction`` of the decorated test.
+    :raises RbacInvalidErrorCode: if ``expected_error_code`` is unsupported.
+    """
+
+    def __init__(self, plan_id, rbac_action):
+        self.plan_id = plan_id
+        self.rbac_action = rbac_action
+        self.expected_exception, self.irregular_msg = _get_exception_type(
+            rbac_action.expected_error_code)
+
+    def is_runnable(self):
+        """Checks whether the policy action of the test can be evaluated.
+
+        Admin-only tests are always runnable. Other tests are runnable if
+        the policy of their service defines their policy action. The policy
+        is compiled once per process and shared with the policy checks of
+        the tests. The service is not looked up in the service catalog, as
+        no identity client is available before the class credentials are
+        set up; a test whose service is not deployed fails when it runs.
+        """
+        if self.rbac_action.admin_only:
+            return True
+        try:
+            policy_parser = rbac_policy_parser.RbacPolicyParser(
+                None, None, self.rbac_action.service, check_service=False)
+        except rbac_exceptions.RbacParsingException as e:
+            LOG.debug("%s cannot be evaluated: %s", self.plan_id, e)
+            return False
+        return self.rbac_action.rule in policy_parser.rules
+
+
+def get_validation_plan(plan_id):
+    """Returns the ``ValidationPlan`` of a decorated function, if any."""
+    return _validation_plans.get(plan_id)
+
+
+def get_class_validation_plans(test_class):
+    """Returns the ``ValidationPlan`` of each RBAC test of ``test_class``."""
+    validation_plans = []
+    for name in sorted(dir(test_class)):
+        if not name.startswith('test'):
+            continue
+        validation_plan = getattr(getattr(test_class, name), 'rbac_plan',
+                                  None)
+        if validation_plan is not None:
+            validation_plans.append(validation_plan)
+    return validation_plans
+
+
+def skip_unless_runnable(test_class):
+    """Skips ``test_class`` if none of its RBAC tests can be evaluated.
+
+    Meant to be called from ``skip_checks``, so that a class whose policy
+    actions are all missing from the policy is skipped before its resources
+    are created, instead of skipping each of its tests afterwards. Does
+    nothing if ``CONF.rbac.strict_policy_check`` is True, as the tests must
+    then fail, or if ``CONF.rbac.validate_policy_before_setup`` is False.
+
+    :raises skipException: if none of the RBAC tests of the class can be
+        evaluated against the loaded policy.
+    """
+    if CONF.rbac.strict_policy_check:
+        return
+    if not CONF.rbac.validate_policy_before_setup:
+        return
+
+    validation_plans = get_class_validation_plans(test_class)
+    if validation_plans and not any(
+            validation_plan.is_runnable()
+            for validation_plan in validation_plans):
+        raise test_class.skipException(
+            "%s skipped as none of its policy actions can be evaluated "
+            "against the policy" % test_class.__name__)
+
 
 def action(service, rule='', admin_only=False, expected_error_code=403,
            extra_target_data=None):
@@ -57,6 +156,8 @@ def action(service, rule='', admin_only=False, expected_error_code=403,
         Support for 404 is needed because some services, like Neutron,
         intentionally throw a 404 for security reasons.
 
+    :raises RbacInvalidErrorCode: when decorating, if `expected_error_code`
+        is not supported.
     :raises NotFound: if `service` is invalid or
                       if Tempest credentials cannot be found.
     :raises Forbidden: for bullet (2) above.
@@ -67,28 +168,46 @@ def action(service, rule='', admin_only=False, expected_error_code=403,
         extra_target_data = {}
 
     def decorator(func):
-        role = CONF.rbac.rbac_test_role
-
-        def wrapper(*args, **kwargs):
-            if args and isinstance(args[0], test.BaseTestCase):
-                test_obj = args[0]
-            else:
-                raise rbac_exceptions.RbacResourceSetupFailed(
-                    '`rbac_rule_validation` decorator can only be applied to '
-                    'an instance of `tempest.test.BaseTestCase`.')
-
+        roles = CONF.rbac.rbac_test_roles or [CONF.rbac.rbac_test_role]
+        plan_id = _get_plan_id(func)
+        validation_plan = ValidationPlan(
+            plan_id, RbacAction(service, rule, admin_only,
+                                expected_error_code, extra_target_data))
+        _validation_plans[plan_id] = validation_plan
+
+        def run_as(test_obj, role, timing_detail, *args, **kwargs):
+            test_id = _get_test_id(test_obj)
             if admin_only:
                 LOG.info("As admin_only is True, only admin role should be "
                          "allowed to perform the API. Skipping oslo.policy "
                          "check for policy action {0}.".format(rule))
                 allowed = test_obj.rbac_utils.is_admin
             else:
-                allowed = _is_authorized(test_obj, service, rule,
-                                         extra_target_data)
-
-            expected_exception, irregular_msg = _get_exception_type(
-                expected_error_code)
-
+                try:
+                    allowed = _is_authorized(test_obj, service, rule,
+                                             extra_target_data, role=role)
+                except testtools.TestCase.skipException:
+                    rbac_results.recorder.record(test_id, role, 'skip')
+                    raise
+
+            if _is_inherited(test_obj, test_id, role, bool(allowed),
+                             validation_plan.rbac_action):
+                rbac_results.recorder.record(test_id, role, 'inherited',
+                                             bool(allowed))
+                raise testtools.TestCase.skipException(
+                    "Outcome for role %s inherited from baseline role %s" %
+                    (role, CONF.rbac.baseline_role))
+
+            expected_exception = validation_plan.expected_exception
+            irregular_msg = validation_plan.irregular_msg
+
+            if CONF.rbac.async_role_restore:
+                # Runs after the cleanups registered by the test, while the
+                # admin role is restored in the background.
+                test_obj.addCleanup(test_obj.rbac_utils.wait_for_switch_role)
+
+            result = 'fail'
+            rbac_timings.collector.start_capture()
             try:
                 func(*args, **kwargs)
             except rbac_exceptions.RbacInvalidService as e:
@@ -105,6 +224,7 @@ def action(service, rule='', admin_only=False, expected_error_code=403,
                     LOG.error(msg)
                     raise exceptions.Forbidden(
                         "%s Exception was: %s" % (msg, e))
+                result = 'pass'
             except Exception as e:
                 exc_info = sys.exc_info()
                 error_details = exc_info[1].__str__()
@@ -120,16 +240,141 @@ def action(service, rule='', admin_only=False, expected_error_code=403,
                     raise rbac_exceptions.RbacOverPermission(
                         "OverPermission: Role %s was allowed to perform %s" %
                         (role, rule))
+                result = 'pass'
             finally:
-                test_obj.rbac_utils.switch_role(test_obj,
-                                                toggle_rbac_role=False)
+                rbac_results.recorder.record(test_id, role, result,
+                                             bool(allowed))
+                try:
+                    if CONF.rbac.async_role_restore:
+                        test_obj.rbac_utils.start_switch_role(
+                            test_obj, toggle_rbac_role=False)
+                    else:
+                        test_obj.rbac_utils.switch_role(
+                            test_obj, toggle_rbac_role=False)
+                finally:
+                    _add_timing_details(test_obj, timing_detail)
+
+        def wrapper(*args, **kwargs):
+            if args and isinstance(args[0], test.BaseTestCase):
+                test_obj = args[0]
+            else:
+                raise rbac_exceptions.RbacResourceSetupFailed(
+                    '`rbac_rule_validation` decorator can only be applied to '
+                    'an instance of `tempest.test.BaseTestCase`.')
+
+            # A background role switch resets the credentials read below.
+            test_obj.rbac_utils.wait_for_switch_role()
+            if CONF.rbac.rbac_test_roles:
+                _sweep_roles(test_obj, CONF.rbac.rbac_test_roles, run_as,
+                             *args, **kwargs)
+            else:
+                run_as(test_obj, CONF.rbac.rbac_test_role,
+                       'switch_role_timings', *args, **kwargs)
 
-        _wrapper = testtools.testcase.attr(role)(wrapper)
+        wrapper.rbac_action = validation_plan.rbac_action
+        wrapper.rbac_plan = validation_plan
+        _wrapper = testtools.testcase.attr(*roles)(wrapper)
         return _wrapper
     return decorator
 
 
-def _is_authorized(test_obj, service, rule_name, extra_target_data):
+def _sweep_roles(test_obj, roles, run_as, *args, **kwargs):
+    """Runs an RBAC test with each of ``roles``.
+
+    The test is run with every role even if it fails with one of them, and
+    the result for each role is attached to the details of the test as
+    ``rbac_role_results``. The traceback of each failed role is attached as
+    ``traceback-<role>``, and the roles skipped by a test that otherwise
+    passed are listed in ``rbac_skipped_roles``.
+
+    :raises RbacRoleSweepFailed: if the test failed with any role.
+    :raises skipException: if the test was skipped with every role.
+    """
+    results = collections.OrderedDict()
+    failures = []
+    for role in roles:
+        test_obj.rbac_utils.set_rbac_test_role(test_obj, role)
+        try:
+            run_as(test_obj, role, 'switch_role_timings-%s' % role,
+                   *args, **kwargs)
+        except testtools.TestCase.skipException as e:
+            results[role] = {'result': 'skip', 'reason': str(e)}
+        except Exception as e:
+            LOG.error("Role %s failed: %s", role, e)
+            test_obj.addDetail('traceback-%s' % role,
+                               content.TracebackContent(sys.exc_info(),
+                                                        test_obj))
+            results[role] = {'result': 'fail', 'reason': str(e)}
+            failures.append(role)
+        else:
+            results[role] = {'result': 'pass'}
+    test_obj.addDetail('rbac_role_results', content.json_content(results))
+
+    skipped = [role for role in results if results[role]['result'] == 'skip']
+    if skipped and len(skipped) < len(results):
+        LOG.warning("Skipped with roles %s.", ', '.join(skipped))
+        test_obj.addDetail('rbac_skipped_roles', content.text_content(
+            '\n'.join('%s: %s' % (role, results[role]['reason'])
+                      for role in skipped)))
+
+    if failures:
+        raise rbac_exceptions.RbacRoleSweepFailed(
+            "Failed with roles %s: %s" % (', '.join(failures), '; '.join(
+                '%s: %s' % (role, results[role]['reason'])
+                for role in failures)))
+    if all(result['result'] == 'skip' for result in results.values()):
+        raise testtools.TestCase.skipException(
+            '; '.join(sorted(set(result['reason']
+                                 for result in results.values()))))
+
+
+def _get_plan_id(func):
+    name = getattr(func, '__qualname__', getattr(func, '__name__', None))
+    code = getattr(func, '__code__', None)
+    return '%s.%s:%s' % (getattr(func, '__module__', None),
+                         name or repr(func),
+                         getattr(code, 'co_firstlineno', None))
+
+
+def _get_test_id(test_obj):
+    """Returns the ID of the running test, without its attributes.
+
+    Tempest appends the attributes of a test, which include the roles it is
+    run with, to its ID, so they are dropped for the ID to be the same in
+    runs with different roles.
+    """
+    return test_obj.id().split('[', 1)[0]
+
+
+def _is_inherited(test_obj, test_id, role, allowed, rbac_action):
+    """Checks whether the outcome of a test is inherited from the baseline.
+
+    The expected outcome for the baseline role is computed from the current
+    policy, so that an outcome is not inherited if the policy changed since
+    the baseline run.
+    """
+    baseline_role = CONF.rbac.baseline_role
+    if not rbac_results.is_baseline_enabled(role):
+        return False
+    if rbac_action.admin_only:
+        baseline_allowed = baseline_role == CONF.identity.admin_role
+    else:
+        baseline_allowed = _is_authorized(
+            test_obj, rbac_action.service, rbac_action.rule,
+            rbac_action.extra_target_data, role=baseline_role)
+    return rbac_results.is_inherited(test_id, role, allowed,
+                                     bool(baseline_allowed))
+
+
+def _add_timing_details(test_obj, name='switch_role_timings'):
+    """Attaches the role switching timings of the test to its details."""
+    timings = rbac_timings.collector.stop_capture()
+    if timings:
+        test_obj.addDetail(name, content.json_content(timings))
+
+
+def _is_authorized(test_obj, service, rule_name, extra_target_data,
+                   role=None):
     try:
         project_id = test_obj.auth_provider.credentials.project_id
         user_id = test_obj.auth_provider.credentials.user_id
@@ -140,7 +385,8 @@ def _is_authorized(test_obj, service, rule_name, extra_target_data):
         raise rbac_exceptions.RbacResourceSetupFailed(msg)
 
     try:
-        role = CONF.rbac.rbac_test_role
+        if role is None:
+            role = CONF.rbac.rbac_test_role
         formatted_target_data = _format_extra_target_data(
             test_obj, extra_target_data)
         policy_parser = rbac_policy_parser.RbacPolicyParser(
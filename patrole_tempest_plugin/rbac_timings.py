@@ -0,0 +1,129 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Wall-clock timings of the phases of role switching.
+
+Timings are aggregated per phase for the whole worker process and written
+to ``CONF.rbac.timing_report_file`` when the process exits. The timings of
+the phases run during a test can also be captured, so that they are attached
+to the details of the test.
+"""
+
+import atexit
+import contextlib
+import copy
+import json
+import os
+import threading
+
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from tempest import config
+
+CONF = config.CONF
+LOG = logging.getLogger(__name__)
+
+
+class TimingCollector(object):
+    """Collects the wall-clock time spent in named phases."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager recording the time spent in phase ``name``."""
+        watch = timeutils.StopWatch()
+        watch.start()
+        try:
+            yield
+        finally:
+            self.record(name, watch.elapsed())
+
+    def record(self, name, seconds):
+        with self._lock:
+            _add_timing(self._phases, name, seconds)
+        captured = getattr(self._local, 'captured', None)
+        if captured is not None:
+            _add_timing(captured, name, seconds)
+
+    def start_capture(self):
+        """Starts capturing the timings recorded by the current thread."""
+        self._local.captured = {}
+
+    def stop_capture(self):
+        """Stops capturing and returns the timings captured per phase."""
+        captured = getattr(self._local, 'captured', None)
+        self._local.captured = None
+        return captured or {}
+
+    def get_stats(self):
+        """Returns the count, total and maximum seconds of each phase."""
+        with self._lock:
+            return copy.deepcopy(self._phases)
+
+    def reset(self):
+        with self._lock:
+            self._phases.clear()
+
+    def write_report(self, path):
+        """Writes the timings of the process to ``path`` as JSON."""
+        report = {'pid': os.getpid(), 'phases': self.get_stats()}
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=4, sort_keys=True)
+
+
+def _add_timing(phases, name, seconds):
+    stats = phases.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+    stats['count'] += 1
+    stats['total'] += seconds
+    stats['max'] = max(stats['max'], seconds)
+
+
+collector = TimingCollector()
+
+
+def get_timing_stats():
+    """Returns the timings of the role switching phases of the process."""
+    return collector.get_stats()
+
+
+def get_report_path():
+    """Returns the path of the timing report of this process, if any.
+
+    The process ID is appended to ``CONF.rbac.timing_report_file``, so that
+    the workers of a test run do not overwrite each other's reports.
+    """
+    if not CONF.rbac.timing_report_file:
+        return None
+    return '%s.%d' % (CONF.rbac.timing_report_file, os.getpid())
+
+
+@atexit.register
+def _write_report():
+    try:
+        path = get_report_path()
+    except Exception:
+        # The configuration may already be unusable at exit.
+        return
+    if path is None or not collector.get_stats():
+        return
+    try:
+        collector.write_report(path)
+    except (IOError, OSError) as e:
+        LOG.warning("Failed to write the timing report %s: %s", path, e)
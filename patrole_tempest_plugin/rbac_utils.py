@@ -13,24 +13,295 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
+import calendar
+from email import utils as email_utils
+import functools
+import hashlib
+import math
+from multiprocessing import pool
+import os
 import sys
+import threading
 import time
 
 from oslo_log import log as logging
+from oslo_utils import timeutils
 import oslo_utils.uuidutils as uuid_utils
+import six
+from testtools import content
 
 from tempest.common import credentials_factory as credentials
 from tempest import config
+from tempest.lib.common.utils import data_utils
+from tempest.lib.common.utils import test_utils
+from tempest.lib import exceptions
 
+from patrole_tempest_plugin import rbac_cache
 from patrole_tempest_plugin import rbac_exceptions
+from patrole_tempest_plugin import rbac_http
+from patrole_tempest_plugin import rbac_policy_parser
+from patrole_tempest_plugin import rbac_timings
 
 CONF = config.CONF
 LOG = logging.getLogger(__name__)
 
+# Number of waits for a new token second and total seconds waited, across
+# all ``RbacUtils`` instances of the process.
+_token_wait_stats = {'waits': 0, 'seconds': 0.0}
+
+
+def get_token_wait_stats():
+    """Returns the number of token waits and the total seconds waited."""
+    return dict(_token_wait_stats)
+
+
+# Role IDs per role name, shared by the RbacUtils of every test class.
+_role_ids = {}
+_role_ids_lock = threading.Lock()
+
+
+def invalidate_role_id_cache():
+    """Forgets the role IDs resolved by this process."""
+    with _role_ids_lock:
+        _role_ids.clear()
+
+
+def _forget_role_ids(role_names):
+    """Forgets the cached IDs of ``role_names``, including on disk."""
+    with _role_ids_lock:
+        for name in role_names:
+            _role_ids.pop(name, None)
+        if rbac_cache.is_enabled():
+            rbac_cache.delete(_get_role_id_cache_entry_name())
+
+
+def _get_role_id_cache_entry_name():
+    """Returns the name of the on-disk role ID cache of the cloud."""
+    identity_uri = CONF.identity.uri_v3 or CONF.identity.uri or ''
+    return 'roles-%s.json' % hashlib.sha1(
+        identity_uri.encode('utf-8')).hexdigest()
+
+
+def _get_domain_attrs(creds):
+    """Returns the domain attributes that are set in ``creds``."""
+    domain_attrs = dict(
+        (attr, getattr(creds, attr, None))
+        for attr in ('user_domain_id', 'user_domain_name',
+                     'project_domain_id', 'project_domain_name'))
+    return dict((k, v) for k, v in domain_attrs.items() if v)
+
+
+# Credentials of the project and user dedicated to this worker process, if
+# [rbac] worker_isolation is enabled.
+_worker_credentials = None
+_worker_credentials_lock = threading.Lock()
+
+
+def _get_response_time(resp):
+    """Returns the time of the ``Date`` header of ``resp``, in seconds.
+
+    Returns None if ``resp`` has no valid ``Date`` header.
+    """
+    headers = getattr(resp, 'response', None)
+    if not isinstance(headers, dict) or not headers.get('date'):
+        return None
+    date = email_utils.parsedate_tz(headers['date'])
+    if date is None:
+        return None
+    return email_utils.mktime_tz(date)
+
+
+def _delete_worker_resources(delete_method, resource_id):
+    try:
+        test_utils.call_and_ignore_notfound_exc(delete_method, resource_id)
+    except Exception as e:
+        LOG.warning("Failed to delete worker resource %s: %s",
+                    resource_id, e)
+
+
+def isolate_worker(test_class):
+    """Makes ``test_class`` use the project and user of the worker process.
+
+    Called by ``setup_credentials`` of the RBAC test classes, so that the
+    client manager of the primary credentials is replaced before
+    ``setup_clients`` creates any client from it. Does nothing unless
+    ``CONF.rbac.worker_isolation`` is set, or if dynamic credentials already
+    give each test class its own project and user.
+
+    The project and user of the worker are created the first time and
+    deleted when the process exits. No network is provisioned for the
+    project and it has the default quotas, so test classes needing a
+    network must rely on a shared one, such as
+    ``CONF.compute.fixed_network_name``.
+    """
+    if not CONF.rbac.worker_isolation:
+        return
+    if CONF.auth.use_dynamic_credentials:
+        LOG.debug('Dynamic credentials already isolate the role '
+                  'assignments of each test class.')
+        return
+
+    global _worker_credentials
+    with _worker_credentials_lock:
+        if _worker_credentials is None:
+            _worker_credentials = _create_worker_credentials(
+                test_class.os_primary.credentials,
+                test_class.get_identity_version())
+
+    test_class.os_primary = test_class.client_manager(
+        credentials=_worker_credentials)
+
+
+def _create_worker_credentials(primary_creds, identity_version):
+    """Creates a project and a user holding the admin role in it.
+
+    The resources are created and deleted with clients of the configured
+    admin credentials, which live as long as the process rather than as
+    long as a test class.
+    """
+    domain_attrs = _get_domain_attrs(primary_creds)
+    admin_manager = credentials.AdminManager()
+    projects_client = admin_manager.projects_client
+    users_client = admin_manager.users_v3_client
+    roles_client = rbac_http.share_connections(admin_manager.roles_v3_client)
+
+    admin_role_id = None
+    for role in roles_client.list_roles(
+            name=CONF.identity.admin_role)['roles']:
+        if role['name'] == CONF.identity.admin_role:
+            admin_role_id = role['id']
+    if not admin_role_id:
+        msg = "Role with name 'admin' does not exist in the system."
+        raise rbac_exceptions.RbacResourceSetupFailed(msg)
+
+    name = data_utils.rand_name('patrole-worker-%d' % os.getpid())
+    project_kwargs = {}
+    if 'project_domain_id' in domain_attrs:
+        project_kwargs['domain_id'] = domain_attrs['project_domain_id']
+    project = projects_client.create_project(
+        name=name, **project_kwargs)['project']
+    atexit.register(_delete_worker_resources,
+                    projects_client.delete_project, project['id'])
+
+    password = data_utils.rand_password()
+    user_kwargs = {}
+    if 'user_domain_id' in domain_attrs:
+        user_kwargs['domain_id'] = domain_attrs['user_domain_id']
+    user = users_client.create_user(
+        name=name, password=password, project_id=project['id'],
+        **user_kwargs)['user']
+    # Exit handlers run last in, first out, so the user is deleted before
+    # its project.
+    atexit.register(_delete_worker_resources,
+                    users_client.delete_user, user['id'])
+    # A project scoped token can only be issued with a role.
+    roles_client.create_user_role_on_project(
+        project['id'], user['id'], admin_role_id)
+
+    LOG.debug('Created project %s and user %s for this worker.',
+              project['id'], user['id'])
+    return credentials.get_credentials(
+        fill_in=False, identity_version=identity_version,
+        username=user['name'], user_id=user['id'], password=password,
+        project_id=project['id'], project_name=project['name'],
+        **domain_attrs)
+
+
+_role_change_pool = None
+_role_change_pool_lock = threading.Lock()
+
+
+def _get_role_change_pool():
+    """Returns the thread pool applying role assignment changes.
+
+    The pool is closed when the process exits.
+    """
+    global _role_change_pool
+    with _role_change_pool_lock:
+        if _role_change_pool is None:
+            _role_change_pool = pool.ThreadPool(
+                CONF.rbac.role_switch_concurrency)
+            atexit.register(_close_role_change_pool)
+        return _role_change_pool
+
+
+def _close_role_change_pool():
+    global _role_change_pool
+    with _role_change_pool_lock:
+        if _role_change_pool is not None:
+            _role_change_pool.close()
+            _role_change_pool.join()
+        _role_change_pool = None
+
+
+def _serialize_auth(auth_provider):
+    """Makes the authentication of ``auth_provider`` thread safe.
+
+    A client used by several threads at once shares the auth data of its
+    auth provider, so only one thread at a time may read or refresh it.
+    """
+    if getattr(auth_provider, '_rbac_auth_serialized', False) is True:
+        return
+    # get_auth calls set_auth when the cached token expired.
+    lock = threading.RLock()
+
+    def locked(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with lock:
+                return method(*args, **kwargs)
+        return wrapper
+
+    for name in ('get_auth', 'set_auth'):
+        setattr(auth_provider, name, locked(getattr(auth_provider, name)))
+    auth_provider._rbac_auth_serialized = True
+
+
+class _PendingSwitch(object):
+    """A role switch running in a background thread.
+
+    :param test_obj: the test that started the switch.
+    """
+
+    thread = None
+    exc_info = None
+    # Timings of the phases of the switch, captured by its thread.
+    timings = None
+
+    def __init__(self, test_obj):
+        self.test_obj = test_obj
+
 
 class RbacUtils(object):
 
     def __init__(self, test_obj):
+        # Role IDs assigned to each (project ID, user ID), as last listed or
+        # changed by `switch_role`. Entries are dropped whenever a change
+        # fails, so that the assignments are listed again.
+        self._user_role_ids = {}
+        # Auth data of the test user per (project ID, user ID, frozenset of
+        # role IDs). Keystone revokes the tokens of a user on a project when
+        # one of its role assignments is removed, so removing a role drops
+        # every token of the user.
+        self._user_tokens = {}
+        if not credentials.is_admin_available(
+                identity_version=test_obj.get_identity_version()):
+            msg = "Missing Identity Admin API credentials in configuration."
+            raise rbac_exceptions.RbacResourceSetupFailed(msg)
+
+        # Let the policy parser validate services with the admin identity
+        # client of the test class rather than building its own, for as
+        # long as the test class runs.
+        services_client = rbac_http.share_connections(
+            test_obj.os_admin.identity_services_v3_client)
+        rbac_policy_parser.RbacPolicyParser.set_services_client(
+            services_client)
+        test_obj.addClassResourceCleanup(
+            rbac_policy_parser.RbacPolicyParser.unset_services_client,
+            services_client)
+        if CONF.rbac.switch_role_mode == 'dual_user':
+            self._setup_dual_user(test_obj)
         self.switch_role(test_obj, toggle_rbac_role=False)
 
     # References the last value of `toggle_rbac_role` that was passed to
@@ -41,73 +312,466 @@ class RbacUtils(object):
     switch_role_history = {}
     admin_role_id = None
     rbac_role_id = None
+    # Time of the last role assignment change made by `switch_role`, by the
+    # clock of the client and, if known, by the clock of Keystone.
+    _role_write_time = None
+    _role_write_server_time = None
+    # In dual user mode, the credentials and cached auth data of the user
+    # holding rbac_test_role (True) and of the admin user (False).
+    _dual_user_auth = None
+    _dual_user_role = None
+    # The role switch running in the background, if any.
+    _pending_switch = None
+    # The role set by `set_rbac_test_role`, if any.
+    _rbac_test_role = None
 
     def switch_role(self, test_obj, toggle_rbac_role=False):
-        self.user_id = test_obj.auth_provider.credentials.user_id
-        self.project_id = test_obj.auth_provider.credentials.tenant_id
-        self.token = test_obj.auth_provider.get_token()
-        self.identity_version = test_obj.get_identity_version()
+        self.wait_for_switch_role()
+        with rbac_timings.collector.phase('switch_role'):
+            self._switch_role(test_obj, toggle_rbac_role)
+
+    def start_switch_role(self, test_obj, toggle_rbac_role=False):
+        """Starts switching role in the background.
+
+        The switch is validated immediately, so that misuses of
+        `switch_role` are still reported by the test. The auth provider of
+        the test class then waits for the switch to complete before it is
+        used, as does `switch_role`. The switch is also waited for by a
+        cleanup of ``test_obj`` registered by ``rbac_rule_validation``, so
+        that its timings and any error it raises are reported on the test
+        that started it.
+        """
+        self.wait_for_switch_role()
+        if self._dual_user_auth is not None:
+            # Switching user is immediate.
+            self.switch_role(test_obj, toggle_rbac_role)
+            return
 
-        if not credentials.is_admin_available(
-                identity_version=self.identity_version):
-            msg = "Missing Identity Admin API credentials in configuration."
-            raise rbac_exceptions.RbacResourceSetupFailed(msg)
+        self._validate_switch_role(test_obj, toggle_rbac_role)
+        self._add_switch_barrier(test_obj.auth_provider)
+        pending_switch = _PendingSwitch(test_obj)
+
+        def run_switch():
+            rbac_timings.collector.start_capture()
+            try:
+                with rbac_timings.collector.phase('switch_role'):
+                    self._switch_role(test_obj, toggle_rbac_role,
+                                      validate=False)
+            except Exception:
+                pending_switch.exc_info = sys.exc_info()
+            finally:
+                pending_switch.timings = \
+                    rbac_timings.collector.stop_capture()
+
+        pending_switch.thread = threading.Thread(target=run_switch)
+        pending_switch.thread.daemon = True
+        self._pending_switch = pending_switch
+        pending_switch.thread.start()
+
+    def wait_for_switch_role(self):
+        """Waits for the role switch running in the background, if any."""
+        pending_switch = self._pending_switch
+        if pending_switch is None or \
+                pending_switch.thread is threading.current_thread():
+            return
+
+        with rbac_timings.collector.phase('switch_role_wait'):
+            pending_switch.thread.join()
+        if self._pending_switch is pending_switch:
+            self._pending_switch = None
+            if pending_switch.timings:
+                pending_switch.test_obj.addDetail(
+                    'switch_role_restore_timings',
+                    content.json_content(pending_switch.timings))
+            if pending_switch.exc_info is not None:
+                LOG.error("Restoring the admin role after %s failed: %s",
+                          pending_switch.test_obj.id(),
+                          pending_switch.exc_info[1])
+                six.reraise(*pending_switch.exc_info)
+
+    def _add_switch_barrier(self, auth_provider):
+        """Makes ``auth_provider`` wait for background role switches."""
+        if getattr(auth_provider, '_rbac_switch_barrier', False) is True:
+            return
+
+        def wait_before(method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                self.wait_for_switch_role()
+                return method(*args, **kwargs)
+            return wrapper
+
+        for name in ('auth_request', 'base_url', 'get_auth', 'get_token'):
+            setattr(auth_provider, name,
+                    wait_before(getattr(auth_provider, name)))
+        auth_provider._rbac_switch_barrier = True
+
+    def _switch_role(self, test_obj, toggle_rbac_role, validate=True):
+        if self._dual_user_auth is not None:
+            LOG.debug('Switching user to: %s', toggle_rbac_role)
+            self._validate_switch_role(test_obj, toggle_rbac_role)
+            self._switch_user(test_obj.auth_provider, toggle_rbac_role)
+            return
 
-        self.roles_client = test_obj.os_admin.roles_v3_client
+        self._set_user_data(test_obj)
 
         LOG.debug('Switching role to: %s', toggle_rbac_role)
 
+        self._role_write_time = None
+        self._role_write_server_time = None
+        # The current token is valid for the current assignment, unless a
+        # role is removed below.
+        self._cache_user_token(test_obj.auth_provider.cache)
         try:
             if not self.admin_role_id or not self.rbac_role_id:
-                self._get_roles()
+                with rbac_timings.collector.phase('role_lookup'):
+                    self._get_roles()
 
-            self._validate_switch_role(test_obj, toggle_rbac_role)
+            if validate:
+                self._validate_switch_role(test_obj, toggle_rbac_role)
 
-            if toggle_rbac_role:
-                self._add_role_to_user(self.rbac_role_id)
-            else:
-                self._add_role_to_user(self.admin_role_id)
+            self._assign_role(toggle_rbac_role)
         except Exception as exp:
             LOG.error(exp)
             raise
         finally:
-            # NOTE(felipemonteiro): These two comments below are copied from
-            # tempest.api.identity.v2/v3.test_users.
-            #
-            # Reset auth again to verify the password restore does work.
-            # Clear auth restores the original credentials and deletes
-            # cached auth data.
+            self._reauthenticate(test_obj)
+
+    def _set_user_data(self, test_obj):
+        self.user_id = test_obj.auth_provider.credentials.user_id
+        self.project_id = test_obj.auth_provider.credentials.tenant_id
+        self.token = test_obj.auth_provider.get_token()
+        self.identity_version = test_obj.get_identity_version()
+
+        # Role switches of every test class reuse the same keep-alive
+        # connections to Keystone, including to issue the tokens of the
+        # test user.
+        self.roles_client = rbac_http.share_connections(
+            test_obj.os_admin.roles_v3_client)
+        auth_client = getattr(test_obj.auth_provider, 'auth_client', None)
+        if auth_client is not None:
+            rbac_http.share_connections(auth_client)
+
+    def _get_user_token_key(self):
+        """Returns the token cache key of the current role assignment.
+
+        Returns None if the roles assigned to the user are not known.
+        """
+        role_ids = self._user_role_ids.get((self.project_id, self.user_id))
+        if role_ids is None:
+            return None
+        return (self.project_id, self.user_id, frozenset(role_ids))
+
+    def _cache_user_token(self, auth_data):
+        token_key = self._get_user_token_key()
+        if token_key is not None and auth_data is not None:
+            self._user_tokens[token_key] = auth_data
+
+    def _invalidate_user_tokens(self):
+        """Drops the cached tokens of the user, which Keystone revoked."""
+        for token_key in list(self._user_tokens):
+            if token_key[:2] == (self.project_id, self.user_id):
+                del self._user_tokens[token_key]
+
+    def _reauthenticate(self, test_obj):
+        # Reuse the token of the new role assignment if it is still valid.
+        auth_provider = test_obj.auth_provider
+        auth_data = self._user_tokens.get(self._get_user_token_key())
+        if auth_data is not None and not auth_provider.is_expired(auth_data):
+            LOG.debug('Reusing the cached token of the role assignment.')
+            auth_provider.cache = auth_data
+            return
+
+        # NOTE(felipemonteiro): These two comments below are copied from
+        # tempest.api.identity.v2/v3.test_users.
+        #
+        # Reset auth again to verify the password restore does work.
+        # Clear auth restores the original credentials and deletes
+        # cached auth data.
+        issued_at = self._get_token_issued_at(test_obj.auth_provider)
+        with rbac_timings.collector.phase('clear_auth'):
             test_obj.auth_provider.clear_auth()
-            # Fernet tokens are not subsecond aware and Keystone should only be
-            # precise to the second. Sleep to ensure we are passing the second
-            # boundary before attempting to authenticate. If token is of type
-            # uuid, then do not sleep.
-            if not uuid_utils.is_uuid_like(self.token):
-                time.sleep(1)
+        # Fernet tokens are not subsecond aware and Keystone should only be
+        # precise to the second. Wait until the second boundary is passed
+        # before attempting to authenticate. If token is of type uuid,
+        # then do not wait.
+        if not uuid_utils.is_uuid_like(self.token):
+            self._wait_for_token_boundary(issued_at)
+        with rbac_timings.collector.phase('set_auth'):
             test_obj.auth_provider.set_auth()
+        if not uuid_utils.is_uuid_like(self.token):
+            self._reissue_revoked_token(test_obj.auth_provider, issued_at)
+        self._cache_user_token(test_obj.auth_provider.cache)
+
+    def _setup_dual_user(self, test_obj):
+        """Provisions the users switched between in dual user mode.
+
+        The test user is only assigned rbac_test_role, and a new user of the
+        same project is assigned the admin role. The new user is deleted
+        during the resource cleanup of the test class. Resources created
+        while the admin user is current, such as in ``resource_setup``,
+        belong to it, so those owned by a user, like keypairs, are not
+        visible to the test user.
+        """
+        self._set_user_data(test_obj)
+        self._role_write_time = None
+        self._role_write_server_time = None
+        try:
+            if not self.admin_role_id or not self.rbac_role_id:
+                with rbac_timings.collector.phase('role_lookup'):
+                    self._get_roles()
+            self._assign_role(True)
+        finally:
+            self._reauthenticate(test_obj)
+
+        auth_provider = test_obj.auth_provider
+        primary_creds = auth_provider.credentials
+        # Reuse the domains of the test user, so that the admin user is
+        # created and authenticated in the same domain.
+        domain_attrs = _get_domain_attrs(primary_creds)
+
+        users_client = test_obj.os_admin.users_v3_client
+        password = data_utils.rand_password()
+        user_kwargs = {}
+        if 'user_domain_id' in domain_attrs:
+            user_kwargs['domain_id'] = domain_attrs['user_domain_id']
+        admin_user = users_client.create_user(
+            name=data_utils.rand_name('rbac-admin'), password=password,
+            project_id=self.project_id, **user_kwargs)['user']
+        test_obj.addClassResourceCleanup(
+            test_utils.call_and_ignore_notfound_exc,
+            users_client.delete_user, admin_user['id'])
+        resp = self.roles_client.create_user_role_on_project(
+            self.project_id, admin_user['id'], self.admin_role_id)
+        self._role_write_time = time.time()
+        self._role_write_server_time = _get_response_time(resp)
+
+        admin_creds = credentials.get_credentials(
+            fill_in=False, identity_version=self.identity_version,
+            username=admin_user['name'], user_id=admin_user['id'],
+            password=password, project_id=self.project_id,
+            project_name=primary_creds.project_name, **domain_attrs)
+
+        # The admin user authenticates the first time it is switched to.
+        self._dual_user_auth = {
+            True: (primary_creds, auth_provider.cache),
+            False: (admin_creds, None)
+        }
+        self._dual_user_role = True
+
+    def _switch_user(self, auth_provider, toggle_rbac_role):
+        """Swaps the user of ``auth_provider`` in dual user mode.
+
+        The credentials and cached auth data of the current user are kept,
+        so switching back does not authenticate again unless its token
+        expired.
+
+        A user without cached auth data authenticates on its next request,
+        so its new token must not be revoked by a recent role change.
+        """
+        if toggle_rbac_role == self._dual_user_role:
+            return
+        self._dual_user_auth[self._dual_user_role] = (
+            auth_provider.credentials, auth_provider.cache)
+        auth_provider.credentials, auth_provider.cache = \
+            self._dual_user_auth[toggle_rbac_role]
+        self._dual_user_role = toggle_rbac_role
+        if auth_provider.cache is None:
+            if not uuid_utils.is_uuid_like(self.token):
+                self._wait_for_token_boundary(None, verified=False)
 
-    def _add_role_to_user(self, role_id):
-        role_already_present = self._clear_user_roles(role_id)
-        if role_already_present:
+    def _get_token_issued_at(self, auth_provider):
+        """Returns the issue time of the cached token, in seconds.
+
+        Returns None if no token is cached or if its issue time is unknown.
+        """
+        try:
+            auth_data = auth_provider.cache[1]
+            # Identity v2 nests the token metadata under the token key.
+            if 'token' in auth_data:
+                auth_data = auth_data['token']
+            issued_at = timeutils.parse_isotime(auth_data['issued_at'])
+        except (TypeError, KeyError, IndexError, ValueError):
+            return None
+        return calendar.timegm(issued_at.utctimetuple()) + \
+            issued_at.microsecond / 1e6
+
+    def _wait_for_token_boundary(self, issued_at, verified=True):
+        """Waits until a new token would be issued after the role change.
+
+        Keystone revokes the tokens issued up to the second of a role
+        assignment change, so a new token must be issued in a later second
+        than both the change and the current token. Nothing is waited for
+        if no role assignment changed or if that second has already begun.
+
+        The second boundary is estimated with the clock of the client, so
+        the new token must then be checked by ``_reissue_revoked_token``.
+        If it is not (``verified`` is False), a whole second is waited
+        from the role change instead, which does not depend on the clocks
+        of the client and of Keystone being in sync.
+        """
+        if self._role_write_time is None:
+            return
+
+        if verified:
+            boundary = math.floor(
+                max(self._role_write_time, issued_at or 0)) + 1
+        else:
+            boundary = self._role_write_time + 1
+        self._sleep_for_token(boundary - time.time())
+
+    def _reissue_revoked_token(self, auth_provider, issued_at):
+        """Authenticates again if the new token was issued too early.
+
+        The issue time of the new token is compared with the ``Date``
+        header of the role assignment responses and with the issue time of
+        the previous token, which all come from the clock of Keystone. A
+        token issued in the same second as the role change is revoked, as
+        happens when the clock of the client is behind, so a new one is
+        issued once Keystone reaches the next second.
+        """
+        if self._role_write_server_time is None:
             return
 
-        self.roles_client.create_user_role_on_project(
-            self.project_id, self.user_id, role_id)
+        boundary = math.floor(
+            max(self._role_write_server_time, issued_at or 0)) + 1
+        new_issued_at = self._get_token_issued_at(auth_provider)
+        if new_issued_at is None or new_issued_at >= boundary:
+            return
 
-    def _clear_user_roles(self, role_id):
-        roles = self.roles_client.list_user_roles_on_project(
-            self.project_id, self.user_id)['roles']
+        LOG.debug('The new token was issued before the role change second '
+                  'ended; authenticating again.')
+        with rbac_timings.collector.phase('clear_auth'):
+            auth_provider.clear_auth()
+        self._sleep_for_token(boundary - new_issued_at)
+        with rbac_timings.collector.phase('set_auth'):
+            auth_provider.set_auth()
 
-        # If the user already has the role that is required, return early.
-        role_ids = [role['id'] for role in roles]
-        if role_ids == [role_id]:
-            return True
+    def _sleep_for_token(self, wait):
+        if wait <= 0:
+            return
 
-        for role in roles:
-            self.roles_client.delete_role_from_user_on_project(
-                self.project_id, self.user_id, role['id'])
+        LOG.debug('Waiting %.3f seconds for the next token second.', wait)
+        with rbac_timings.collector.phase('token_wait'):
+            time.sleep(wait)
+        _token_wait_stats['waits'] += 1
+        _token_wait_stats['seconds'] += wait
 
-        return False
+    def _assign_role(self, toggle_rbac_role):
+        """Makes the admin role or rbac_test_role the only role of the user.
+
+        A role ID is resolved again, once, if the role is not found, as the
+        role may have been deleted and recreated since its ID was cached.
+        """
+        try:
+            self._add_role_to_user(self.rbac_role_id if toggle_rbac_role
+                                   else self.admin_role_id)
+        except exceptions.NotFound:
+            LOG.warning('Role assignment failed with NotFound; resolving '
+                        'the role IDs again.')
+            _forget_role_ids([self.rbac_test_role, CONF.identity.admin_role])
+            with rbac_timings.collector.phase('role_lookup'):
+                self._get_roles()
+            self._add_role_to_user(self.rbac_role_id if toggle_rbac_role
+                                   else self.admin_role_id)
+
+    def _add_role_to_user(self, role_id):
+        """Makes ``role_id`` the only role of the user on the project.
+
+        The other roles of the user are removed and ``role_id`` is assigned
+        if needed. These changes are made concurrently, by up to
+        ``CONF.rbac.role_switch_concurrency`` requests at a time.
+
+        The resulting assignment is not read back when every change
+        succeeds, so a role assigned meanwhile by something other than
+        Patrole goes unnoticed. The roles of the user are only listed again
+        after a failed change.
+        """
+        role_ids = self._get_user_role_ids()
+        if role_ids == [role_id]:
+            return
+
+        changes = [
+            ('delete_assignment',
+             self.roles_client.delete_role_from_user_on_project, other_id)
+            for other_id in role_ids if other_id != role_id]
+        if changes:
+            self._invalidate_user_tokens()
+        if role_id not in role_ids:
+            changes.append(
+                ('create_assignment',
+                 self.roles_client.create_user_role_on_project, role_id))
+
+        user_key = (self.project_id, self.user_id)
+        self._user_role_ids.pop(user_key, None)
+        errors, server_time = self._apply_role_changes(changes)
+        self._role_write_time = time.time()
+        self._role_write_server_time = server_time
+
+        if errors:
+            # The outcome of the changes is unknown, so read the actual
+            # roles of the user again.
+            try:
+                self._get_user_role_ids()
+            except Exception as e:
+                LOG.error("Failed to list the roles of user %s: %s",
+                          self.user_id, e)
+            for exc_info in errors[1:]:
+                LOG.error("Failed to change a role assignment: %s",
+                          exc_info[1])
+            six.reraise(*errors[0])
+
+        self._user_role_ids[user_key] = [role_id]
+
+    def _get_user_role_ids(self):
+        """Returns the IDs of the roles of the user on the project.
+
+        The roles of the user are only listed if they are not already known
+        from a previous call.
+        """
+        user_key = (self.project_id, self.user_id)
+        role_ids = self._user_role_ids.get(user_key)
+        if role_ids is None:
+            with rbac_timings.collector.phase('list_assignments'):
+                roles = self.roles_client.list_user_roles_on_project(
+                    self.project_id, self.user_id)['roles']
+            role_ids = [role['id'] for role in roles]
+            self._user_role_ids[user_key] = role_ids
+        return role_ids
+
+    def _apply_role_changes(self, changes):
+        """Applies role assignment changes of the user.
+
+        :param changes: list of (timing phase, roles client method, role ID)
+        :returns: list of the ``sys.exc_info()`` of the failed changes, and
+            the latest ``Date`` header of the responses, in seconds, or None
+            if unknown.
+        """
+        def apply_change(change):
+            phase, method, role_id = change
+            watch = timeutils.StopWatch()
+            watch.start()
+            try:
+                resp = method(self.project_id, self.user_id, role_id)
+            except Exception:
+                return phase, watch.elapsed(), sys.exc_info(), None
+            return phase, watch.elapsed(), None, _get_response_time(resp)
+
+        if len(changes) > 1 and CONF.rbac.role_switch_concurrency > 1:
+            _serialize_auth(self.roles_client.auth_provider)
+            results = _get_role_change_pool().map(apply_change, changes)
+        else:
+            results = [apply_change(change) for change in changes]
+
+        errors = []
+        server_time = None
+        for phase, elapsed, exc_info, resp_time in results:
+            rbac_timings.collector.record(phase, elapsed)
+            if exc_info is not None:
+                errors.append(exc_info)
+            if resp_time is not None:
+                server_time = max(server_time or 0, resp_time)
+        return errors, server_time
 
     def _validate_switch_role(self, test_obj, toggle_rbac_role):
         """Validates that the rbac role passed to `switch_role` is legal.
@@ -145,14 +809,10 @@ class RbacUtils(object):
             self.switch_role_history[key] = toggle_rbac_role
 
     def _get_roles(self):
-        available_roles = self.roles_client.list_roles()
-        admin_role_id = rbac_role_id = None
-
-        for role in available_roles['roles']:
-            if role['name'] == CONF.rbac.rbac_test_role:
-                rbac_role_id = role['id']
-            if role['name'] == CONF.identity.admin_role:
-                admin_role_id = role['id']
+        role_ids = self._get_role_ids(
+            [self.rbac_test_role, CONF.identity.admin_role])
+        admin_role_id = role_ids.get(CONF.identity.admin_role)
+        rbac_role_id = role_ids.get(self.rbac_test_role)
 
         if not admin_role_id or not rbac_role_id:
             msg = "Role with name 'admin' does not exist in the system."\
@@ -163,10 +823,89 @@ class RbacUtils(object):
         self.admin_role_id = admin_role_id
         self.rbac_role_id = rbac_role_id
 
+    def _get_role_ids(self, role_names):
+        """Resolves role names to role IDs.
+
+        Resolved role IDs are cached for the whole process and, if
+        ``CONF.rbac.cache_dir`` is set, shared with other processes for
+        ``CONF.rbac.role_id_cache_ttl`` seconds. Unknown roles are looked up
+        by name, rather than by listing every role.
+
+        :returns: dict of the role IDs of the roles that exist, by name.
+        """
+        with _role_ids_lock:
+            missing_names = [name for name in role_names
+                             if name not in _role_ids]
+            cache_enabled = rbac_cache.is_enabled()
+            if missing_names and cache_enabled:
+                _role_ids.update(rbac_cache.load_json(
+                    _get_role_id_cache_entry_name(),
+                    ttl=CONF.rbac.role_id_cache_ttl) or {})
+                missing_names = [name for name in missing_names
+                                 if name not in _role_ids]
+
+            for name in missing_names:
+                roles = self.roles_client.list_roles(name=name)['roles']
+                for role in roles:
+                    if role['name'] == name:
+                        _role_ids[name] = role['id']
+
+            if cache_enabled and any(name in _role_ids
+                                     for name in missing_names):
+                rbac_cache.store_json(_get_role_id_cache_entry_name(),
+                                      _role_ids)
+
+            return dict((name, _role_ids[name]) for name in role_names
+                        if name in _role_ids)
+
     @property
     def is_admin(self):
         """Verifies whether the current test role equals the admin role.
 
         :returns: True if ``rbac_test_role`` is the admin role.
         """
-        return CONF.rbac.rbac_test_role == CONF.identity.admin_role
+        return self.rbac_test_role == CONF.identity.admin_role
+
+    @property
+    def rbac_test_role(self):
+        """The role switched to by ``switch_role(toggle_rbac_role=True)``.
+
+        ``CONF.rbac.rbac_test_role``, unless changed by
+        ``set_rbac_test_role``.
+        """
+        return self._rbac_test_role or CONF.rbac.rbac_test_role
+
+    def set_rbac_test_role(self, test_obj, role):
+        """Changes the role that RBAC tests of the test class are run with.
+
+        Used to run each RBAC test with every role of
+        ``CONF.rbac.rbac_test_roles`` while reusing the resources of the
+        test class. The ID of the role is resolved by the next role switch.
+        In dual user mode, the role of the test user is changed right away.
+        """
+        self.wait_for_switch_role()
+        if role == self.rbac_test_role:
+            return
+        self._rbac_test_role = role
+        self.rbac_role_id = None
+        if CONF.rbac.switch_role_mode == 'dual_user':
+            self._set_dual_user_role(test_obj)
+
+    def _set_dual_user_role(self, test_obj):
+        """Assigns rbac_test_role to the test user in dual user mode."""
+        creds, _ = self._dual_user_auth[True]
+        self.user_id = creds.user_id
+        self.project_id = creds.tenant_id
+        with rbac_timings.collector.phase('role_lookup'):
+            self._get_roles()
+        self._assign_role(True)
+        # The token of the test user no longer holds its role. Like a role
+        # switch, wait for the second boundary before the test user
+        # authenticates again, so that its new token is not revoked. The
+        # test user authenticates later, so its new token is not checked.
+        if not uuid_utils.is_uuid_like(self.token):
+            self._wait_for_token_boundary(None, verified=False)
+        if self._dual_user_role:
+            test_obj.auth_provider.cache = None
+        else:
+            self._dual_user_auth[True] = (creds, None)
@@ -20,6 +20,7 @@ from tempest import config
 from tempest.lib.common.utils import data_utils
 from tempest.lib.common.utils import test_utils
 
+from patrole_tempest_plugin import rbac_rule_validation
 from patrole_tempest_plugin import rbac_utils
 
 CONF = config.CONF
@@ -36,6 +37,12 @@ class BaseIdentityRbacTest(base.BaseIdentityTest):
         if not CONF.rbac.enable_rbac:
             raise cls.skipException(
                 "%s skipped as RBAC testing not enabled" % cls.__name__)
+        rbac_rule_validation.skip_unless_runnable(cls)
+
+    @classmethod
+    def setup_credentials(cls):
+        super(BaseIdentityRbacTest, cls).setup_credentials()
+        rbac_utils.isolate_worker(cls)
 
     @classmethod
     def setup_clients(cls):
@@ -14,6 +14,7 @@
 from tempest.api.image import base as image_base
 from tempest import config
 
+from patrole_tempest_plugin import rbac_rule_validation
 from patrole_tempest_plugin import rbac_utils
 
 CONF = config.CONF
@@ -29,6 +30,12 @@ class BaseV1ImageRbacTest(image_base.BaseV1ImageTest):
         if not CONF.rbac.enable_rbac:
             raise cls.skipException(
                 "%s skipped as RBAC testing not enabled" % cls.__name__)
+        rbac_rule_validation.skip_unless_runnable(cls)
+
+    @classmethod
+    def setup_credentials(cls):
+        super(BaseV1ImageRbacTest, cls).setup_credentials()
+        rbac_utils.isolate_worker(cls)
 
     @classmethod
     def setup_clients(cls):
@@ -47,6 +54,12 @@ class BaseV2ImageRbacTest(image_base.BaseV2ImageTest):
         if not CONF.rbac.enable_rbac:
             raise cls.skipException(
                 "%s skipped as RBAC testing not enabled" % cls.__name__)
+        rbac_rule_validation.skip_unless_runnable(cls)
+
+    @classmethod
+    def setup_credentials(cls):
+        super(BaseV2ImageRbacTest, cls).setup_credentials()
+        rbac_utils.isolate_worker(cls)
 
     @classmethod
     def setup_clients(cls):
@@ -16,6 +16,7 @@
 from tempest.api.network import base as network_base
 from tempest import config
 
+from patrole_tempest_plugin import rbac_rule_validation
 from patrole_tempest_plugin import rbac_utils
 
 CONF = config.CONF
@@ -31,6 +32,12 @@ class BaseNetworkRbacTest(network_base.BaseNetworkTest):
         if not CONF.rbac.enable_rbac:
             raise cls.skipException(
                 "%s skipped as RBAC testing not enabled" % cls.__name__)
+        rbac_rule_validation.skip_unless_runnable(cls)
+
+    @classmethod
+    def setup_credentials(cls):
+        super(BaseNetworkRbacTest, cls).setup_credentials()
+        rbac_utils.isolate_worker(cls)
 
     @classmethod
     def setup_clients(cls):
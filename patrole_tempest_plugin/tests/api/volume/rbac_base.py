@@ -16,6 +16,7 @@ from tempest import config
 from tempest.lib.common.utils import data_utils
 from tempest.lib.common.utils import test_utils
 
+from patrole_tempest_plugin import rbac_rule_validation
 from patrole_tempest_plugin import rbac_utils
 
 CONF = config.CONF
@@ -31,6 +32,12 @@ class BaseVolumeRbacTest(vol_base.BaseVolumeTest):
         if not CONF.rbac.enable_rbac:
             raise cls.skipException(
                 "%s skipped as RBAC testing not enabled" % cls.__name__)
+        rbac_rule_validation.skip_unless_runnable(cls)
+
+    @classmethod
+    def setup_credentials(cls):
+        super(BaseVolumeRbacTest, cls).setup_credentials()
+        rbac_utils.isolate_worker(cls)
 
     @classmethod
     def setup_clients(cls):
@@ -0,0 +1,68 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import mock
+import os
+
+import fixtures
+
+from tempest.tests import base
+
+from patrole_tempest_plugin.cmd import policy_snapshot
+from patrole_tempest_plugin import rbac_policy_parser
+
+
+class PolicySnapshotTest(base.TestCase):
+
+    def setUp(self):
+        super(PolicySnapshotTest, self).setUp()
+        self.output = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'snapshot.json')
+
+    @mock.patch.object(rbac_policy_parser, 'load_code_policy', autospec=True)
+    def test_generate_snapshot(self, mock_load_code_policy):
+        mock_load_code_policy.side_effect = [
+            {'compute:create': 'rule:admin_or_owner'},
+            {'identity:get_user': 'rule:admin_required'}
+        ]
+
+        policy_snapshot.main(['nova', 'keystone', '--output', self.output])
+
+        with open(self.output) as f:
+            snapshot = json.load(f)
+        self.assertEqual(
+            {'nova': {'compute:create': 'rule:admin_or_owner'},
+             'keystone': {'identity:get_user': 'rule:admin_required'}},
+            snapshot)
+
+    @mock.patch.object(rbac_policy_parser, 'load_code_policy', autospec=True)
+    def test_generate_snapshot_preserves_other_services(
+            self, mock_load_code_policy):
+        with open(self.output, 'w') as f:
+            json.dump({'nova': {'compute:create': 'role:admin'},
+                       'keystone': {'identity:get_user': 'role:admin'}}, f)
+        mock_load_code_policy.return_value = {
+            'compute:create': 'rule:admin_or_owner'}
+
+        snapshot = policy_snapshot.generate_snapshot(['nova'], self.output)
+
+        expected_snapshot = {
+            'nova': {'compute:create': 'rule:admin_or_owner'},
+            'keystone': {'identity:get_user': 'role:admin'}
+        }
+        self.assertEqual(expected_snapshot, snapshot)
+        with open(self.output) as f:
+            self.assertEqual(expected_snapshot, json.load(f))
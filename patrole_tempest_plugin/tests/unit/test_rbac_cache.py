@@ -0,0 +1,97 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+
+import fixtures
+import mock
+
+from tempest import config
+from tempest.tests import base
+
+from patrole_tempest_plugin import rbac_cache
+
+CONF = config.CONF
+
+
+class RbacCacheTest(base.TestCase):
+
+    def setUp(self):
+        super(RbacCacheTest, self).setUp()
+        self.cache_dir = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'cache')
+        CONF.set_override('cache_dir', self.cache_dir, group='rbac')
+        self.addCleanup(CONF.clear_override, 'cache_dir', group='rbac')
+
+    def test_is_enabled(self):
+        self.assertTrue(rbac_cache.is_enabled())
+        CONF.set_override('cache_dir', None, group='rbac')
+        self.assertFalse(rbac_cache.is_enabled())
+
+    def test_store_and_load(self):
+        self.assertIsNone(rbac_cache.load('entry'))
+
+        rbac_cache.store('entry', b'content')
+
+        self.assertEqual(b'content', rbac_cache.load('entry'))
+        # No temporary files are left behind.
+        self.assertEqual(['entry'], os.listdir(self.cache_dir))
+
+    def test_load_corrupt_entry(self):
+        rbac_cache.store('entry', b'content')
+        with open(rbac_cache.get_path('entry'), 'r+b') as f:
+            data = f.read()
+            f.seek(0)
+            f.write(data[:-1] + b'x')
+
+        self.assertIsNone(rbac_cache.load('entry'))
+
+    def test_load_truncated_entry(self):
+        rbac_cache.store('entry', b'content')
+        with open(rbac_cache.get_path('entry'), 'r+b') as f:
+            f.truncate(10)
+
+        self.assertIsNone(rbac_cache.load('entry'))
+
+    def test_delete(self):
+        rbac_cache.store('entry', b'content')
+        rbac_cache.delete('entry')
+        rbac_cache.delete('entry')
+
+        self.assertIsNone(rbac_cache.load('entry'))
+
+    def test_store_and_load_json(self):
+        self.assertIsNone(rbac_cache.load_json('entry.json'))
+
+        rbac_cache.store_json('entry.json', ['nova', 'cinder'])
+
+        self.assertEqual(['nova', 'cinder'],
+                         rbac_cache.load_json('entry.json'))
+        self.assertEqual(['nova', 'cinder'],
+                         rbac_cache.load_json('entry.json', ttl=60))
+
+    def test_load_expired_json(self):
+        rbac_cache.store_json('entry.json', ['nova'])
+
+        with mock.patch.object(rbac_cache.time, 'time',
+                               return_value=time.time() + 61):
+            self.assertIsNone(rbac_cache.load_json('entry.json', ttl=60))
+            self.assertEqual(['nova'], rbac_cache.load_json('entry.json'))
+
+    def test_load_invalid_json(self):
+        rbac_cache.store('entry.json', b'not json')
+
+        self.assertIsNone(rbac_cache.load_json('entry.json'))
@@ -0,0 +1,134 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+import fixtures
+import mock
+from six.moves import BaseHTTPServer
+import urllib3
+
+from tempest import config
+from tempest.lib.common import http as tempest_http
+from tempest.tests import base
+
+from patrole_tempest_plugin import rbac_http
+
+CONF = config.CONF
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveHttpTest(base.TestCase):
+
+    def setUp(self):
+        super(KeepAliveHttpTest, self).setUp()
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d/v3/roles' % server.server_port
+
+    def test_request_reuses_connection(self):
+        http = rbac_http.KeepAliveHttp(maxsize=2)
+        self.addCleanup(http.close)
+
+        for _ in range(3):
+            resp, body = http.request(self.url, 'GET')
+            self.assertEqual(200, resp.status)
+            self.assertEqual('200', resp['status'])
+            self.assertEqual(self.url, resp['content-location'])
+            self.assertEqual(b'{}', body)
+
+        self.assertEqual({'requests': 3, 'connections': 1, 'reused': 2},
+                         http.get_stats())
+
+
+class KeepAliveHttpInitTest(base.TestCase):
+
+    def test_init(self):
+        http = rbac_http.KeepAliveHttp(
+            disable_ssl_certificate_validation=True, timeout=10,
+            follow_redirects=False, maxsize=3)
+
+        self.assertIsInstance(http, tempest_http.ClosingHttp)
+        self.assertFalse(http.follow_redirects)
+        self.assertEqual(3, http.connection_pool_kw['maxsize'])
+        self.assertEqual('CERT_NONE', http.connection_pool_kw['cert_reqs'])
+        self.assertEqual(10, http.connection_pool_kw['timeout'])
+
+    def test_init_without_follow_redirects_support(self):
+        # Before Tempest 20.0.0, ClosingHttp does not accept
+        # follow_redirects.
+        def old_init(self, disable_ssl_certificate_validation=False,
+                     ca_certs=None, timeout=None):
+            kwargs = {}
+            if timeout:
+                kwargs['timeout'] = timeout
+            urllib3.PoolManager.__init__(self, **kwargs)
+
+        self.useFixture(fixtures.MockPatchObject(
+            tempest_http.ClosingHttp, '__init__', old_init))
+
+        http = rbac_http.KeepAliveHttp(timeout=10, maxsize=2)
+
+        self.assertTrue(http.follow_redirects)
+        self.assertEqual(2, http.connection_pool_kw['maxsize'])
+
+
+class SharedHttpTest(base.TestCase):
+
+    def setUp(self):
+        super(SharedHttpTest, self).setUp()
+        rbac_http.reset_shared_http()
+        self.addCleanup(rbac_http.reset_shared_http)
+
+    def test_share_connections(self):
+        clients = [mock.Mock(), mock.Mock()]
+        for client in clients:
+            self.assertIs(client, rbac_http.share_connections(client))
+
+        self.assertIsInstance(clients[0].http_obj, rbac_http.KeepAliveHttp)
+        self.assertIs(clients[0].http_obj, clients[1].http_obj)
+        self.assertIs(clients[0].http_obj, rbac_http.get_shared_http())
+        self.assertEqual({'requests': 0, 'connections': 0, 'reused': 0},
+                         rbac_http.get_http_stats())
+
+    def test_share_connections_disabled(self):
+        CONF.set_override('keystone_http_pool_size', 0, group='rbac')
+        self.addCleanup(CONF.clear_override, 'keystone_http_pool_size',
+                        group='rbac')
+        client = mock.Mock()
+        http_obj = client.http_obj
+
+        rbac_http.share_connections(client)
+
+        self.assertIs(http_obj, client.http_obj)
+        self.assertIsNone(rbac_http.get_shared_http())
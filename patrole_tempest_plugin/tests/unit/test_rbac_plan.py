@@ -0,0 +1,162 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import os
+import types
+
+from tempest import config
+from tempest import test
+from tempest.tests import base
+
+from patrole_tempest_plugin.cmd import rbac_plan
+from patrole_tempest_plugin import rbac_policy_parser
+from patrole_tempest_plugin import rbac_rule_validation as rbac_rv
+
+CONF = config.CONF
+
+
+class RbacPlanTest(base.TestCase):
+
+    def setUp(self):
+        super(RbacPlanTest, self).setUp()
+        current_directory = os.path.dirname(os.path.realpath(__file__))
+        custom_policy_file = os.path.join(current_directory, 'resources',
+                                          'custom_rbac_policy.json')
+        CONF.set_override('nova_policy_file', custom_policy_file,
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'nova_policy_file',
+                        group='rbac')
+
+        # Let build_plan seed the available services.
+        parser_class = rbac_policy_parser.RbacPolicyParser
+        if 'available_services' in vars(parser_class):
+            self.addCleanup(setattr, parser_class, 'available_services',
+                            parser_class.available_services)
+            del parser_class.available_services
+        self.addCleanup(self._remove_available_services)
+
+        rbac_policy_parser.invalidate_policy_cache()
+        self.addCleanup(rbac_policy_parser.invalidate_policy_cache)
+
+    def _remove_available_services(self):
+        if 'available_services' in vars(rbac_policy_parser.RbacPolicyParser):
+            del rbac_policy_parser.RbacPolicyParser.available_services
+
+    def _get_fake_module(self):
+        class FakeRbacTest(test.BaseTestCase):
+
+            @rbac_rv.action(service='nova', rule='policy_action_1')
+            def test_even(self):
+                pass
+
+            @rbac_rv.action(service='nova', rule='missing_action')
+            def test_missing(self):
+                pass
+
+            @rbac_rv.action(service='nova', admin_only=True)
+            def test_admin_only(self):
+                pass
+
+            def test_not_rbac(self):
+                pass
+
+        module = types.ModuleType('fake_rbac_tests')
+        FakeRbacTest.__module__ = module.__name__
+        module.FakeRbacTest = FakeRbacTest
+        # Classes imported from other modules are not reported twice.
+        module.BaseTestCase = test.BaseTestCase
+        return module
+
+    def test_find_rbac_tests(self):
+        tests = list(rbac_plan.find_rbac_tests([self._get_fake_module()]))
+
+        self.assertEqual(
+            ['fake_rbac_tests.FakeRbacTest.test_admin_only',
+             'fake_rbac_tests.FakeRbacTest.test_even',
+             'fake_rbac_tests.FakeRbacTest.test_missing'],
+            [test_id for test_id, _ in tests])
+        self.assertEqual(
+            rbac_rv.RbacAction('nova', 'policy_action_1', False, 403, {}),
+            tests[1][1])
+
+    def test_build_plan(self):
+        tests = rbac_plan.find_rbac_tests([self._get_fake_module()])
+
+        plan = rbac_plan.build_plan(tests, ['two', 'three', 'admin'])
+
+        # The services assumed to be deployed do not outlive the plan.
+        self.assertNotIn('available_services',
+                         vars(rbac_policy_parser.RbacPolicyParser))
+        outcomes = dict((entry['test'].rsplit('.', 1)[1], entry['outcomes'])
+                        for entry in plan)
+        self.assertEqual(
+            {'test_admin_only': {'two': 'deny', 'three': 'deny',
+                                 'admin': 'allow'},
+             'test_even': {'two': 'allow', 'three': 'deny',
+                           'admin': 'deny'},
+             'test_missing': {'two': 'skip', 'three': 'skip',
+                              'admin': 'skip'}},
+            outcomes)
+
+    def test_build_plan_keeps_available_services(self):
+        rbac_policy_parser.RbacPolicyParser.available_services = ['glance']
+        tests = rbac_plan.find_rbac_tests([self._get_fake_module()])
+
+        plan = rbac_plan.build_plan(tests, ['two'])
+
+        self.assertEqual(
+            ['glance'], rbac_policy_parser.RbacPolicyParser.available_services)
+        self.assertEqual('error', plan[1]['outcomes']['two'])
+
+    @mock.patch.object(rbac_plan.sys, 'stderr')
+    @mock.patch.object(rbac_plan.sys, 'stdout')
+    @mock.patch.object(rbac_plan, 'CONF')
+    @mock.patch.object(rbac_plan, 'import_modules', autospec=True,
+                       return_value=([], []))
+    def test_main_sets_config_path_first(self, mock_import_modules,
+                                         mock_conf, *args):
+        calls = mock.Mock()
+        calls.attach_mock(mock_conf.set_config_path, 'set_config_path')
+        calls.attach_mock(mock_import_modules, 'import_modules')
+
+        self.assertEqual(0, rbac_plan.main(
+            ['--config-file', '/etc/tempest/tempest.conf', '--role', 'two']))
+
+        # The configuration file is set before the test modules, which may
+        # read the configuration, are imported.
+        self.assertEqual(
+            [mock.call.set_config_path('/etc/tempest/tempest.conf'),
+             mock.call.import_modules(['patrole_tempest_plugin.tests.api'])],
+            calls.mock_calls)
+
+    def test_build_plan_strict_policy_check(self):
+        CONF.set_override('strict_policy_check', True, group='rbac')
+        self.addCleanup(CONF.clear_override, 'strict_policy_check',
+                        group='rbac')
+        tests = rbac_plan.find_rbac_tests([self._get_fake_module()])
+
+        plan = rbac_plan.build_plan(tests, ['two'])
+
+        self.assertEqual('error', plan[-1]['outcomes']['two'])
+
+    def test_format_table(self):
+        plan = [{'test': 'module.Class.test_a', 'rule': 'policy_action_1',
+                 'outcomes': {'two': 'allow', 'three': 'deny'}}]
+
+        self.assertEqual(
+            'test                 rule             two    three\n'
+            'module.Class.test_a  policy_action_1  allow  deny\n',
+            rbac_plan.format_table(plan, ['two', 'three']))
@@ -0,0 +1,175 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from oslo_policy import policy
+
+from tempest.tests import base
+
+from patrole_tempest_plugin import rbac_exceptions
+from patrole_tempest_plugin import rbac_policy_compiler
+
+
+class RoleMasksTest(base.TestCase):
+
+    rules = {
+        'admin_rule': 'role:admin',
+        'member_rule': 'role:Member',
+        'admin_or_member': 'rule:admin_rule or rule:member_rule',
+        'admin_and_member': 'role:admin and role:member',
+        'not_admin': 'not rule:admin_rule',
+        'allow_all': '@',
+        'deny_all': '!',
+        'empty': '',
+        'undefined_rule': 'rule:does_not_exist',
+        'owner': 'project_id:%(project_id)s',
+        'admin_or_owner': 'role:admin or rule:owner',
+        'target_role': 'role:%(role)s',
+        'cycle_a': 'rule:cycle_b',
+        'cycle_b': 'rule:cycle_a',
+    }
+
+    def setUp(self):
+        super(RoleMasksTest, self).setUp()
+        self.role_masks = rbac_policy_compiler.RoleMasks(
+            policy.Rules.from_dict(self.rules))
+
+    def _oslo_allowed(self, rules, rule_name, role):
+        class Object(object):
+            pass
+        o = Object()
+        o.rules = rules
+        return bool(rules[rule_name]({}, {'roles': [role]}, o))
+
+    def test_role_table(self):
+        self.assertEqual({'admin': 1, 'member': 2},
+                         self.role_masks.roles)
+        # Roles not referenced by the policy share a single bit.
+        self.assertEqual(4, self.role_masks.role_bit('reader'))
+        self.assertEqual(4, self.role_masks.role_bit('other'))
+        self.assertEqual(1, self.role_masks.role_bit('ADMIN'))
+
+    def test_role_only_rules_match_oslo_policy(self):
+        rules = policy.Rules.from_dict(self.rules)
+        role_only_rules = ['admin_rule', 'member_rule', 'admin_or_member',
+                           'admin_and_member', 'not_admin', 'allow_all',
+                           'deny_all', 'empty', 'undefined_rule']
+        for rule_name in role_only_rules:
+            for role in ['admin', 'Member', 'member', 'reader']:
+                self.assertEqual(
+                    self._oslo_allowed(rules, rule_name, role),
+                    self.role_masks.is_allowed(rule_name, role),
+                    '%s: %s' % (rule_name, role))
+
+    def test_non_role_only_rules_are_not_compiled(self):
+        for rule_name in ['owner', 'admin_or_owner', 'target_role',
+                          'cycle_a', 'cycle_b']:
+            self.assertNotIn(rule_name, self.role_masks.masks)
+            self.assertIsNone(
+                self.role_masks.is_allowed(rule_name, 'admin'))
+
+    def test_undefined_rule_uses_default_rule(self):
+        role_masks = rbac_policy_compiler.RoleMasks(policy.Rules.from_dict(
+            {'default': 'role:admin', 'rule': 'rule:does_not_exist'},
+            'default'))
+
+        self.assertTrue(role_masks.is_allowed('rule', 'admin'))
+        self.assertFalse(role_masks.is_allowed('rule', 'Member'))
+        # The undefined rule itself is not compiled.
+        self.assertNotIn('does_not_exist', role_masks.masks)
+        self.assertIsNone(role_masks.is_allowed('does_not_exist', 'admin'))
+
+
+class CheckGraphTest(base.TestCase):
+
+    rules = {
+        'context_is_admin': 'role:admin',
+        'owner': 'project_id:%(project_id)s',
+        'admin_or_owner': 'rule:context_is_admin or rule:owner',
+        'admin_and_owner': 'rule:context_is_admin and rule:owner',
+        'admin_api': 'is_admin:True',
+        'not_owner': 'not rule:owner',
+        'deep': 'rule:admin_or_owner and (rule:admin_api or rule:owner)',
+        'undefined_rule': 'rule:does_not_exist',
+        'allow_all': '@',
+        'cycle_a': 'rule:cycle_b',
+        'cycle_b': 'rule:cycle_a',
+        'references_cycle': 'role:admin or rule:cycle_a',
+    }
+
+    def setUp(self):
+        super(CheckGraphTest, self).setUp()
+        self.policy_rules = policy.Rules.from_dict(self.rules)
+        self.check_graph = rbac_policy_compiler.CheckGraph(self.policy_rules)
+
+        class Object(object):
+            pass
+        self.enforcer = Object()
+        self.enforcer.rules = self.policy_rules
+
+    def _get_creds(self, role, is_admin=False):
+        return {'roles': [role], 'project_id': 'project_id',
+                'is_admin': is_admin}
+
+    def test_evaluation_matches_oslo_policy(self):
+        # oslo.policy recurses endlessly on rules referencing a cycle.
+        excluded_rules = set(self.check_graph.circular_rules)
+        excluded_rules.add('references_cycle')
+        rule_names = set(self.rules) - excluded_rules
+        for target_project_id in ['project_id', 'other_project_id']:
+            target = {'project_id': target_project_id}
+            for role, is_admin in [('admin', True), ('Member', False)]:
+                creds = self._get_creds(role, is_admin)
+                for name in rule_names:
+                    expected = bool(self.policy_rules[name](
+                        target, creds, self.enforcer))
+                    actual = bool(self.check_graph.evaluate(
+                        name, target, creds, self.enforcer))
+                    self.assertEqual(expected, actual,
+                                     '%s: %s' % (name, role))
+
+    def test_referenced_rules_are_shared(self):
+        admin_or_owner = self.check_graph._nodes['admin_or_owner'].node
+        admin_and_owner = self.check_graph._nodes['admin_and_owner'].node
+
+        self.assertIs(self.check_graph._nodes['context_is_admin'],
+                      admin_or_owner.nodes[0])
+        self.assertIs(admin_or_owner.nodes[0], admin_and_owner.nodes[0])
+        self.assertIs(admin_or_owner.nodes[1], admin_and_owner.nodes[1])
+
+    def test_referenced_rules_are_evaluated_once(self):
+        owner_check = self.policy_rules['owner']
+        with mock.patch.object(type(owner_check), '__call__', autospec=True,
+                               return_value=False) as mock_check:
+            # "owner" is referenced twice by "deep", but only evaluated once.
+            self.check_graph.evaluate(
+                'deep', {'project_id': 'project_id'},
+                self._get_creds('Member'), self.enforcer)
+
+        self.assertEqual(1, mock_check.call_count)
+
+    def test_circular_references_are_detected(self):
+        self.assertEqual(['cycle_a', 'cycle_b'],
+                         sorted(self.check_graph.circular_rules))
+
+        e = self.assertRaises(rbac_exceptions.RbacParsingException,
+                              self.check_graph.evaluate, 'references_cycle',
+                              {}, self._get_creds('Member'), self.enforcer)
+        self.assertIn('contains a circular reference', str(e))
+        # Short-circuiting avoids the cycle, like with oslo.policy.
+        self.assertTrue(self.check_graph.evaluate(
+            'references_cycle', {}, self._get_creds('admin'),
+            self.enforcer))
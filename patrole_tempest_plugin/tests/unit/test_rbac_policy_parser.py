@@ -16,6 +16,9 @@
 import json
 import mock
 import os
+import time
+
+import fixtures
 
 from tempest import config
 from tempest.tests import base
@@ -34,6 +37,8 @@ class RbacPolicyTest(base.TestCase):
             rbac_policy_parser, 'credentials').start()
         self.mock_path = mock.patch.object(
             rbac_policy_parser, 'os').start()
+        mock.patch.object(rbac_policy_parser.RbacPolicyParser,
+                          '_services_client', None).start()
 
         current_directory = os.path.dirname(os.path.realpath(__file__))
         self.custom_policy_file = os.path.join(current_directory,
@@ -78,6 +83,9 @@ class RbacPolicyTest(base.TestCase):
             identity_services_v3_client.list_services.return_value = \
             services
 
+        rbac_policy_parser.invalidate_policy_cache()
+        self.addCleanup(rbac_policy_parser.invalidate_policy_cache)
+
     def _get_fake_policy_rule(self, name, rule):
         fake_rule = mock.Mock(check=rule)
         fake_rule.name = name
@@ -214,6 +222,8 @@ class RbacPolicyTest(base.TestCase):
             self.assertTrue(allowed)
 
         # Check whether _try_rule is called with the correct target dictionary.
+        # Cached decisions are cleared first, so that every rule is evaluated.
+        rbac_policy_parser._decision_cache.clear()
         with mock.patch.object(
             parser, '_try_rule', return_value=True, autospec=True) \
             as mock_try_rule:
@@ -331,11 +341,8 @@ class RbacPolicyTest(base.TestCase):
         parser = rbac_policy_parser.RbacPolicyParser(
             test_tenant_id, test_user_id, "test_service")
 
-        policy_data = parser._get_policy_data('fake_service')
+        actual_policy_data = parser._get_policy_data('fake_service')
 
-        self.assertIsInstance(policy_data, str)
-
-        actual_policy_data = json.loads(policy_data)
         expected_policy_data = {
             "code_policy_action_1": "rule:code_rule_1",
             "code_policy_action_2": "rule:code_rule_2",
@@ -375,11 +382,8 @@ class RbacPolicyTest(base.TestCase):
         parser = rbac_policy_parser.RbacPolicyParser(
             test_tenant_id, test_user_id, "test_service")
 
-        policy_data = parser._get_policy_data('fake_service')
-
-        self.assertIsInstance(policy_data, str)
+        actual_policy_data = parser._get_policy_data('fake_service')
 
-        actual_policy_data = json.loads(policy_data)
         expected_policy_data = {
             "code_policy_action_3": "rule:code_rule_3",
             "rule1": "tenant_id:%(network:tenant_id)s",
@@ -416,7 +420,7 @@ class RbacPolicyTest(base.TestCase):
     @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
     def test_get_policy_data_without_valid_policy(self, mock_stevedore,
                                                   mock_json):
-        self.mock_path.path.isfile.return_value = False
+        self.mock_path.path.join.return_value = self.tenant_policy_file
 
         test_policy_action = mock.Mock(check='rule:bar')
         test_policy_action.configure_mock(name='foo')
@@ -427,7 +431,8 @@ class RbacPolicyTest(base.TestCase):
         mock_stevedore.named.NamedExtensionManager\
             .return_value = [test_policy]
 
-        mock_json.dumps.side_effect = ValueError
+        # Policy rules must be strings.
+        mock_json.loads.return_value = {'rule1': 1}
 
         e = self.assertRaises(rbac_exceptions.RbacParsingException,
                               rbac_policy_parser.RbacPolicyParser,
@@ -460,3 +465,428 @@ class RbacPolicyTest(base.TestCase):
                                               self.tenant_policy_file)
 
         self.assertIn(expected_error, str(e))
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_get_policy_data_from_snapshot(self, mock_stevedore):
+        snapshot_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'snapshot.json')
+        with open(snapshot_file, 'w') as f:
+            json.dump({'test_service': {'code_policy_action_1': 'role:admin'},
+                       'other_service': {'code_policy_action_2': '@'}}, f)
+        CONF.set_override('policy_snapshot_file', snapshot_file,
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'policy_snapshot_file',
+                        group='rbac')
+
+        self.mock_path.path.join.return_value = self.admin_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+
+        self.assertTrue(parser.allowed('code_policy_action_1', 'admin'))
+        self.assertFalse(parser.allowed('code_policy_action_1', 'Member'))
+        self.assertNotIn('code_policy_action_2', parser.rules)
+        # Service code is never imported when a snapshot is used.
+        mock_stevedore.named.NamedExtensionManager.assert_not_called()
+
+    def test_get_policy_data_from_invalid_snapshot(self):
+        snapshot_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'snapshot.json')
+        with open(snapshot_file, 'w') as f:
+            f.write('{"test_service": ')
+        CONF.set_override('policy_snapshot_file', snapshot_file,
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'policy_snapshot_file',
+                        group='rbac')
+
+        self.mock_path.path.join.return_value = self.admin_policy_file
+        e = self.assertRaises(rbac_exceptions.RbacParsingException,
+                              rbac_policy_parser.RbacPolicyParser,
+                              None, None, 'test_service')
+        self.assertIn('Failed to read policy snapshot file %s'
+                      % snapshot_file, str(e))
+
+    def test_role_only_rules_bypass_oslo_policy(self):
+        self.mock_path.path.join.return_value = self.alt_admin_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        with mock.patch.object(parser, '_try_rule',
+                               autospec=True) as mock_try_rule:
+            self.assertTrue(parser.allowed('admin_rule', 'super_admin'))
+            self.assertFalse(parser.allowed('admin_rule', 'fake_admin'))
+            self.assertTrue(parser.allowed('non_admin_rule', 'fake_admin'))
+
+        mock_try_rule.assert_not_called()
+
+    def test_admin_context_is_evaluated_once_per_role(self):
+        # Never reuse a cached policy decision.
+        self.useFixture(fixtures.MockPatchObject(
+            rbac_policy_parser._decision_cache, 'get', return_value=None))
+        self.mock_path.path.join.return_value = self.alt_admin_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+        other_parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        # Force every check through oslo.policy.
+        self.useFixture(fixtures.MockPatchObject(
+            rbac_policy_parser.RbacPolicyParser, '_get_role_masks',
+            return_value=None))
+        mock_allowed = self.useFixture(fixtures.MockPatchObject(
+            rbac_policy_parser.RbacPolicyParser, '_allowed', autospec=True,
+            side_effect=rbac_policy_parser.RbacPolicyParser._allowed)).mock
+        for _ in range(2):
+            for p in (parser, other_parser):
+                self.assertTrue(p.allowed('admin_rule', 'super_admin'))
+                self.assertFalse(p.allowed('admin_rule', 'fake_admin'))
+                self.assertTrue(p.allowed('non_admin_rule', 'fake_admin'))
+
+        admin_context_calls = [
+            c for c in mock_allowed.call_args_list
+            if c[1]['apply_rule'] == 'context_is_admin']
+        self.assertEqual(2, len(admin_context_calls))
+        self.assertEqual(12 + 2, mock_allowed.call_count)
+
+    def test_allowed_caches_decisions(self):
+        self.mock_path.path.join.return_value = self.tenant_policy_file
+        rbac_policy_parser._decision_cache.reset_stats()
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        with mock.patch.object(parser, '_try_rule', autospec=True,
+                               return_value=True) as mock_try_rule:
+            for _ in range(3):
+                self.assertTrue(parser.allowed('rule1', 'Member'))
+            self.assertTrue(parser.allowed('rule1', 'admin'))
+
+        self.assertEqual(2, mock_try_rule.call_count)
+        self.assertEqual({'hits': 2, 'misses': 2, 'size': 2},
+                         rbac_policy_parser.get_decision_cache_stats())
+
+    def test_allowed_decisions_depend_on_target(self):
+        self.mock_path.path.join.return_value = self.tenant_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+        other_parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service",
+            extra_target_data={'user_id': mock.sentinel.other_user_id})
+
+        self.assertTrue(parser.allowed('rule4', 'Member'))
+        self.assertFalse(other_parser.allowed('rule4', 'Member'))
+
+    def test_allowed_decision_cache_disabled(self):
+        CONF.set_override('policy_decision_cache_size', 0, group='rbac')
+        self.addCleanup(CONF.clear_override, 'policy_decision_cache_size',
+                        group='rbac')
+        self.mock_path.path.join.return_value = self.tenant_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        with mock.patch.object(parser, '_try_rule', autospec=True,
+                               return_value=True) as mock_try_rule:
+            for _ in range(3):
+                self.assertTrue(parser.allowed('rule1', 'Member'))
+
+        self.assertEqual(3, mock_try_rule.call_count)
+        self.assertEqual(
+            0, rbac_policy_parser.get_decision_cache_stats()['size'])
+
+    def test_decision_cache_is_bounded(self):
+        CONF.set_override('policy_decision_cache_size', 2, group='rbac')
+        self.addCleanup(CONF.clear_override, 'policy_decision_cache_size',
+                        group='rbac')
+        decision_cache = rbac_policy_parser.DecisionCache()
+
+        decision_cache.set('a', True)
+        decision_cache.set('b', False)
+        decision_cache.get('a')
+        decision_cache.set('c', True)
+
+        # 'b' is the least recently used decision.
+        self.assertIsNone(decision_cache.get('b'))
+        self.assertTrue(decision_cache.get('a'))
+        self.assertTrue(decision_cache.get('c'))
+
+    def test_undefined_action_referenced_by_rule_is_not_found(self):
+        policy_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'policy.json')
+        with open(policy_file, 'w') as f:
+            json.dump({'default': 'role:admin',
+                       'policy_action': 'rule:undefined_action'}, f)
+        self.mock_path.path.join.return_value = policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        # The reference resolves to the default rule, but the undefined
+        # action itself does not exist.
+        self.assertTrue(parser.allowed('policy_action', 'admin'))
+        self.assertRaises(rbac_exceptions.RbacParsingException,
+                          parser.allowed, 'undefined_action', 'admin')
+
+    def test_admin_contexts_are_bounded(self):
+        CONF.set_override('policy_decision_cache_size', 2, group='rbac')
+        self.addCleanup(CONF.clear_override, 'policy_decision_cache_size',
+                        group='rbac')
+        self.mock_path.path.join.return_value = self.alt_admin_policy_file
+
+        for user_id in ('user_a', 'user_b', 'user_c'):
+            parser = rbac_policy_parser.RbacPolicyParser(
+                mock.sentinel.tenant_id, user_id, "test_service")
+            parser._is_admin_context('admin')
+
+        self.assertEqual(
+            2, parser._compiled_policy.admin_contexts.stats()['size'])
+
+    def test_invalidate_policy_cache_clears_decisions(self):
+        self.mock_path.path.join.return_value = self.tenant_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+        parser.allowed('rule1', 'Member')
+        self.assertEqual(
+            1, rbac_policy_parser.get_decision_cache_stats()['size'])
+
+        rbac_policy_parser.invalidate_policy_cache('test_service')
+
+        self.assertEqual(
+            0, rbac_policy_parser.get_decision_cache_stats()['size'])
+
+    def _clear_available_services(self):
+        if 'available_services' in vars(rbac_policy_parser.RbacPolicyParser):
+            available_services = \
+                rbac_policy_parser.RbacPolicyParser.available_services
+            del rbac_policy_parser.RbacPolicyParser.available_services
+            self.addCleanup(setattr, rbac_policy_parser.RbacPolicyParser,
+                            'available_services', available_services)
+
+    def test_validate_service_with_registered_client(self):
+        self._clear_available_services()
+        services_client = mock.Mock(**{
+            'list_services.return_value': {'services': [{'name': 'nova'}]}})
+        rbac_policy_parser.RbacPolicyParser.set_services_client(
+            services_client)
+
+        rbac_policy_parser.RbacPolicyParser.validate_service('nova')
+
+        services_client.list_services.assert_called_once_with()
+        self.mock_admin_mgr.AdminManager.assert_not_called()
+        self.assertRaises(rbac_exceptions.RbacInvalidService,
+                          rbac_policy_parser.RbacPolicyParser.validate_service,
+                          'glance')
+
+    def test_policy_is_loaded_without_checking_service(self):
+        self._clear_available_services()
+        self.mock_path.path.join.return_value = self.custom_policy_file
+
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, 'undeployed_service', check_service=False)
+
+        self.assertIn('policy_action_1', parser.rules)
+        self.assertNotIn('available_services',
+                         vars(rbac_policy_parser.RbacPolicyParser))
+        self.mock_admin_mgr.AdminManager.assert_not_called()
+
+    def test_available_services_are_shared_through_cache_dir(self):
+        self._clear_available_services()
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        CONF.set_override('cache_dir', cache_dir, group='rbac')
+        self.addCleanup(CONF.clear_override, 'cache_dir', group='rbac')
+
+        rbac_policy_parser.RbacPolicyParser.validate_service('nova')
+        # Simulate another worker process, with no services in memory.
+        del rbac_policy_parser.RbacPolicyParser.available_services
+        rbac_policy_parser.RbacPolicyParser.validate_service('nova')
+
+        self.assertEqual(
+            1, self.mock_admin_mgr.AdminManager.return_value.
+            identity_services_v3_client.list_services.call_count)
+
+        # Expired entries are refreshed.
+        CONF.set_override('service_catalog_cache_ttl', 0, group='rbac')
+        self.addCleanup(CONF.clear_override, 'service_catalog_cache_ttl',
+                        group='rbac')
+        del rbac_policy_parser.RbacPolicyParser.available_services
+        with mock.patch.object(rbac_policy_parser.rbac_cache.time, 'time',
+                               return_value=time.time() + 1):
+            rbac_policy_parser.RbacPolicyParser.validate_service('nova')
+
+        self.assertEqual(
+            2, self.mock_admin_mgr.AdminManager.return_value.
+            identity_services_v3_client.list_services.call_count)
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_compiled_policy_is_shared_through_cache_dir(self,
+                                                         mock_stevedore):
+        mock_stevedore.named.NamedExtensionManager.return_value = None
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        CONF.set_override('cache_dir', cache_dir, group='rbac')
+        self.addCleanup(CONF.clear_override, 'cache_dir', group='rbac')
+        self.mock_path.path.join.return_value = self.custom_policy_file
+
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+        # Simulate another worker process, with an empty in-memory cache.
+        rbac_policy_parser.invalidate_policy_cache()
+        with mock.patch.object(rbac_policy_parser.RbacPolicyParser,
+                               '_get_policy_data',
+                               autospec=True) as mock_get_policy_data:
+            second_parser = rbac_policy_parser.RbacPolicyParser(
+                None, None, "test_service")
+
+        mock_get_policy_data.assert_not_called()
+        # The in-code policy defaults are not loaded to look up the cache.
+        mock_stevedore.named.NamedExtensionManager.assert_called_once_with(
+            'oslo.policy.policies', names=['test_service'],
+            on_load_failure_callback=None, invoke_on_load=True,
+            warn_on_missing_entrypoint=False)
+        self.assertIsNot(parser.rules, second_parser.rules)
+        self.assertEqual(str(parser.rules), str(second_parser.rules))
+        self.assertTrue(second_parser.allowed('policy_action_3', 'zero'))
+
+        # The policy data is cached as JSON.
+        entries = os.listdir(cache_dir)
+        self.assertEqual(1, len(entries))
+        self.assertTrue(entries[0].endswith('.json'))
+        self.assertEqual(
+            'rule:zero_rule',
+            rbac_policy_parser.rbac_cache.load_json(entries[0])[
+                'policy_action_3'])
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_corrupt_cached_policy_is_rebuilt(self, mock_stevedore):
+        mock_stevedore.named.NamedExtensionManager.return_value = None
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        CONF.set_override('cache_dir', cache_dir, group='rbac')
+        self.addCleanup(CONF.clear_override, 'cache_dir', group='rbac')
+        self.mock_path.path.join.return_value = self.custom_policy_file
+
+        rbac_policy_parser.RbacPolicyParser(None, None, "test_service")
+        rbac_policy_parser.invalidate_policy_cache()
+        for entry in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, entry), 'ab') as f:
+                f.write(b'garbage')
+
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+
+        self.assertTrue(parser.allowed('policy_action_3', 'zero'))
+        # The corrupt entry was replaced by a valid one.
+        rbac_policy_parser.invalidate_policy_cache()
+        with mock.patch.object(rbac_policy_parser.RbacPolicyParser,
+                               '_get_policy_data',
+                               autospec=True) as mock_get_policy_data:
+            rbac_policy_parser.RbacPolicyParser(None, None, "test_service")
+        mock_get_policy_data.assert_not_called()
+
+    def test_permission_matrix(self):
+        self.mock_path.path.join.return_value = self.admin_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        roles = ['admin', 'Member', 'other']
+        matrix = parser.permission_matrix(roles)
+
+        self.assertEqual(tuple(roles), matrix.roles)
+        self.assertEqual(('admin_rule', 'alt_admin_rule', 'is_admin_rule',
+                          'non_admin_rule'), matrix.actions)
+        self.assertEqual([(True, False, False),
+                          (True, False, False),
+                          (True, False, False),
+                          (False, True, False)], matrix.allowed)
+
+        # The matrix agrees with evaluating each combination separately.
+        for i, action in enumerate(matrix.actions):
+            for j, role in enumerate(matrix.roles):
+                self.assertEqual(parser.allowed(action, role),
+                                 matrix.allowed[i][j])
+
+    def test_permission_matrix_with_actions(self):
+        self.mock_path.path.join.return_value = self.custom_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        matrix = parser.permission_matrix(
+            ['zero', 'one', 'two'], actions=['policy_action_1',
+                                             'policy_action_3'])
+
+        self.assertEqual(('policy_action_1', 'policy_action_3'),
+                         matrix.actions)
+        self.assertEqual([(False, False, True), (True, False, False)],
+                         matrix.allowed)
+
+    def test_permission_matrix_with_unknown_action(self):
+        self.mock_path.path.join.return_value = self.custom_policy_file
+        parser = rbac_policy_parser.RbacPolicyParser(
+            mock.sentinel.tenant_id, mock.sentinel.user_id, "test_service")
+
+        self.assertRaises(rbac_exceptions.RbacParsingException,
+                          parser.permission_matrix, ['zero'],
+                          actions=['fake_rule'])
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_get_rules_does_not_serialize_policy_data(self, mock_stevedore):
+        mock_stevedore.named.NamedExtensionManager.return_value = None
+        self.mock_path.path.join.return_value = self.custom_policy_file
+
+        with mock.patch.object(rbac_policy_parser.json, 'dumps',
+                               autospec=True) as mock_dumps:
+            parser = rbac_policy_parser.RbacPolicyParser(
+                None, None, "test_service")
+
+        mock_dumps.assert_not_called()
+        self.assertTrue(parser.allowed('policy_action_3', 'zero'))
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_policy_cache_reuses_compiled_rules(self, mock_stevedore):
+        mock_stevedore.named.NamedExtensionManager.return_value = None
+        self.mock_path.path.join.return_value = self.custom_policy_file
+        rbac_policy_parser._policy_cache.reset_stats()
+
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+        second_parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+
+        self.assertIs(parser.rules, second_parser.rules)
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1},
+                         rbac_policy_parser.get_policy_cache_stats())
+        # The in-code policy defaults are only loaded once.
+        mock_stevedore.named.NamedExtensionManager.assert_called_once_with(
+            'oslo.policy.policies',
+            names=['test_service'],
+            on_load_failure_callback=None,
+            invoke_on_load=True,
+            warn_on_missing_entrypoint=False)
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_policy_cache_reparses_modified_policy_file(self,
+                                                        mock_stevedore):
+        mock_stevedore.named.NamedExtensionManager.return_value = None
+        self.mock_path.path.join.return_value = self.custom_policy_file
+        self.mock_path.stat.return_value = mock.Mock(st_mtime=1, st_size=10)
+
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+
+        self.mock_path.stat.return_value = mock.Mock(st_mtime=2, st_size=10)
+        second_parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+
+        self.assertIsNot(parser.rules, second_parser.rules)
+        # The stale entry is evicted.
+        self.assertEqual(
+            1, rbac_policy_parser.get_policy_cache_stats()['size'])
+
+    @mock.patch.object(rbac_policy_parser, 'stevedore', autospec=True)
+    def test_invalidate_policy_cache(self, mock_stevedore):
+        mock_stevedore.named.NamedExtensionManager.return_value = None
+        self.mock_path.path.join.return_value = self.custom_policy_file
+
+        parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+        rbac_policy_parser.invalidate_policy_cache("test_service")
+        second_parser = rbac_policy_parser.RbacPolicyParser(
+            None, None, "test_service")
+
+        self.assertIsNot(parser.rules, second_parser.rules)
+        self.assertEqual(
+            2, mock_stevedore.named.NamedExtensionManager.call_count)
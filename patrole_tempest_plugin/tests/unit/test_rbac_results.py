@@ -0,0 +1,119 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+
+import fixtures
+
+from tempest import config
+from tempest.tests import base
+
+from patrole_tempest_plugin import rbac_results
+
+CONF = config.CONF
+
+
+class ResultRecorderTest(base.TestCase):
+
+    def setUp(self):
+        super(ResultRecorderTest, self).setUp()
+        self.recorder = rbac_results.ResultRecorder()
+        self.directory = self.useFixture(fixtures.TempDir()).path
+
+        rbac_results.reset_baseline()
+        self.addCleanup(rbac_results.reset_baseline)
+
+    def _set_override(self, name, value):
+        CONF.set_override(name, value, group='rbac')
+        self.addCleanup(CONF.clear_override, name, group='rbac')
+
+    def test_write_results(self):
+        path = os.path.join(self.directory, 'results.json')
+        self.recorder.record('module.Class.test_a', 'admin', 'pass', True)
+        self.recorder.record('module.Class.test_a', 'Member', 'fail', False)
+
+        self.recorder.write_results(path)
+
+        with open(path) as results_file:
+            results = json.load(results_file)
+        self.assertEqual(os.getpid(), results['pid'])
+        self.assertEqual(
+            {'module.Class.test_a': {
+                'admin': {'result': 'pass', 'allowed': True},
+                'Member': {'result': 'fail', 'allowed': False}}},
+            results['results'])
+
+        self.recorder.reset()
+        self.assertEqual({}, self.recorder.get_results())
+
+    def test_get_results_path(self):
+        self.assertIsNone(rbac_results.get_results_path())
+
+        self._set_override('results_file', '/tmp/results.json')
+
+        self.assertEqual('/tmp/results.json.%d' % os.getpid(),
+                         rbac_results.get_results_path())
+
+    def test_load_results_merges_workers(self):
+        first = rbac_results.ResultRecorder()
+        first.record('module.Class.test_a', 'admin', 'pass', True)
+        first.write_results(os.path.join(self.directory, 'results.json.1'))
+        second = rbac_results.ResultRecorder()
+        second.record('module.Class.test_a', 'Member', 'pass', False)
+        second.record('module.Class.test_b', 'admin', 'skip', None)
+        second.write_results(os.path.join(self.directory, 'results.json.2'))
+
+        results = rbac_results.load_results(
+            os.path.join(self.directory, 'results.json.*'))
+
+        self.assertEqual(
+            {'module.Class.test_a': {
+                'admin': {'result': 'pass', 'allowed': True},
+                'Member': {'result': 'pass', 'allowed': False}},
+             'module.Class.test_b': {
+                'admin': {'result': 'skip', 'allowed': None}}},
+            results)
+
+    def test_is_inherited(self):
+        baseline = rbac_results.ResultRecorder()
+        baseline.record('module.Class.test_a', 'Member', 'pass', False)
+        baseline.record('module.Class.test_b', 'Member', 'fail', False)
+        baseline.write_results(os.path.join(self.directory, 'results.json.1'))
+
+        self.assertFalse(rbac_results.is_inherited(
+            'module.Class.test_a', 'reader', False, False))
+
+        self._set_override('baseline_results',
+                           os.path.join(self.directory, 'results.json.*'))
+        self._set_override('baseline_role', 'Member')
+
+        self.assertTrue(rbac_results.is_inherited(
+            'module.Class.test_a', 'reader', False, False))
+        # The expected outcome differs from the baseline.
+        self.assertFalse(rbac_results.is_inherited(
+            'module.Class.test_a', 'reader', True, False))
+        # The policy of the baseline role changed since the baseline run.
+        self.assertFalse(rbac_results.is_inherited(
+            'module.Class.test_a', 'reader', True, True))
+        # The test did not pass in the baseline.
+        self.assertFalse(rbac_results.is_inherited(
+            'module.Class.test_b', 'reader', False, False))
+        # The test was not run in the baseline.
+        self.assertFalse(rbac_results.is_inherited(
+            'module.Class.test_c', 'reader', False, False))
+        # The baseline role itself is always run.
+        self.assertFalse(rbac_results.is_inherited(
+            'module.Class.test_a', 'Member', False, False))
@@ -12,7 +12,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
 import mock
+import testtools
+from testtools import matchers
 
 from tempest import config
 from tempest.lib import exceptions
@@ -21,6 +24,7 @@ from tempest.tests import base
 
 from patrole_tempest_plugin import rbac_exceptions
 from patrole_tempest_plugin import rbac_rule_validation as rbac_rv
+from patrole_tempest_plugin import rbac_timings
 
 CONF = config.CONF
 
@@ -36,6 +40,7 @@ class RBACRuleValidationTest(base.TestCase):
             mock.sentinel.project_id
         self.mock_args.auth_provider.credentials.user_id = \
             mock.sentinel.user_id
+        self.mock_args.id.return_value = 'module.Class.test_a[id-1,Member]'
 
         CONF.set_override('rbac_test_role', 'Member', group='rbac')
         self.addCleanup(CONF.clear_override, 'rbac_test_role', group='rbac')
@@ -332,3 +337,289 @@ class RBACRuleValidationTest(base.TestCase):
                 "codes: [403, 404]")
 
             mock_log.error.reset_mock()
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_adds_switch_role_timings(self, mock_policy):
+        mock_policy.RbacPolicyParser.return_value.allowed.return_value = True
+
+        def switch_role(*args, **kwargs):
+            rbac_timings.collector.record('set_auth', 1.0)
+        self.mock_args.rbac_utils.switch_role.side_effect = switch_role
+
+        decorator = rbac_rv.action(mock.sentinel.service, mock.sentinel.action)
+        wrapper = decorator(mock.Mock())
+        wrapper(self.mock_args)
+
+        self.mock_args.addDetail.assert_called_once_with(
+            'switch_role_timings', mock.ANY)
+        detail = self.mock_args.addDetail.call_args[0][1]
+        self.assertEqual(
+            b'{"set_auth": {"count": 1, "total": 1.0, "max": 1.0}}',
+            b''.join(detail.iter_bytes()))
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_without_switch_role_timings(self, mock_policy):
+        mock_policy.RbacPolicyParser.return_value.allowed.return_value = True
+
+        decorator = rbac_rv.action(mock.sentinel.service, mock.sentinel.action)
+        wrapper = decorator(mock.Mock())
+        wrapper(self.mock_args)
+
+        self.mock_args.addDetail.assert_not_called()
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_with_async_role_restore(self, mock_policy):
+        CONF.set_override('async_role_restore', True, group='rbac')
+        self.addCleanup(CONF.clear_override, 'async_role_restore',
+                        group='rbac')
+        mock_policy.RbacPolicyParser.return_value.allowed.return_value = True
+
+        decorator = rbac_rv.action(mock.sentinel.service, mock.sentinel.action)
+        wrapper = decorator(mock.Mock())
+        wrapper(self.mock_args)
+
+        self.mock_args.rbac_utils.start_switch_role.assert_called_once_with(
+            self.mock_args, toggle_rbac_role=False)
+        self.mock_args.rbac_utils.switch_role.assert_not_called()
+        # The switch is waited for by a cleanup of the test that started
+        # it, and before the credentials are read by the next test.
+        wait_for_switch_role = self.mock_args.rbac_utils.wait_for_switch_role
+        self.mock_args.addCleanup.assert_called_once_with(
+            wait_for_switch_role)
+        wait_for_switch_role.assert_called_once_with()
+
+    def test_validation_plan_registered_when_decorating(self):
+        def test_function(self):
+            pass
+
+        wrapper = rbac_rv.action(mock.sentinel.service, mock.sentinel.action,
+                                 expected_error_code=404)(test_function)
+
+        validation_plan = wrapper.rbac_plan
+        self.assertIs(validation_plan,
+                      rbac_rv.get_validation_plan(validation_plan.plan_id))
+        self.assertIn('test_function:', validation_plan.plan_id)
+        self.assertEqual(exceptions.NotFound,
+                         validation_plan.expected_exception)
+        self.assertEqual(validation_plan.rbac_action, wrapper.rbac_action)
+
+    def test_invalid_error_code_fails_when_decorating(self):
+        decorator = rbac_rv.action(mock.sentinel.service, mock.sentinel.action,
+                                   expected_error_code=500)
+
+        self.assertRaises(rbac_exceptions.RbacInvalidErrorCode,
+                          decorator, mock.Mock())
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_validation_plan_is_runnable(self, mock_policy):
+        mock_policy.RbacPolicyParser.return_value.rules = {
+            'existing_action': mock.sentinel.rule}
+
+        def get_plan(**kwargs):
+            return rbac_rv.action(mock.sentinel.service,
+                                  **kwargs)(mock.Mock()).rbac_plan
+
+        self.assertTrue(get_plan(rule='existing_action').is_runnable())
+        self.assertFalse(get_plan(rule='missing_action').is_runnable())
+        self.assertTrue(get_plan(admin_only=True).is_runnable())
+        mock_policy.RbacPolicyParser.assert_called_with(
+            None, None, mock.sentinel.service, check_service=False)
+
+        mock_policy.RbacPolicyParser.side_effect = \
+            rbac_exceptions.RbacParsingException()
+        self.assertFalse(get_plan(rule='existing_action').is_runnable())
+
+    def _get_fake_test_class(self):
+        class FakeRbacTest(test.BaseTestCase):
+
+            @rbac_rv.action(service='nova', rule='missing_action')
+            def test_missing(self):
+                pass
+
+            @rbac_rv.action(service='nova', rule='existing_action')
+            def test_existing(self):
+                pass
+
+            def test_not_rbac(self):
+                pass
+
+        return FakeRbacTest
+
+    @mock.patch.object(rbac_rv.ValidationPlan, 'is_runnable', autospec=True)
+    def test_skip_unless_runnable(self, mock_is_runnable):
+        mock_is_runnable.return_value = False
+        test_class = self._get_fake_test_class()
+
+        self.assertEqual(
+            ['test_existing', 'test_missing'],
+            [validation_plan.plan_id.split(':')[0].rsplit('.', 1)[1]
+             for validation_plan
+             in rbac_rv.get_class_validation_plans(test_class)])
+        self.assertRaises(test_class.skipException,
+                          rbac_rv.skip_unless_runnable, test_class)
+
+        mock_is_runnable.side_effect = \
+            lambda validation_plan: validation_plan.rbac_action.rule == \
+            'existing_action'
+        rbac_rv.skip_unless_runnable(test_class)
+
+    @mock.patch.object(rbac_rv.ValidationPlan, 'is_runnable', autospec=True,
+                       return_value=False)
+    def test_skip_unless_runnable_with_strict_policy_check(
+            self, mock_is_runnable):
+        CONF.set_override('strict_policy_check', True, group='rbac')
+        self.addCleanup(CONF.clear_override, 'strict_policy_check',
+                        group='rbac')
+
+        rbac_rv.skip_unless_runnable(self._get_fake_test_class())
+
+        mock_is_runnable.assert_not_called()
+
+    @mock.patch.object(rbac_rv.ValidationPlan, 'is_runnable', autospec=True,
+                       return_value=False)
+    def test_skip_unless_runnable_without_rbac_tests(self, mock_is_runnable):
+        class FakeTest(test.BaseTestCase):
+            def test_not_rbac(self):
+                pass
+
+        rbac_rv.skip_unless_runnable(FakeTest)
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_sweeps_roles(self, mock_policy):
+        CONF.set_override('rbac_test_roles', ['admin', 'Member', 'reader'],
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'rbac_test_roles', group='rbac')
+        mock_policy.RbacPolicyParser.return_value.allowed.side_effect = \
+            lambda rule, role: role != 'reader'
+        mock_function = mock.Mock()
+
+        wrapper = rbac_rv.action(mock.sentinel.service,
+                                 mock.sentinel.action)(mock_function)
+        e = self.assertRaises(rbac_exceptions.RbacRoleSweepFailed, wrapper,
+                              self.mock_args)
+
+        # The test is run with every role, even after failing with one.
+        self.assertIn('Failed with roles reader', str(e))
+        self.assertEqual(3, mock_function.call_count)
+        self.mock_args.rbac_utils.set_rbac_test_role.assert_has_calls(
+            [mock.call(self.mock_args, 'admin'),
+             mock.call(self.mock_args, 'Member'),
+             mock.call(self.mock_args, 'reader')])
+        mock_policy.RbacPolicyParser.return_value.allowed.assert_has_calls(
+            [mock.call(mock.sentinel.action, 'admin'),
+             mock.call(mock.sentinel.action, 'Member'),
+             mock.call(mock.sentinel.action, 'reader')])
+        self.assertEqual(
+            3, self.mock_args.rbac_utils.switch_role.call_count)
+
+        details = dict(call[0] for call in
+                       self.mock_args.addDetail.call_args_list)
+        self.assertEqual(['rbac_role_results', 'traceback-reader'],
+                         sorted(details))
+        self.assertIn('OverPermission', b''.join(
+            details['traceback-reader'].iter_bytes()).decode('utf-8'))
+        results = json.loads(b''.join(
+            details['rbac_role_results'].iter_bytes()).decode('utf-8'))
+        self.assertEqual(['admin', 'Member', 'reader'], list(results))
+        self.assertEqual('pass', results['admin']['result'])
+        self.assertEqual('pass', results['Member']['result'])
+        self.assertEqual('fail', results['reader']['result'])
+        self.assertIn('OverPermission', results['reader']['reason'])
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_sweep_lists_skipped_roles(self, mock_policy):
+        CONF.set_override('rbac_test_roles', ['admin', 'Member'],
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'rbac_test_roles', group='rbac')
+        mock_policy.RbacPolicyParser.return_value.allowed.return_value = True
+        mock_function = mock.Mock(side_effect=[
+            None, testtools.TestCase.skipException('not supported')])
+
+        wrapper = rbac_rv.action(mock.sentinel.service,
+                                 mock.sentinel.action)(mock_function)
+        wrapper(self.mock_args)
+
+        # A pass with one role does not hide the skip of another.
+        details = dict(call[0] for call in
+                       self.mock_args.addDetail.call_args_list)
+        self.assertEqual(['rbac_role_results', 'rbac_skipped_roles'],
+                         sorted(details))
+        self.assertThat(b''.join(
+            details['rbac_skipped_roles'].iter_bytes()).decode('utf-8'),
+            matchers.StartsWith('Member: not supported'))
+
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_sweep_skipped_with_every_role(self,
+                                                           mock_policy):
+        CONF.set_override('rbac_test_roles', ['admin', 'Member'],
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'rbac_test_roles', group='rbac')
+        mock_policy.RbacPolicyParser.return_value.allowed.side_effect = \
+            rbac_exceptions.RbacParsingException('missing action')
+        mock_function = mock.Mock()
+
+        wrapper = rbac_rv.action(mock.sentinel.service,
+                                 mock.sentinel.action)(mock_function)
+
+        self.assertRaises(testtools.TestCase.skipException, wrapper,
+                          self.mock_args)
+        mock_function.assert_not_called()
+
+    def test_validation_plan_ids_are_unique(self):
+        def test_function(self):
+            pass
+        first_function = test_function
+
+        def test_function(self):
+            pass
+        # Python 2 has no __qualname__ to tell the functions apart.
+        first_function.__qualname__ = test_function.__qualname__
+
+        decorator = rbac_rv.action(mock.sentinel.service,
+                                   mock.sentinel.action)
+        self.assertNotEqual(decorator(first_function).rbac_plan.plan_id,
+                            decorator(test_function).rbac_plan.plan_id)
+
+    @mock.patch.object(rbac_rv, 'rbac_results', autospec=True)
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_records_result(self, mock_policy,
+                                            mock_results):
+        mock_policy.RbacPolicyParser.return_value.allowed.return_value = False
+        mock_results.is_baseline_enabled.return_value = False
+        mock_function = mock.Mock(side_effect=exceptions.Forbidden)
+
+        wrapper = rbac_rv.action(mock.sentinel.service,
+                                 mock.sentinel.action)(mock_function)
+        wrapper(self.mock_args)
+
+        # Results are keyed by the test that ran, without its attributes.
+        mock_results.recorder.record.assert_called_once_with(
+            'module.Class.test_a', 'Member', 'pass', False)
+        mock_results.is_inherited.assert_not_called()
+
+    @mock.patch.object(rbac_rv, 'rbac_results', autospec=True)
+    @mock.patch.object(rbac_rv, 'rbac_policy_parser', autospec=True)
+    def test_rule_validation_inherits_baseline_outcome(self, mock_policy,
+                                                       mock_results):
+        CONF.set_override('baseline_role', 'admin', group='rbac')
+        self.addCleanup(CONF.clear_override, 'baseline_role', group='rbac')
+        mock_policy.RbacPolicyParser.return_value.allowed.side_effect = \
+            lambda rule, role: role == 'admin'
+        mock_results.is_baseline_enabled.return_value = True
+        mock_results.is_inherited.return_value = True
+        mock_function = mock.Mock()
+
+        wrapper = rbac_rv.action(mock.sentinel.service,
+                                 mock.sentinel.action)(mock_function)
+        e = self.assertRaises(testtools.TestCase.skipException, wrapper,
+                              self.mock_args)
+
+        self.assertIn('inherited from baseline role admin', str(e))
+        # The outcome for the baseline role is computed from the current
+        # policy.
+        mock_results.is_inherited.assert_called_once_with(
+            'module.Class.test_a', 'Member', False, True)
+        mock_function.assert_not_called()
+        self.mock_args.rbac_utils.switch_role.assert_not_called()
+        mock_results.recorder.record.assert_called_once_with(
+            'module.Class.test_a', 'Member', 'inherited', False)
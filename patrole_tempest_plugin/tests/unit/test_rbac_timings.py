@@ -0,0 +1,92 @@
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+
+import fixtures
+
+from tempest import config
+from tempest.tests import base
+
+from patrole_tempest_plugin import rbac_timings
+
+CONF = config.CONF
+
+
+class TimingCollectorTest(base.TestCase):
+
+    def setUp(self):
+        super(TimingCollectorTest, self).setUp()
+        self.collector = rbac_timings.TimingCollector()
+
+    def test_record(self):
+        self.collector.record('set_auth', 0.5)
+        self.collector.record('set_auth', 1.5)
+        self.collector.record('clear_auth', 0.25)
+
+        self.assertEqual(
+            {'set_auth': {'count': 2, 'total': 2.0, 'max': 1.5},
+             'clear_auth': {'count': 1, 'total': 0.25, 'max': 0.25}},
+            self.collector.get_stats())
+
+        self.collector.reset()
+        self.assertEqual({}, self.collector.get_stats())
+
+    def test_phase(self):
+        with self.collector.phase('set_auth'):
+            pass
+        try:
+            with self.collector.phase('set_auth'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(2, self.collector.get_stats()['set_auth']['count'])
+
+    def test_capture(self):
+        self.collector.record('set_auth', 1.0)
+        self.collector.start_capture()
+        self.collector.record('clear_auth', 0.5)
+
+        self.assertEqual(
+            {'clear_auth': {'count': 1, 'total': 0.5, 'max': 0.5}},
+            self.collector.stop_capture())
+        self.assertEqual({}, self.collector.stop_capture())
+        self.assertEqual(2, len(self.collector.get_stats()))
+
+    def test_write_report(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'timings.json')
+        self.collector.record('set_auth', 1.0)
+
+        self.collector.write_report(path)
+
+        with open(path) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(os.getpid(), report['pid'])
+        self.assertEqual({'set_auth': {'count': 1, 'total': 1.0, 'max': 1.0}},
+                         report['phases'])
+
+    def test_get_report_path(self):
+        self.assertIsNone(rbac_timings.get_report_path())
+
+        CONF.set_override('timing_report_file', '/tmp/timings.json',
+                          group='rbac')
+        self.addCleanup(CONF.clear_override, 'timing_report_file',
+                        group='rbac')
+
+        self.assertEqual('/tmp/timings.json.%d' % os.getpid(),
+                         rbac_timings.get_report_path())
@@ -13,16 +13,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import threading
+
+import fixtures
 import mock
 import testtools
 
 from tempest import config
 from tempest.lib import base as lib_base
+from tempest.lib.common import rest_client
 from tempest.lib import exceptions as lib_exc
 from tempest.tests import base
 
 from patrole_tempest_plugin import rbac_exceptions
 from patrole_tempest_plugin import rbac_utils
+from patrole_tempest_plugin import rbac_timings
 
 CONF = config.CONF
 
@@ -38,9 +44,11 @@ class RBACUtilsTest(base.TestCase):
 
     @mock.patch.object(rbac_utils, 'credentials', autospec=True,
                        **{'is_admin_available.return_value': True})
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
-    def setUp(self, *args):
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
+    @mock.patch.object(rbac_utils.rbac_policy_parser.RbacPolicyParser,
+                       'set_services_client')
+    def setUp(self, mock_set_services_client, *args):
         super(RBACUtilsTest, self).setUp()
 
         self.mock_test_obj = mock.Mock(spec=lib_base.BaseTestCase)
@@ -51,10 +59,23 @@ class RBACUtilsTest(base.TestCase):
             **{'roles_v3_client.list_roles.return_value': self.available_roles}
         )
         self.mock_test_obj.get_identity_version = mock.Mock(return_value=3)
+        self.mock_test_obj.addClassResourceCleanup = mock.Mock()
 
         with mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role'):
             self.rbac_utils = rbac_utils.RbacUtils(self.mock_test_obj)
+        services_client = \
+            self.mock_test_obj.os_admin.identity_services_v3_client
+        mock_set_services_client.assert_called_once_with(services_client)
+        # The client is only registered while the test class runs.
+        self.mock_test_obj.addClassResourceCleanup.assert_called_once_with(
+            rbac_utils.rbac_policy_parser.RbacPolicyParser.
+            unset_services_client, services_client)
         self.rbac_utils.switch_role_history = {}
+        self.rbac_utils._user_role_ids = {}
+        rbac_utils.invalidate_role_id_cache()
+        self.addCleanup(rbac_utils.invalidate_role_id_cache)
+        self.addCleanup(rbac_utils.rbac_http.reset_shared_http)
+        self.rbac_utils._user_tokens = {}
         self.rbac_utils.admin_role_id = 'admin_id'
         self.rbac_utils.rbac_role_id = 'member_id'
 
@@ -76,8 +97,8 @@ class RBACUtilsTest(base.TestCase):
             **{'roles_client.list_user_roles_on_project.'
                'return_value': {'roles': [{'id': return_value}]}})
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     def test_initialization_with_missing_admin_role(self, _):
         self.mock_test_obj.os_admin = mock.Mock(
             **{'roles_v3_client.list_roles.return_value':
@@ -90,8 +111,8 @@ class RBACUtilsTest(base.TestCase):
         self.assertIn("Role with name 'admin' does not exist in the system.",
                       e.__str__())
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     def test_initialization_with_missing_rbac_role(self, _):
         self.mock_test_obj.os_admin = mock.Mock(
             **{'roles_v3_client.list_roles.return_value':
@@ -104,17 +125,120 @@ class RBACUtilsTest(base.TestCase):
         self.assertIn("Role defined by rbac_test_role does not exist in the "
                       "system.", e.__str__())
 
-    def test_clear_user_roles(self):
+    def _list_roles(self, name=None):
+        return {'roles': [role for role in self.available_roles['roles']
+                          if role['name'] == name]}
+
+    def test_identity_clients_share_connections(self):
+        shared_http = rbac_utils.rbac_http.get_shared_http()
+        self.assertIs(shared_http, self.rbac_utils.roles_client.http_obj)
+        # Tokens of the test user are issued over the same connections.
+        self.assertIs(shared_http,
+                      self.mock_test_obj.auth_provider.auth_client.http_obj)
+
+    @mock.patch.object(rbac_utils, 'credentials', autospec=True,
+                       **{'is_admin_available.return_value': False})
+    def test_initialization_without_admin_credentials(self, _):
+        test_obj = mock.Mock(spec=lib_base.BaseTestCase)
+        test_obj.get_identity_version = mock.Mock(return_value=3)
+
+        self.assertRaises(rbac_exceptions.RbacResourceSetupFailed,
+                          rbac_utils.RbacUtils, test_obj)
+        # The admin client manager is never created.
+        self.assertNotIn('os_admin', dir(test_obj))
+
+    def test_get_roles_filters_by_name_and_caches_role_ids(self):
+        roles_client = mock.Mock(**{'list_roles.side_effect':
+                                    self._list_roles})
+        self.rbac_utils.roles_client = roles_client
+
+        self.rbac_utils._get_roles()
+        other_utils = rbac_utils.RbacUtils.__new__(rbac_utils.RbacUtils)
+        other_utils.roles_client = roles_client
+        other_utils._get_roles()
+
+        roles_client.list_roles.assert_has_calls([
+            mock.call(name='Member'), mock.call(name='admin')])
+        self.assertEqual(2, roles_client.list_roles.call_count)
+        self.assertEqual('admin_id', other_utils.admin_role_id)
+        self.assertEqual('member_id', other_utils.rbac_role_id)
+
+    def test_stale_role_id_is_resolved_again(self):
+        roles_client = self._set_user(['admin_id'])
+        roles_client.list_roles.side_effect = lambda name=None: {
+            'roles': [{'name': name, 'id': 'new_%s_id' % name}]}
+        roles_client.create_user_role_on_project.side_effect = [
+            lib_exc.NotFound(), None]
+        rbac_utils._role_ids.update({'Member': 'member_id',
+                                     'admin': 'admin_id'})
+
+        self.rbac_utils._assign_role(True)
+
+        # The cached role IDs are dropped and resolved again, once.
+        roles_client.list_roles.assert_has_calls([
+            mock.call(name='Member'), mock.call(name='admin')])
+        self.assertEqual('new_Member_id', self.rbac_utils.rbac_role_id)
+        self.assertEqual('new_admin_id', self.rbac_utils.admin_role_id)
+        roles_client.create_user_role_on_project.assert_has_calls([
+            mock.call(mock.sentinel.project_id, mock.sentinel.user_id,
+                      'member_id'),
+            mock.call(mock.sentinel.project_id, mock.sentinel.user_id,
+                      'new_Member_id')])
+
+    def test_missing_role_is_only_resolved_again_once(self):
+        roles_client = self._set_user(['admin_id'])
+        roles_client.list_roles.side_effect = self._list_roles
+        roles_client.create_user_role_on_project.side_effect = \
+            lib_exc.NotFound()
+
+        self.assertRaises(lib_exc.NotFound, self.rbac_utils._assign_role,
+                          True)
+        self.assertEqual(
+            2, roles_client.create_user_role_on_project.call_count)
+
+    def test_get_roles_does_not_cache_missing_roles(self):
+        roles_client = mock.Mock(**{'list_roles.return_value':
+                                    {'roles': []}})
+        self.rbac_utils.roles_client = roles_client
+
+        for _ in range(2):
+            self.assertRaises(rbac_exceptions.RbacResourceSetupFailed,
+                              self.rbac_utils._get_roles)
+
+        self.assertEqual(4, roles_client.list_roles.call_count)
+
+    def test_get_roles_shares_role_ids_through_cache_dir(self):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        CONF.set_override('cache_dir', cache_dir, group='rbac')
+        self.addCleanup(CONF.clear_override, 'cache_dir', group='rbac')
+        roles_client = mock.Mock(**{'list_roles.side_effect':
+                                    self._list_roles})
+        self.rbac_utils.roles_client = roles_client
+
+        self.rbac_utils._get_roles()
+        # Simulate another worker process, with no role IDs in memory.
+        rbac_utils.invalidate_role_id_cache()
+        self.rbac_utils._get_roles()
+
+        self.assertEqual(2, roles_client.list_roles.call_count)
+        self.assertEqual('admin_id', self.rbac_utils.admin_role_id)
+
+    def _set_user(self, role_ids):
         roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        roles_client.reset_mock()
         roles_client.list_user_roles_on_project.return_value = {
-            'roles': [{'id': 'admin_id'}, {'id': 'member_id'}]
+            'roles': [{'id': role_id} for role_id in role_ids]
         }
 
         self.rbac_utils.roles_client = roles_client
         self.rbac_utils.project_id = mock.sentinel.project_id
         self.rbac_utils.user_id = mock.sentinel.user_id
+        return roles_client
+
+    def test_add_role_to_user(self):
+        roles_client = self._set_user(['admin_id', 'member_id'])
 
-        self.rbac_utils._clear_user_roles(None)
+        self.rbac_utils._add_role_to_user('other_id')
 
         roles_client.list_user_roles_on_project.\
             assert_called_once_with(mock.sentinel.project_id,
@@ -125,15 +249,229 @@ class RBACUtilsTest(base.TestCase):
                           'admin_id'),
                 mock.call(mock.sentinel.project_id, mock.sentinel.user_id,
                           'member_id'),
-            ])
+            ], any_order=True)
+        roles_client.create_user_role_on_project.assert_called_once_with(
+            mock.sentinel.project_id, mock.sentinel.user_id, 'other_id')
+
+    def test_add_role_to_user_serializes_auth(self):
+        roles_client = self._set_user(['admin_id', 'member_id'])
+        auth_provider = roles_client.auth_provider
+        get_auth = auth_provider.get_auth
+
+        self.rbac_utils._add_role_to_user('other_id')
+
+        # The auth data shared by the concurrent changes is read under a
+        # lock, which is only added once.
+        self.assertIs(True, auth_provider._rbac_auth_serialized)
+        wrapped_get_auth = auth_provider.get_auth
+        self.assertIsNot(get_auth, wrapped_get_auth)
+        self.rbac_utils._add_role_to_user('member_id')
+        self.assertIs(wrapped_get_auth, auth_provider.get_auth)
+        auth_provider.get_auth()
+        get_auth.assert_called_once_with()
+
+    @mock.patch.object(rbac_utils, 'atexit', autospec=True)
+    def test_role_change_pool_is_closed_at_exit(self, mock_atexit):
+        self.addCleanup(rbac_utils._close_role_change_pool)
+        rbac_utils._close_role_change_pool()
+
+        role_change_pool = rbac_utils._get_role_change_pool()
+        self.assertIs(role_change_pool, rbac_utils._get_role_change_pool())
+
+        mock_atexit.register.assert_called_once_with(
+            rbac_utils._close_role_change_pool)
+        rbac_utils._close_role_change_pool()
+        self.assertIsNone(rbac_utils._role_change_pool)
+        self.assertRaises(ValueError, role_change_pool.map, len, [[]])
+
+    def test_add_role_to_user_one_change_at_a_time(self):
+        CONF.set_override('role_switch_concurrency', 1, group='rbac')
+        self.addCleanup(CONF.clear_override, 'role_switch_concurrency',
+                        group='rbac')
+        roles_client = self._set_user(['admin_id', 'member_id'])
+
+        self.rbac_utils._add_role_to_user('other_id')
+
+        self.assertEqual([
+            mock.call.list_user_roles_on_project(
+                mock.sentinel.project_id, mock.sentinel.user_id),
+            mock.call.delete_role_from_user_on_project(
+                mock.sentinel.project_id, mock.sentinel.user_id, 'admin_id'),
+            mock.call.delete_role_from_user_on_project(
+                mock.sentinel.project_id, mock.sentinel.user_id,
+                'member_id'),
+            mock.call.create_user_role_on_project(
+                mock.sentinel.project_id, mock.sentinel.user_id, 'other_id')
+        ], roles_client.mock_calls)
+
+    @mock.patch.object(rbac_utils, 'LOG', autospec=True)
+    def test_add_role_to_user_with_failed_changes(self, mock_log):
+        roles_client = self._set_user(['admin_id', 'member_id'])
+        not_found = lib_exc.NotFound()
+        conflict = lib_exc.Conflict()
+        roles_client.delete_role_from_user_on_project.side_effect = \
+            lambda project_id, user_id, role_id: self._raise(
+                not_found if role_id == 'admin_id' else None)
+        roles_client.create_user_role_on_project.side_effect = conflict
+
+        e = self.assertRaises(lib_exc.NotFound,
+                              self.rbac_utils._add_role_to_user, 'other_id')
+
+        self.assertIs(not_found, e)
+        mock_log.error.assert_called_once_with(
+            "Failed to change a role assignment: %s", conflict)
+        # The roles of the user are listed again to know the actual state.
+        self.assertEqual(
+            2, roles_client.list_user_roles_on_project.call_count)
+        self.assertEqual(
+            ['admin_id', 'member_id'],
+            self.rbac_utils._user_role_ids[(mock.sentinel.project_id,
+                                            mock.sentinel.user_id)])
+
+    def _raise(self, exc):
+        if exc is not None:
+            raise exc
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_switch_role_applies_minimal_role_changes(self, mock_time, _):
+        mock_time.time.return_value = 100.0
+        roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        roles_client.list_user_roles_on_project.return_value = {
+            'roles': [{'id': 'admin_id'}, {'id': 'other_id'}]}
+
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        roles_client.list_user_roles_on_project.assert_called_once_with(
+            mock.sentinel.project_id, mock.sentinel.user_id)
+        roles_client.delete_role_from_user_on_project.assert_has_calls([
+            mock.call(mock.sentinel.project_id, mock.sentinel.user_id,
+                      'admin_id'),
+            mock.call(mock.sentinel.project_id, mock.sentinel.user_id,
+                      'other_id')], any_order=True)
+        roles_client.create_user_role_on_project.assert_called_once_with(
+            mock.sentinel.project_id, mock.sentinel.user_id, 'member_id')
+
+        # The assignment is known, so it is not listed again.
+        roles_client.reset_mock()
+        self.rbac_utils.switch_role(self.mock_test_obj, False)
+
+        roles_client.list_user_roles_on_project.assert_not_called()
+        roles_client.delete_role_from_user_on_project.assert_called_once_with(
+            mock.sentinel.project_id, mock.sentinel.user_id, 'member_id')
+        roles_client.create_user_role_on_project.assert_called_once_with(
+            mock.sentinel.project_id, mock.sentinel.user_id, 'admin_id')
+
+        roles_client.reset_mock()
+        self.rbac_utils.switch_role(self.mock_test_obj, False)
+
+        self.assertEqual([], roles_client.mock_calls)
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_switch_role_records_phase_timings(self, mock_time, _):
+        mock_time.time.return_value = 100.0
+        roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        roles_client.list_user_roles_on_project.return_value = {
+            'roles': [{'id': 'admin_id'}]}
+        self.rbac_utils.admin_role_id = None
+
+        rbac_utils.rbac_timings.collector.start_capture()
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+        timings = rbac_utils.rbac_timings.collector.stop_capture()
+
+        self.assertEqual(
+            ['clear_auth', 'create_assignment', 'delete_assignment',
+             'list_assignments', 'role_lookup', 'set_auth', 'switch_role',
+             'token_wait'],
+            sorted(timings))
+        self.assertEqual(1, timings['switch_role']['count'])
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    def test_switch_role_reuses_token_of_unchanged_assignment(self, _):
+        auth_provider = self.mock_test_obj.auth_provider
+        auth_provider.cache = mock.sentinel.admin_auth
+        auth_provider.is_expired.return_value = False
+        self.rbac_utils._user_role_ids = {
+            (mock.sentinel.project_id, mock.sentinel.user_id): ['admin_id']}
+
+        self.rbac_utils.switch_role(self.mock_test_obj, False)
+
+        auth_provider.is_expired.assert_called_once_with(
+            mock.sentinel.admin_auth)
+        auth_provider.clear_auth.assert_not_called()
+        auth_provider.set_auth.assert_not_called()
+        self.assertIs(mock.sentinel.admin_auth, auth_provider.cache)
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    def test_switch_role_does_not_reuse_expired_token(self, _):
+        auth_provider = self.mock_test_obj.auth_provider
+        auth_provider.cache = mock.sentinel.admin_auth
+        auth_provider.is_expired.return_value = True
+        self.rbac_utils._user_role_ids = {
+            (mock.sentinel.project_id, mock.sentinel.user_id): ['admin_id']}
+
+        self.rbac_utils.switch_role(self.mock_test_obj, False)
+
+        auth_provider.clear_auth.assert_called_once_with()
+        auth_provider.set_auth.assert_called_once_with()
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_switch_role_drops_revoked_tokens(self, mock_time, _):
+        mock_time.time.return_value = 100.0
+        auth_provider = self.mock_test_obj.auth_provider
+        auth_provider.is_expired.return_value = False
+        self.rbac_utils._user_role_ids = {
+            (mock.sentinel.project_id, mock.sentinel.user_id): ['admin_id']}
+        self.rbac_utils._user_tokens = {
+            (mock.sentinel.project_id, mock.sentinel.user_id,
+             frozenset(['member_id'])): mock.sentinel.member_auth}
+        auth_provider.cache = mock.sentinel.admin_auth
+
+        # Removing the admin role revokes both tokens of the user.
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        auth_provider.clear_auth.assert_called_once_with()
+        auth_provider.set_auth.assert_called_once_with()
+        self.assertEqual(
+            {(mock.sentinel.project_id, mock.sentinel.user_id,
+              frozenset(['member_id'])): auth_provider.cache},
+            self.rbac_utils._user_tokens)
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_switch_role_lists_roles_again_after_failure(self, mock_time, _):
+        mock_time.time.return_value = 100.0
+        roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        roles_client.list_user_roles_on_project.return_value = {
+            'roles': [{'id': 'admin_id'}]}
+        roles_client.create_user_role_on_project.side_effect = \
+            lib_exc.Conflict
+
+        self.assertRaises(lib_exc.Conflict, self.rbac_utils.switch_role,
+                          self.mock_test_obj, True)
+        roles_client.create_user_role_on_project.side_effect = None
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        self.assertEqual(
+            2, roles_client.list_user_roles_on_project.call_count)
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     @mock.patch.object(rbac_utils, 'time', autospec=True)
     def test_rbac_utils_switch_role_to_admin_role(self, mock_time, _):
         self.rbac_utils.prev_switch_role = True
         self._mock_list_user_roles_on_project('admin_id')
         roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        # The role is assigned at 100.25s and the token is requested at 100.5s.
+        mock_time.time.side_effect = [100.25, 100.5]
 
         self.rbac_utils.switch_role(self.mock_test_obj, False)
 
@@ -141,14 +479,15 @@ class RBACUtilsTest(base.TestCase):
             mock.sentinel.project_id, mock.sentinel.user_id, 'admin_id')
         self.mock_test_obj.auth_provider.clear_auth.assert_called_once_with()
         self.mock_test_obj.auth_provider.set_auth.assert_called_once_with()
-        mock_time.sleep.assert_called_once_with(1)
+        mock_time.sleep.assert_called_once_with(0.5)
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     @mock.patch.object(rbac_utils, 'time', autospec=True)
     def test_rbac_utils_switch_role_to_rbac_role(self, mock_time, _):
         self._mock_list_user_roles_on_project('member_id')
         roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        mock_time.time.side_effect = [100.25, 100.5]
 
         self.rbac_utils.switch_role(self.mock_test_obj, True)
 
@@ -156,7 +495,423 @@ class RBACUtilsTest(base.TestCase):
             mock.sentinel.project_id, mock.sentinel.user_id, 'member_id')
         self.mock_test_obj.auth_provider.clear_auth.assert_called_once_with()
         self.mock_test_obj.auth_provider.set_auth.assert_called_once_with()
-        mock_time.sleep.assert_called_once_with(1)
+        mock_time.sleep.assert_called_once_with(0.5)
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_rbac_utils_switch_role_waits_for_token_issue_time(self,
+                                                               mock_time, _):
+        # The token was issued after the role assignment, by a Keystone
+        # server whose clock is ahead.
+        self.mock_test_obj.auth_provider.cache = (
+            mock.sentinel.token, {'issued_at': '1970-01-01T00:01:41.200000Z'})
+        mock_time.time.side_effect = [100.25, 100.5]
+        waits = rbac_utils.get_token_wait_stats()['waits']
+
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        mock_time.sleep.assert_called_once_with(1.5)
+        self.assertEqual(waits + 1,
+                         rbac_utils.get_token_wait_stats()['waits'])
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_rbac_utils_switch_role_after_token_boundary(self, mock_time, _):
+        mock_time.time.side_effect = [100.25, 101.0]
+
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        mock_time.sleep.assert_not_called()
+        self.mock_test_obj.auth_provider.set_auth.assert_called_once_with()
+
+    def _mock_token_issue(self, role_change_date, *issued_ats):
+        roles_client = self.mock_test_obj.os_admin.roles_v3_client
+        roles_client.create_user_role_on_project.return_value = \
+            rest_client.ResponseBody({'date': role_change_date})
+        auth_provider = self.mock_test_obj.auth_provider
+        auth_provider.cache = (
+            mock.sentinel.token, {'issued_at': '1970-01-01T00:01:30Z'})
+        tokens = iter([(mock.sentinel.token, {'issued_at': issued_at})
+                       for issued_at in issued_ats])
+
+        def set_auth():
+            auth_provider.cache = next(tokens)
+        auth_provider.set_auth.side_effect = set_auth
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_rbac_utils_switch_role_with_skewed_clocks(self, mock_time, _):
+        # The clock of Keystone is 2 seconds ahead: the role is assigned at
+        # 102s and the token is issued at 102.3s by its clock, while the
+        # clock of the client has only reached the 101s boundary.
+        self._mock_token_issue('Thu, 01 Jan 1970 00:01:42 GMT',
+                               '1970-01-01T00:01:42.300000Z',
+                               '1970-01-01T00:01:43.000000Z')
+        mock_time.time.side_effect = [100.25, 100.5]
+
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        # The revoked token is replaced once Keystone reaches 103s.
+        self.assertEqual(2, mock_time.sleep.call_count)
+        self.assertEqual(0.5, mock_time.sleep.call_args_list[0][0][0])
+        self.assertAlmostEqual(0.7, mock_time.sleep.call_args_list[1][0][0])
+        auth_provider = self.mock_test_obj.auth_provider
+        self.assertEqual(2, auth_provider.clear_auth.call_count)
+        self.assertEqual(2, auth_provider.set_auth.call_count)
+        self.assertEqual(103, self.rbac_utils._get_token_issued_at(
+            auth_provider))
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_rbac_utils_switch_role_with_synced_clocks(self, mock_time, _):
+        self._mock_token_issue('Thu, 01 Jan 1970 00:01:40 GMT',
+                               '1970-01-01T00:01:41.000000Z')
+        mock_time.time.side_effect = [100.25, 100.5]
+
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        mock_time.sleep.assert_called_once_with(0.5)
+        self.mock_test_obj.auth_provider.clear_auth.assert_called_once_with()
+        self.mock_test_obj.auth_provider.set_auth.assert_called_once_with()
+
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_wait_for_unverified_token_boundary(self, mock_time):
+        # A token that is not checked afterwards is only requested a whole
+        # second after the role change.
+        self.rbac_utils._role_write_time = 100.75
+        mock_time.time.return_value = 101.25
+
+        self.rbac_utils._wait_for_token_boundary(None, verified=False)
+        mock_time.sleep.assert_called_once_with(0.5)
+
+        mock_time.sleep.reset_mock()
+        self.rbac_utils._wait_for_token_boundary(None)
+        mock_time.sleep.assert_not_called()
+
+    def test_get_response_time(self):
+        self.assertEqual(102, rbac_utils._get_response_time(
+            rest_client.ResponseBody(
+                {'date': 'Thu, 01 Jan 1970 00:01:42 GMT'})))
+        self.assertIsNone(rbac_utils._get_response_time(
+            rest_client.ResponseBody({'date': 'invalid'})))
+        self.assertIsNone(rbac_utils._get_response_time(
+            rest_client.ResponseBody({})))
+        self.assertIsNone(rbac_utils._get_response_time(None))
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=['member_id'])
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_rbac_utils_switch_role_without_role_change(self, mock_time, _):
+        self.rbac_utils.switch_role(self.mock_test_obj, True)
+
+        mock_time.sleep.assert_not_called()
+        self.mock_test_obj.auth_provider.clear_auth.assert_called_once_with()
+        self.mock_test_obj.auth_provider.set_auth.assert_called_once_with()
+
+    @mock.patch.object(rbac_utils, 'credentials', autospec=True,
+                       **{'is_admin_available.return_value': True})
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
+    @mock.patch.object(rbac_utils.RbacUtils, '_validate_switch_role',
+                       autospec=True)
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_dual_user_mode(self, mock_time, _, mock_get_user_role_ids,
+                            mock_creds):
+        CONF.set_override('switch_role_mode', 'dual_user', group='rbac')
+        self.addCleanup(CONF.clear_override, 'switch_role_mode',
+                        group='rbac')
+        self.mock_test_obj.addClassResourceCleanup = mock.Mock()
+        auth_provider = self.mock_test_obj.auth_provider
+        primary_creds = auth_provider.credentials
+        primary_creds.user_domain_id = 'domain_id'
+        primary_creds.project_domain_id = None
+        admin_creds = mock_creds.get_credentials.return_value
+        os_admin = self.mock_test_obj.os_admin
+        os_admin.users_v3_client.create_user.return_value = {
+            'user': {'id': 'admin_user_id', 'name': 'admin_user'}}
+        rbac_utils.RbacUtils.admin_role_id = None
+        rbac_utils.RbacUtils.rbac_role_id = None
+        # The test user is assigned its role at 100.25s and authenticates at
+        # 100.5s, then the admin user is assigned its role at 100.75s.
+        mock_time.time.side_effect = [100.25, 100.5, 100.75, 101.0]
+
+        utils = rbac_utils.RbacUtils(self.mock_test_obj)
+
+        # The test user is assigned rbac_test_role and a new user of the same
+        # project is assigned the admin role.
+        mock_get_user_role_ids.assert_called_once_with(utils)
+        os_admin.roles_v3_client.create_user_role_on_project.\
+            assert_has_calls([
+                mock.call(mock.sentinel.project_id, mock.sentinel.user_id,
+                          'member_id'),
+                mock.call(mock.sentinel.project_id, 'admin_user_id',
+                          'admin_id')])
+        create_user_kwargs = \
+            os_admin.users_v3_client.create_user.call_args[1]
+        self.assertEqual(mock.sentinel.project_id,
+                         create_user_kwargs['project_id'])
+        self.assertEqual('domain_id', create_user_kwargs['domain_id'])
+        self.mock_test_obj.addClassResourceCleanup.assert_called_with(
+            rbac_utils.test_utils.call_and_ignore_notfound_exc,
+            os_admin.users_v3_client.delete_user, 'admin_user_id')
+        get_credentials_kwargs = mock_creds.get_credentials.call_args[1]
+        self.assertEqual('admin_user_id', get_credentials_kwargs['user_id'])
+        self.assertEqual(create_user_kwargs['password'],
+                         get_credentials_kwargs['password'])
+        self.assertEqual('domain_id',
+                         get_credentials_kwargs['user_domain_id'])
+        self.assertNotIn('project_domain_id', get_credentials_kwargs)
+
+        # The admin user is switched to after the setup, once its first
+        # token would no longer be revoked by its role assignment.
+        self.assertIs(admin_creds, auth_provider.credentials)
+        self.assertIsNone(auth_provider.cache)
+        self.assertEqual([mock.call(0.5), mock.call(0.75)],
+                         mock_time.sleep.call_args_list)
+
+        # Switching swaps the users without calling Keystone.
+        auth_provider.cache = mock.sentinel.admin_auth
+        os_admin.reset_mock()
+        auth_provider.reset_mock()
+
+        utils.switch_role(self.mock_test_obj, True)
+        self.assertIs(primary_creds, auth_provider.credentials)
+        utils.switch_role(self.mock_test_obj, False)
+        self.assertIs(admin_creds, auth_provider.credentials)
+        self.assertIs(mock.sentinel.admin_auth, auth_provider.cache)
+
+        self.assertEqual([], os_admin.mock_calls)
+        auth_provider.clear_auth.assert_not_called()
+        auth_provider.set_auth.assert_not_called()
+
+    def test_set_rbac_test_role(self):
+        self.rbac_utils.roles_client = mock.Mock(
+            **{'list_roles.side_effect': self._list_roles})
+        self.assertEqual('Member', self.rbac_utils.rbac_test_role)
+        self.assertFalse(self.rbac_utils.is_admin)
+
+        self.rbac_utils.set_rbac_test_role(self.mock_test_obj, 'admin')
+
+        # The role ID is resolved by the next role switch.
+        self.assertEqual('admin', self.rbac_utils.rbac_test_role)
+        self.assertTrue(self.rbac_utils.is_admin)
+        self.assertIsNone(self.rbac_utils.rbac_role_id)
+        self.rbac_utils._get_roles()
+        self.assertEqual('admin_id', self.rbac_utils.rbac_role_id)
+
+        self.rbac_utils.set_rbac_test_role(self.mock_test_obj, 'admin')
+        self.assertEqual('admin_id', self.rbac_utils.rbac_role_id)
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_wait_for_token_boundary',
+                       autospec=True)
+    @mock.patch.object(rbac_utils.RbacUtils, '_add_role_to_user',
+                       autospec=True)
+    def test_set_rbac_test_role_in_dual_user_mode(self,
+                                                  mock_add_role_to_user,
+                                                  mock_wait):
+        CONF.set_override('switch_role_mode', 'dual_user', group='rbac')
+        self.addCleanup(CONF.clear_override, 'switch_role_mode',
+                        group='rbac')
+        self.rbac_utils.roles_client = mock.Mock(
+            **{'list_roles.side_effect': self._list_roles})
+        test_creds = mock.Mock(user_id='test_user_id',
+                               tenant_id='test_project_id')
+        self.rbac_utils._dual_user_auth = {
+            True: (test_creds, mock.sentinel.test_auth),
+            False: (mock.sentinel.admin_creds, mock.sentinel.admin_auth)}
+        self.rbac_utils._dual_user_role = False
+        self.rbac_utils.token = 'fernet-token'
+
+        self.rbac_utils.set_rbac_test_role(self.mock_test_obj, 'admin')
+
+        # The role of the test user is changed and its token is dropped,
+        # once a new token would no longer be revoked.
+        mock_add_role_to_user.assert_called_once_with(self.rbac_utils,
+                                                      'admin_id')
+        mock_wait.assert_called_once_with(self.rbac_utils, None,
+                                          verified=False)
+        self.assertEqual('test_user_id', self.rbac_utils.user_id)
+        self.assertEqual('test_project_id', self.rbac_utils.project_id)
+        self.assertEqual((test_creds, None),
+                         self.rbac_utils._dual_user_auth[True])
+
+    @mock.patch.object(rbac_utils, 'time', autospec=True)
+    def test_set_rbac_test_role_in_dual_user_mode_waits_for_role_change(
+            self, mock_time):
+        CONF.set_override('switch_role_mode', 'dual_user', group='rbac')
+        self.addCleanup(CONF.clear_override, 'switch_role_mode',
+                        group='rbac')
+        roles_client = self._set_user(['member_id'])
+        roles_client.list_roles.side_effect = self._list_roles
+        test_creds = mock.Mock(user_id=mock.sentinel.user_id,
+                               tenant_id=mock.sentinel.project_id)
+        self.rbac_utils._dual_user_auth = {
+            True: (test_creds, mock.sentinel.test_auth),
+            False: (mock.sentinel.admin_creds, mock.sentinel.admin_auth)}
+        self.rbac_utils._dual_user_role = False
+        self.rbac_utils.token = 'fernet-token'
+        # The role is assigned at 100.25s and the wait starts at 100.5s.
+        mock_time.time.side_effect = [100.25, 100.5]
+
+        self.rbac_utils.set_rbac_test_role(self.mock_test_obj, 'admin')
+
+        roles_client.create_user_role_on_project.assert_called_once_with(
+            mock.sentinel.project_id, mock.sentinel.user_id, 'admin_id')
+        self.assertEqual(100.25, self.rbac_utils._role_write_time)
+        mock_time.sleep.assert_called_once_with(0.75)
+
+    @mock.patch.object(rbac_utils, 'atexit', autospec=True)
+    @mock.patch.object(rbac_utils, 'credentials', autospec=True)
+    def test_worker_isolation(self, mock_creds, mock_atexit):
+        CONF.set_override('worker_isolation', True, group='rbac')
+        self.addCleanup(CONF.clear_override, 'worker_isolation',
+                        group='rbac')
+        CONF.set_override('use_dynamic_credentials', False, group='auth')
+        self.addCleanup(CONF.clear_override, 'use_dynamic_credentials',
+                        group='auth')
+        self.addCleanup(setattr, rbac_utils, '_worker_credentials', None)
+        admin_manager = mock_creds.AdminManager.return_value = mock.Mock()
+        admin_manager.roles_v3_client.list_roles.return_value = {
+            'roles': [{'name': 'admin', 'id': 'admin_id'}]}
+        admin_manager.projects_client.create_project.return_value = {
+            'project': {'id': 'project_id', 'name': 'project_name'}}
+        admin_manager.users_v3_client.create_user.return_value = {
+            'user': {'id': 'user_id', 'name': 'user_name'}}
+        worker_creds = mock_creds.get_credentials.return_value
+        test_classes = []
+        for _ in range(2):
+            test_class = mock.Mock()
+            primary_creds = test_class.os_primary.credentials
+            primary_creds.user_domain_id = 'domain_id'
+            primary_creds.project_domain_id = 'domain_id'
+            primary_creds.user_domain_name = None
+            primary_creds.project_domain_name = None
+            test_classes.append(test_class)
+
+        for test_class in test_classes:
+            rbac_utils.isolate_worker(test_class)
+
+        # The project and user are only created once per worker, with
+        # clients that outlive the test classes.
+        admin_manager.projects_client.create_project.assert_called_once_with(
+            name=mock.ANY, domain_id='domain_id')
+        admin_manager.users_v3_client.create_user.assert_called_once_with(
+            name=mock.ANY, password=mock.ANY, project_id='project_id',
+            domain_id='domain_id')
+        admin_manager.roles_v3_client.create_user_role_on_project.\
+            assert_called_once_with('project_id', 'user_id', 'admin_id')
+        mock_atexit.register.assert_has_calls([
+            mock.call(rbac_utils._delete_worker_resources,
+                      admin_manager.projects_client.delete_project,
+                      'project_id'),
+            mock.call(rbac_utils._delete_worker_resources,
+                      admin_manager.users_v3_client.delete_user,
+                      'user_id')])
+        # The clients of each test class are created from the credentials
+        # of the worker.
+        for test_class in test_classes:
+            test_class.client_manager.assert_called_once_with(
+                credentials=worker_creds)
+            self.assertIs(test_class.client_manager.return_value,
+                          test_class.os_primary)
+
+    def test_worker_isolation_with_dynamic_credentials(self):
+        CONF.set_override('worker_isolation', True, group='rbac')
+        self.addCleanup(CONF.clear_override, 'worker_isolation',
+                        group='rbac')
+        CONF.set_override('use_dynamic_credentials', True, group='auth')
+        self.addCleanup(CONF.clear_override, 'use_dynamic_credentials',
+                        group='auth')
+        test_class = mock.Mock()
+        os_primary = test_class.os_primary
+
+        rbac_utils.isolate_worker(test_class)
+
+        test_class.client_manager.assert_not_called()
+        self.assertIs(os_primary, test_class.os_primary)
+
+    def test_start_switch_role_runs_in_background(self):
+        started = threading.Event()
+        proceed = threading.Event()
+        switches = []
+
+        def switch_role(test_obj, toggle_rbac_role, validate=True):
+            started.set()
+            proceed.wait(10)
+            switches.append((toggle_rbac_role, validate))
+
+        auth_provider = self.mock_test_obj.auth_provider
+        auth_request = auth_provider.auth_request
+        with mock.patch.object(self.rbac_utils, '_switch_role',
+                               side_effect=switch_role):
+            self.rbac_utils.start_switch_role(self.mock_test_obj, False)
+            self.assertTrue(started.wait(10))
+            self.assertEqual([], switches)
+
+            proceed.set()
+            # Using the auth provider waits for the switch to complete.
+            auth_provider.auth_request('GET', 'url')
+
+        self.assertEqual([(False, False)], switches)
+        auth_request.assert_called_once_with('GET', 'url')
+        self.assertIsNone(self.rbac_utils._pending_switch)
+
+    @mock.patch.object(rbac_utils.RbacUtils, '_switch_role', autospec=True)
+    def test_start_switch_role_validates_immediately(self, _):
+        self.rbac_utils.start_switch_role(self.mock_test_obj, False)
+        self.rbac_utils.wait_for_switch_role()
+
+        self.assertRaises(rbac_exceptions.RbacResourceSetupFailed,
+                          self.rbac_utils.start_switch_role,
+                          self.mock_test_obj, False)
+        self.assertIsNone(self.rbac_utils._pending_switch)
+
+    def test_start_switch_role_error_is_raised_by_next_switch(self):
+        with mock.patch.object(self.rbac_utils, '_switch_role',
+                               side_effect=lib_exc.NotFound):
+            self.rbac_utils.start_switch_role(self.mock_test_obj, False)
+
+            self.assertRaises(lib_exc.NotFound, self.rbac_utils.switch_role,
+                              self.mock_test_obj, True)
+            # The error is only raised once.
+            self.rbac_utils.wait_for_switch_role()
+
+    def test_start_switch_role_timings_attached_to_starting_test(self):
+        def switch_role(test_obj, toggle_rbac_role, validate=True):
+            rbac_timings.collector.record('set_auth', 1.0)
+
+        with mock.patch.object(self.rbac_utils, '_switch_role',
+                               side_effect=switch_role):
+            self.rbac_utils.start_switch_role(self.mock_test_obj, False)
+            self.rbac_utils.wait_for_switch_role()
+
+        self.mock_test_obj.addDetail.assert_called_once_with(
+            'switch_role_restore_timings', mock.ANY)
+        detail = self.mock_test_obj.addDetail.call_args[0][1]
+        timings = json.loads(b''.join(detail.iter_bytes()).decode('utf-8'))
+        self.assertEqual(['set_auth', 'switch_role'], sorted(timings))
+        self.assertEqual({'count': 1, 'total': 1.0, 'max': 1.0},
+                         timings['set_auth'])
+
+    def test_get_token_issued_at(self):
+        auth_provider = mock.Mock()
+        auth_provider.cache = (mock.sentinel.token,
+                               {'issued_at': '1970-01-01T00:01:40Z'})
+        self.assertEqual(
+            100, self.rbac_utils._get_token_issued_at(auth_provider))
+
+        # Identity v2 tokens.
+        auth_provider.cache = (mock.sentinel.token, {
+            'token': {'issued_at': '1970-01-01T00:01:40.500000Z'}})
+        self.assertEqual(
+            100.5, self.rbac_utils._get_token_issued_at(auth_provider))
+
+        auth_provider.cache = None
+        self.assertIsNone(self.rbac_utils._get_token_issued_at(auth_provider))
 
     def test_RBAC_utils_switch_roles_without_boolean_value(self):
         self.assertRaises(rbac_exceptions.RbacResourceSetupFailed,
@@ -166,8 +921,8 @@ class RBACUtilsTest(base.TestCase):
                           self.rbac_utils.switch_role, self.mock_test_obj,
                           None)
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     def test_rbac_utils_switch_roles_with_false_value_twice(self, _):
         self._mock_list_user_roles_on_project('admin_id')
         self.rbac_utils.switch_role(self.mock_test_obj, False)
@@ -179,8 +934,8 @@ class RBACUtilsTest(base.TestCase):
             'twice. Make sure that you included a rbac_utils.switch_role '
             'method call inside the test.', str(e))
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     def test_rbac_utils_switch_roles_with_true_value_twice(self, _):
         self._mock_list_user_roles_on_project('admin_id')
         self.rbac_utils.switch_role(self.mock_test_obj, True)
@@ -192,8 +947,8 @@ class RBACUtilsTest(base.TestCase):
             'twice. Make sure that you included a rbac_utils.switch_role '
             'method call inside the test.', str(e))
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     @mock.patch.object(rbac_utils, 'LOG', autospec=True)
     @mock.patch.object(rbac_utils, 'sys', autospec=True)
     def test_rbac_utils_switch_roles_with_unhandled_exception(self, mock_sys,
@@ -229,10 +984,10 @@ class RBACUtilsTest(base.TestCase):
             self.rbac_utils.switch_role(self.mock_test_obj, True)
             mock_log.error.assert_not_called()
 
-    @mock.patch.object(rbac_utils.RbacUtils, '_clear_user_roles',
-                       autospec=True, return_value=False)
+    @mock.patch.object(rbac_utils.RbacUtils, '_get_user_role_ids',
+                       autospec=True, return_value=[])
     def test_rbac_utils_switch_role_except_exception(self,
-                                                     mock_clear_user_roles):
+                                                     mock_get_user_role_ids):
         roles_client = self.mock_test_obj.os_admin.roles_v3_client
         roles_client.create_user_role_on_project.side_effect =\
             lib_exc.NotFound
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright 2017 AT&T Corporation.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmarks construction of oslo.policy rules from a merged policy.
+
+Compares building ``oslo_policy.policy.Rules`` by serializing the merged
+policy dictionary to JSON and loading it again (``Rules.load``) with
+building them directly from the dictionary (``Rules.from_dict``).
+
+Usage::
+
+    $ python tools/benchmark_policy_construction.py [--rules 2000]
+"""
+
+import argparse
+import json
+import timeit
+
+from oslo_policy import policy
+
+
+_RULE_TEMPLATES = [
+    'role:admin',
+    'rule:admin_or_owner',
+    'is_admin:True or project_id:%(project_id)s',
+    'role:admin and (role:member or user_id:%(user_id)s)',
+    'rule:context_is_admin or not role:reader',
+    '@',
+]
+
+
+def make_policy(num_rules):
+    policy_data = {
+        'context_is_admin': 'role:admin',
+        'admin_or_owner': 'is_admin:True or project_id:%(project_id)s',
+        'default': 'rule:admin_or_owner',
+    }
+    for i in range(num_rules - len(policy_data)):
+        policy_data['service:action_%d' % i] = _RULE_TEMPLATES[
+            i % len(_RULE_TEMPLATES)]
+    return policy_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rules', type=int, default=2000,
+                        help='Number of rules in the generated policy.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of constructions to time.')
+    args = parser.parse_args()
+
+    policy_data = make_policy(args.rules)
+
+    def round_trip():
+        return policy.Rules.load(json.dumps(policy_data), 'default')
+
+    def from_dict():
+        return policy.Rules.from_dict(policy_data, 'default')
+
+    expected = sorted((k, str(v)) for k, v in round_trip().items())
+    actual = sorted((k, str(v)) for k, v in from_dict().items())
+    assert expected == actual, 'Both constructions must yield equal rules.'
+
+    for name, func in [('json.dumps + Rules.load', round_trip),
+                       ('Rules.from_dict', from_dict)]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('%-25s %8.2f ms per %d-rule policy'
+              % (name, best * 1000, args.rules))
+
+
+if __name__ == '__main__':
+    main()